@@ -1,29 +1,248 @@
 #include <stdint.h>
+#include <stdarg.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <time.h>
+#include <unistd.h>
+#include <dirent.h>
 
+#include <sys/mman.h>
+#include <sys/syscall.h>
 #include <sys/time.h>
 #include <sys/types.h>
 #include <sys/stat.h>
+#include <sys/uio.h>
 #include <fcntl.h>
 #include <pthread.h>
 #include "Aprof.h"
 
+#ifdef __ANDROID__
 #include <asm/sigcontext.h>       /* for sigcontext */
 #include <asm/signal.h>           /* for stack_t */
-
 #include <android/log.h>
+#define DEFAULT_OUTFILE "/sdcard/profiledata.bin"
+#else
+#include <ucontext.h>
+#define DEFAULT_OUTFILE "profiledata.bin"
+#endif
+
+#ifndef sigev_notify_thread_id
+#define sigev_notify_thread_id _sigev_un._tid
+#endif
+#ifndef SIGEV_THREAD_ID
+#define SIGEV_THREAD_ID 4
+#endif
 
 namespace GUM {
 
+Aprof::Ring Aprof::_rings[MAX_THREADS];
+void** Aprof::_ringmemory = 0;
+uint32_t Aprof::_ringwords = 0;
+uint32_t Aprof::_ringcapacity = 0;
+Aprof::ThreadTimer Aprof::_timers[MAX_THREADS];
+int Aprof::_frequency = DEFAULT_FREQUENCY;
+Aprof::ClockMode Aprof::_clockmode = PROCESS_CPU;
+int Aprof::_stackdepth = 0;
+volatile int Aprof::_sampling = 0;
+volatile int Aprof::_inhandler = 0;
+int32_t Aprof::_flushertid = 0;
 int Aprof::_dumpfile = -1;
-void* Aprof::_buffer[BUFFER_SIZE];
-int Aprof::_bufferpos = 0;
-uint64_t Aprof::_samplecount = 0;
-int Aprof::_samplecountoffset = 0;
-pthread_mutex_t Aprof::_mutex = PTHREAD_MUTEX_INITIALIZER;
+pthread_t Aprof::_flusher;
+volatile int Aprof::_running = 0;
+volatile uint64_t Aprof::_samplecount = 0;
+volatile uint32_t Aprof::_droppedcount = 0;
+
+static void Log(const char* format, ...)
+{
+	va_list args;
+	va_start(args, format);
+#ifdef __ANDROID__
+	__android_log_vprint(ANDROID_LOG_INFO, "Aprof", format, args);
+#else
+	fprintf(stderr, "Aprof: ");
+	vfprintf(stderr, format, args);
+	fprintf(stderr, "\n");
+#endif
+	va_end(args);
+}
+
+static void* ContextPC(void* context)
+{
+	ucontext_t* uc = reinterpret_cast<ucontext_t*>(context);
+#if defined(__arm__)
+	return reinterpret_cast<void*>(uc->uc_mcontext.arm_pc);
+#elif defined(__aarch64__)
+	return reinterpret_cast<void*>(uc->uc_mcontext.pc);
+#elif defined(__x86_64__)
+	return reinterpret_cast<void*>(uc->uc_mcontext.gregs[REG_RIP]);
+#elif defined(__i386__)
+	return reinterpret_cast<void*>(uc->uc_mcontext.gregs[REG_EIP]);
+#else
+#error "Aprof doesn't know how to find the PC on this architecture"
+#endif
+}
+
+struct StackRegisters
+{
+	uintptr_t sp;
+	uintptr_t fp;
+	uintptr_t lr; // 0 where calls don't use a link register
+};
+
+static void ContextRegisters(void* context, StackRegisters* regs)
+{
+	ucontext_t* uc = reinterpret_cast<ucontext_t*>(context);
+#if defined(__arm__)
+	regs->sp = uc->uc_mcontext.arm_sp;
+	regs->fp = uc->uc_mcontext.arm_fp;
+	regs->lr = uc->uc_mcontext.arm_lr;
+#elif defined(__aarch64__)
+	regs->sp = uc->uc_mcontext.sp;
+	regs->fp = uc->uc_mcontext.regs[29];
+	regs->lr = uc->uc_mcontext.regs[30];
+#elif defined(__x86_64__)
+	regs->sp = uc->uc_mcontext.gregs[REG_RSP];
+	regs->fp = uc->uc_mcontext.gregs[REG_RBP];
+	regs->lr = 0;
+#elif defined(__i386__)
+	regs->sp = uc->uc_mcontext.gregs[REG_ESP];
+	regs->fp = uc->uc_mcontext.gregs[REG_EBP];
+	regs->lr = 0;
+#endif
+}
+
+static bool SafeRead(uintptr_t addr, void* out, size_t size)
+{
+	// Frame pointers can't be trusted (code built without them reuses the
+	// register), so copy through the kernel, which fails instead of faulting
+#ifdef __NR_process_vm_readv
+	iovec local;
+	local.iov_base = out;
+	local.iov_len = size;
+	iovec remote;
+	remote.iov_base = reinterpret_cast<void*>(addr);
+	remote.iov_len = size;
+	return syscall(__NR_process_vm_readv, getpid(), &local, 1, &remote, 1, 0) == static_cast<ssize_t>(size);
+#else
+	return false;
+#endif
+}
+
+// Frames further than this above the interrupted stack pointer end the walk
+static const uintptr_t MAX_STACK_BYTES = 8 << 20;
+
+static int CaptureStack(void* context, void** frames, int maxdepth, bool* haslr)
+{
+	// Leaf first: the PC, the link register, then the return address of each
+	// frame record. A frame record is the {caller's frame pointer, return
+	// address} pair that the frame pointer points at (aarch64, x86, and 32-bit
+	// ARM code built by clang).
+	StackRegisters regs;
+	ContextRegisters(context, &regs);
+	int n = 0;
+	frames[n++] = ContextPC(context);
+	*haslr = false;
+	if (regs.lr && n < maxdepth)
+	{
+		frames[n++] = reinterpret_cast<void*>(regs.lr);
+		*haslr = true;
+	}
+	uintptr_t fp = regs.fp;
+	uintptr_t low = regs.sp;
+	bool first = true;
+	while (n < maxdepth && fp >= low && fp - regs.sp < MAX_STACK_BYTES && fp % sizeof(void*) == 0)
+	{
+		uintptr_t record[2];
+		if (!SafeRead(fp, record, sizeof(record)) || record[1] == 0)
+		{
+			break;
+		}
+		// In a function that has saved the link register, the first return
+		// address is the link register again
+		if (!(first && *haslr && record[1] == regs.lr))
+		{
+			frames[n++] = reinterpret_cast<void*>(record[1]);
+		}
+		first = false;
+		// Callers' frames are always further up the stack
+		low = fp + sizeof(record);
+		fp = record[0];
+	}
+	return n;
+}
+
+static const char* ClockModeName(Aprof::ClockMode clockmode)
+{
+	switch (clockmode)
+	{
+	case Aprof::THREAD_CPU:
+		return "thread";
+	case Aprof::WALL_CLOCK:
+		return "wall";
+	default:
+		return "prof";
+	}
+}
+
+static clockid_t ThreadCPUClock(int32_t tid)
+{
+	// The kernel's clock id for the CPU time of another thread of this process
+	// (CPUCLOCK_PERTHREAD | CPUCLOCK_SCHED), which CLOCK_THREAD_CPUTIME_ID can
+	// only name for the calling thread
+	return (~static_cast<clockid_t>(tid) << 3) | 6;
+}
+
+static void WriteAll(int fd, const void* data, size_t size)
+{
+	const char* p = reinterpret_cast<const char*>(data);
+	while (size > 0)
+	{
+		ssize_t n = write(fd, p, size);
+		if (n <= 0)
+		{
+			return;
+		}
+		p += n;
+		size -= n;
+	}
+}
 
 Aprof::Aprof()
 {
-	Begin("/sdcard/profiledata.bin");
+	// APROF_OUTPUT overrides the dump file; set it empty to start no session.
+	// APROF_FREQUENCY (Hz), APROF_CLOCK (prof, thread or wall) and
+	// APROF_STACK_DEPTH (frames, 0 for the PC only) configure it.
+	const char* outfilename = getenv("APROF_OUTPUT");
+	if (!outfilename)
+	{
+		outfilename = DEFAULT_OUTFILE;
+	}
+	int frequency = DEFAULT_FREQUENCY;
+	if (getenv("APROF_FREQUENCY"))
+	{
+		frequency = atoi(getenv("APROF_FREQUENCY"));
+	}
+	int stackdepth = 0;
+	if (getenv("APROF_STACK_DEPTH"))
+	{
+		stackdepth = atoi(getenv("APROF_STACK_DEPTH"));
+	}
+	ClockMode clockmode = PROCESS_CPU;
+	const char* clockname = getenv("APROF_CLOCK");
+	if (clockname && strcmp(clockname, ClockModeName(THREAD_CPU)) == 0)
+	{
+		clockmode = THREAD_CPU;
+	}
+	else if (clockname && strcmp(clockname, ClockModeName(WALL_CLOCK)) == 0)
+	{
+		clockmode = WALL_CLOCK;
+	}
+	if (*outfilename)
+	{
+		Begin(outfilename, frequency, clockmode, stackdepth);
+	}
 }
 
 Aprof::~Aprof()
@@ -31,116 +250,478 @@ Aprof::~Aprof()
 	End();
 }
 
-bool Aprof::Begin(const char* outfilename)
+bool Aprof::Begin(const char* outfilename, int frequency, ClockMode clockmode, int stackdepth)
 {
-    __android_log_print(ANDROID_LOG_INFO, "Aprof", "Aprof starting up");
+	Log("Aprof starting up");
 	// If already profiling, end old session
 	if (_dumpfile >= 0)
 	{
 		End();
 	}
-	
+	if (frequency <= 0 || frequency > 1000000)
+	{
+		Log("Bad sampling frequency %d", frequency);
+		return false;
+	}
+	if (stackdepth < 0 || stackdepth > MAX_STACK_DEPTH)
+	{
+		Log("Bad stack depth %d", stackdepth);
+		return false;
+	}
+	_frequency = frequency;
+	_clockmode = clockmode;
+	_stackdepth = stackdepth;
+	if (!AllocateRings(stackdepth ? STACK_RING_SIZE * (stackdepth + 1) : RING_SIZE))
+	{
+		Log("Failed to allocate sample buffers");
+		return false;
+	}
+
 	// Open dump file
 	_dumpfile = open(outfilename, O_CREAT | O_WRONLY | O_TRUNC, 0666);
 	if (_dumpfile < 0)
 	{
-        __android_log_print(ANDROID_LOG_INFO, "Aprof", "Failed to open %s", outfilename);
+		Log("Failed to open %s", outfilename);
 		return false;
 	}
 
-    __android_log_print(ANDROID_LOG_INFO, "Aprof", "Opened %s", outfilename);
+	Log("Opened %s", outfilename);
 
-	// Write version 1 PROFDAT file
-	
-	// I. Write PROFDAT1 header string
-	write(_dumpfile, "PROFDAT1", 8);
+	// Write version 2 PROFDAT file (see Aprof/ProfileData.py for the layout)
+
+	// I. Write PROFDAT2 header string
+	WriteAll(_dumpfile, "PROFDAT2", 8);
 
 	// II. Write PC size (bytes, should be 4 or 8, endianness indicates process endianness)
-	uint32_t pcsize = static_cast<char>(sizeof(void*));
-	write(_dumpfile, &pcsize, sizeof(pcsize));
+	uint32_t pcsize = sizeof(void*);
+	WriteAll(_dumpfile, &pcsize, sizeof(pcsize));
+	uint32_t reserved = 0;
+	WriteAll(_dumpfile, &reserved, sizeof(reserved));
 
-	// III. Write sample count
+	// III. The chunks follow: the sampling configuration first, then the
+	// samples written by the flusher thread, then the totals and maps from End()
+	WriteInfo(false);
+	for (int i = 0; i < MAX_THREADS; ++i)
+	{
+		_rings[i].tid = 0;
+		_rings[i].head = 0;
+		_rings[i].tail = 0;
+		_rings[i].words = _ringmemory + i * _ringwords;
+	}
+	memset(_timers, 0, sizeof(_timers));
 	_samplecount = 0;
-	_samplecountoffset = lseek(_dumpfile, 0, SEEK_CUR);
-	write(_dumpfile, &_samplecount, sizeof(_samplecount));
-	
-	// Configure SIGPROF signal handler
+	_droppedcount = 0;
+
+	// Configure SIGPROF signal handler (every clock mode delivers SIGPROF). It
+	// must be in place before the flusher creates the first per-thread timer.
 	sigset_t mask;
 	sigfillset(&mask);
-	
+
 	struct sigaction act;
+	memset(&act, 0, sizeof(act));
 	act.sa_sigaction = &Handler;
 	act.sa_mask = mask;
-	act.sa_flags = SA_SIGINFO;
-	act.sa_restorer = 0;
-	
+	act.sa_flags = SA_SIGINFO | SA_RESTART;
+
 	sigaction(SIGPROF, &act, 0);
 	signal(SIGINT, &HandleSIGUSR1);
-	
-	// Enable the profile timer
-	itimerval itv;
-	itv.it_interval.tv_sec = 0;
-	itv.it_interval.tv_usec = 10000; // 100 hz
-	itv.it_value = itv.it_interval;
-	
-	setitimer(ITIMER_PROF, &itv, 0);
+
+	// Start the flusher with every signal blocked, so it is never sampled and
+	// never runs a signal handler of the application
+	sigset_t oldmask;
+	pthread_sigmask(SIG_SETMASK, &mask, &oldmask);
+	_running = 1;
+	if (pthread_create(&_flusher, 0, &Flusher, 0) != 0)
+	{
+		pthread_sigmask(SIG_SETMASK, &oldmask, 0);
+		Log("Failed to start the flusher thread");
+		_running = 0;
+		close(_dumpfile);
+		_dumpfile = -1;
+		return false;
+	}
+	pthread_sigmask(SIG_SETMASK, &oldmask, 0);
+
+	_sampling = 1;
+	StartTimers();
+	return true;
 }
 
 bool Aprof::End()
 {
-    __android_log_print(ANDROID_LOG_INFO, "Aprof", "Aprof shutting down");
-	// Disable the profile timer
-	itimerval itv;
-	itv.it_interval.tv_sec = 0;
-	itv.it_interval.tv_usec = 0;
-	itv.it_value = itv.it_interval;
-	
-	setitimer(ITIMER_PROF, &itv, 0);
-	
+	Log("Aprof shutting down");
+
 	// Close the session
-	if (_dumpfile >= 0)
+	if (_dumpfile < 0)
 	{
-		if (_bufferpos > 0)
-		{
-			write(_dumpfile, _buffer, _bufferpos * sizeof(unsigned long));
-		}
-		// Write samplecount
-		lseek(_dumpfile, _samplecountoffset, SEEK_SET);
-		write(_dumpfile, &_samplecount, sizeof(_samplecount));
-		lseek(_dumpfile, 0, SEEK_END);
-		
-		// Dump maps info
-		write(_dumpfile, "MAPSDATA", 8);
-		uint64_t zero = 0;
-		write(_dumpfile, &zero, sizeof(zero)); // placeholder -- may need to put string length here eventually
-		int mapsfd = open("/proc/self/maps", O_RDONLY);
-		char cpybuf[64];
-		int n = read(mapsfd, cpybuf, sizeof(cpybuf));
-		while (n > 0)
-		{
-			write(_dumpfile, cpybuf, n);
-			n = read(mapsfd, cpybuf, sizeof(cpybuf));
-		}
-		close(mapsfd);
-		
-		close(_dumpfile);
-		_dumpfile = -1;
+		return false;
+	}
+
+	// Stop the flusher and the timers, then drain whatever hasn't been written yet
+	_sampling = 0;
+	__sync_synchronize();
+	while (_inhandler)
+	{
+		// A handler that saw _sampling set is still writing its sample
+		timespec ts;
+		ts.tv_sec = 0;
+		ts.tv_nsec = 100000;
+		nanosleep(&ts, 0);
+	}
+	_running = 0;
+	pthread_join(_flusher, 0);
+	StopTimers();
+	Flush();
+
+	WriteInfo(true);
+	WriteMaps();
+
+	close(_dumpfile);
+	_dumpfile = -1;
+	return true;
+}
+
+bool Aprof::AllocateRings(uint32_t words)
+{
+	_ringcapacity = words;
+	if (words <= _ringwords)
+	{
+		return true;
+	}
+	// Round up to a power of two so positions can be masked. Pages are only
+	// committed once a thread's samples touch them.
+	uint32_t size = 1;
+	while (size < words)
+	{
+		size <<= 1;
+	}
+	void* memory = mmap(0, MAX_THREADS * size * sizeof(void*), PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+	if (memory == MAP_FAILED)
+	{
+		return false;
+	}
+	// No handler can be using the old rings: End() has waited for them all
+	if (_ringmemory)
+	{
+		munmap(_ringmemory, MAX_THREADS * _ringwords * sizeof(void*));
 	}
-	_bufferpos = 0;
+	_ringmemory = reinterpret_cast<void**>(memory);
+	_ringwords = size;
+	return true;
+}
+
+Aprof::Ring* Aprof::FindRing(int32_t tid)
+{
+	// Open addressing on the thread id. A slot is claimed by the first thread
+	// that hashes to it and belongs to that thread id until the flusher sees
+	// the thread has exited. Slots before a thread's own may be freed in the
+	// meantime, so look for its slot all the way before claiming a free one.
+	for (int i = 0; i < MAX_THREADS; ++i)
+	{
+		Ring* ring = &_rings[(tid + i) % MAX_THREADS];
+		if (ring->tid == tid)
+		{
+			return ring;
+		}
+	}
+	for (int i = 0; i < MAX_THREADS; ++i)
+	{
+		Ring* ring = &_rings[(tid + i) % MAX_THREADS];
+		if (ring->tid == 0 && __sync_bool_compare_and_swap(&ring->tid, 0, tid))
+		{
+			return ring;
+		}
+	}
+	return 0;
 }
 
 void Aprof::Handler(int signo, siginfo_t* info, void* context)
 {
-	pthread_mutex_lock(&_mutex);
-	ucontext_t* uc = reinterpret_cast<ucontext_t*>(context);
-	_buffer[_bufferpos++] = reinterpret_cast<void*>(uc->uc_mcontext.arm_pc);
-	++_samplecount;
-	if (_bufferpos == BUFFER_SIZE)
+	// Runs on the interrupted thread: no locks, no I/O. Counted in and out so
+	// End() can wait for handlers still using the rings; the count is raised
+	// before _sampling is read, so a handler End() doesn't wait for has
+	// already seen it cleared.
+	__sync_fetch_and_add(&_inhandler, 1);
+	if (_sampling)
+	{
+		Sample(context);
+	}
+	__sync_fetch_and_sub(&_inhandler, 1);
+}
+
+void Aprof::Sample(void* context)
+{
+	void* frames[MAX_STACK_DEPTH + 1];
+	uint32_t n = 1;
+	uintptr_t header = 0;
+	if (_stackdepth)
+	{
+		bool haslr;
+		int depth = CaptureStack(context, frames + 1, _stackdepth, &haslr);
+		header = depth | (haslr ? STACK_LR_FLAG : 0);
+		frames[0] = reinterpret_cast<void*>(header);
+		n = depth + 1;
+	}
+	else
+	{
+		frames[0] = ContextPC(context);
+	}
+
+	int32_t tid = syscall(__NR_gettid);
+	Ring* ring = FindRing(tid);
+	if (!ring || _ringcapacity - (ring->head - ring->tail) < n)
+	{
+		// Out of slots, or the flusher has fallen behind
+		__sync_fetch_and_add(&_droppedcount, 1);
+		return;
+	}
+	uint32_t head = ring->head;
+	for (uint32_t i = 0; i < n; ++i)
+	{
+		ring->words[(head + i) & (_ringwords - 1)] = frames[i];
+	}
+	// Publish the sample before the new head
+	__sync_synchronize();
+	ring->head = head + n;
+}
+
+void Aprof::StartTimers()
+{
+	if (_clockmode == PROCESS_CPU)
+	{
+		// One process-wide timer; the kernel picks the thread to signal
+		itimerval itv;
+		itv.it_interval.tv_sec = 1 / _frequency;
+		itv.it_interval.tv_usec = 1000000 / _frequency % 1000000;
+		itv.it_value = itv.it_interval;
+
+		setitimer(ITIMER_PROF, &itv, 0);
+	}
+	// The per-thread timers are created by the flusher as it finds threads
+}
+
+void Aprof::StopTimers()
+{
+	if (_clockmode == PROCESS_CPU)
+	{
+		itimerval itv;
+		itv.it_interval.tv_sec = 0;
+		itv.it_interval.tv_usec = 0;
+		itv.it_value = itv.it_interval;
+
+		setitimer(ITIMER_PROF, &itv, 0);
+		return;
+	}
+	for (int i = 0; i < MAX_THREADS; ++i)
+	{
+		if (_timers[i].tid)
+		{
+			timer_delete(_timers[i].timer);
+			_timers[i].tid = 0;
+		}
+	}
+}
+
+void Aprof::UpdateThreadTimers()
+{
+	// Give every thread of the process a timer that signals that thread, and
+	// delete the timers of threads that have exited
+	DIR* dir = opendir("/proc/self/task");
+	if (!dir)
+	{
+		return;
+	}
+	for (int i = 0; i < MAX_THREADS; ++i)
+	{
+		_timers[i].alive = false;
+	}
+	while (dirent* entry = readdir(dir))
+	{
+		int32_t tid = atoi(entry->d_name);
+		if (tid <= 0 || tid == _flushertid)
+		{
+			continue;
+		}
+		ThreadTimer* free = 0;
+		ThreadTimer* found = 0;
+		for (int i = 0; i < MAX_THREADS && !found; ++i)
+		{
+			if (_timers[i].tid == tid)
+			{
+				found = &_timers[i];
+			}
+			else if (_timers[i].tid == 0 && !free)
+			{
+				free = &_timers[i];
+			}
+		}
+		if (found)
+		{
+			found->alive = true;
+			continue;
+		}
+		if (!free)
+		{
+			// Out of timer slots; the thread goes unsampled
+			continue;
+		}
+		sigevent sev;
+		memset(&sev, 0, sizeof(sev));
+		sev.sigev_notify = SIGEV_THREAD_ID;
+		sev.sigev_signo = SIGPROF;
+		sev.sigev_notify_thread_id = tid;
+		clockid_t clock = _clockmode == THREAD_CPU ? ThreadCPUClock(tid) : CLOCK_MONOTONIC;
+		if (timer_create(clock, &sev, &free->timer) != 0)
+		{
+			// Most likely the thread exited since the directory was read
+			continue;
+		}
+		itimerspec its;
+		its.it_interval.tv_sec = 1 / _frequency;
+		its.it_interval.tv_nsec = 1000000000L / _frequency % 1000000000L;
+		its.it_value = its.it_interval;
+		timer_settime(free->timer, 0, &its, 0);
+		free->tid = tid;
+		free->alive = true;
+	}
+	closedir(dir);
+	for (int i = 0; i < MAX_THREADS; ++i)
+	{
+		if (_timers[i].tid && !_timers[i].alive)
+		{
+			timer_delete(_timers[i].timer);
+			_timers[i].tid = 0;
+		}
+	}
+}
+
+void* Aprof::Flusher(void* arg)
+{
+	_flushertid = syscall(__NR_gettid);
+	while (_running)
 	{
-		write(_dumpfile, _buffer, BUFFER_SIZE * sizeof(uc->uc_mcontext.arm_pc));
-		_bufferpos = 0;
+		if (_clockmode != PROCESS_CPU)
+		{
+			UpdateThreadTimers();
+		}
+		timespec ts;
+		ts.tv_sec = 0;
+		ts.tv_nsec = FLUSH_INTERVAL_MS * 1000000L;
+		nanosleep(&ts, 0);
+		Flush();
 	}
-	pthread_mutex_unlock(&_mutex);
+	return 0;
+}
+
+void Aprof::WriteChunkHeader(const char* id, uint64_t length)
+{
+	WriteAll(_dumpfile, id, 4);
+	WriteAll(_dumpfile, &length, sizeof(length));
+}
+
+void Aprof::Flush()
+{
+	// Write one SAMP (or, in stack mode, STAK) chunk for each ring with pending
+	// samples, and free the rings of threads that have exited
+	pid_t pid = getpid();
+	for (int i = 0; i < MAX_THREADS; ++i)
+	{
+		Ring* ring = &_rings[i];
+		int32_t tid = ring->tid;
+		if (tid == 0)
+		{
+			continue;
+		}
+		// Checked before reading the head, so an exited thread's last samples
+		// are all visible and it can't add any after this flush
+		bool exited = syscall(__NR_tgkill, pid, tid, 0) != 0 && errno == ESRCH;
+		uint32_t head = ring->head;
+		// Read the samples only after seeing the head that published them
+		__sync_synchronize();
+		uint32_t tail = ring->tail;
+		uint32_t n = head - tail;
+		if (n == 0)
+		{
+			if (exited)
+			{
+				__sync_bool_compare_and_swap(&ring->tid, tid, 0);
+			}
+			continue;
+		}
+		uint32_t mask = _ringwords - 1;
+
+		// Stack records vary in length, so count them
+		uint32_t nsamples = n;
+		if (_stackdepth)
+		{
+			nsamples = 0;
+			for (uint32_t pos = tail; pos != head; ++nsamples)
+			{
+				pos += 1 + (reinterpret_cast<uintptr_t>(ring->words[pos & mask]) & STACK_COUNT_MASK);
+			}
+		}
+
+		WriteChunkHeader(_stackdepth ? "STAK" : "SAMP", 12 + n * sizeof(void*));
+		uint32_t threadid = tid;
+		uint8_t codec[4] = { 0, 0, 0, 0 }; // raw words, then padding
+		WriteAll(_dumpfile, &threadid, sizeof(threadid));
+		WriteAll(_dumpfile, codec, sizeof(codec));
+		WriteAll(_dumpfile, &nsamples, sizeof(nsamples));
+		uint32_t first = tail & mask;
+		uint32_t contiguous = _ringwords - first < n ? _ringwords - first : n;
+		WriteAll(_dumpfile, &ring->words[first], contiguous * sizeof(void*));
+		WriteAll(_dumpfile, &ring->words[0], (n - contiguous) * sizeof(void*));
+
+		// Hand the slots back to the handler only after they have been written
+		__sync_synchronize();
+		ring->tail = tail + n;
+		_samplecount += nsamples;
+		if (exited)
+		{
+			// The ring is empty, so the next thread to claim it starts clean
+			__sync_bool_compare_and_swap(&ring->tid, tid, 0);
+		}
+	}
+}
+
+void Aprof::WriteInfo(bool final)
+{
+	// The configuration goes at the start of the file, the totals at the end
+	char info[256];
+	int n;
+	if (final)
+	{
+		n = snprintf(info, sizeof(info), "samples=%llu\ndropped=%u\n",
+			static_cast<unsigned long long>(_samplecount), _droppedcount);
+	}
+	else
+	{
+		n = snprintf(info, sizeof(info), "clock=%s\nfrequency=%d\nstackdepth=%d\n", ClockModeName(_clockmode), _frequency, _stackdepth);
+	}
+	WriteChunkHeader("INFO", n);
+	WriteAll(_dumpfile, info, n);
+}
+
+void Aprof::WriteMaps()
+{
+	// The length of /proc/self/maps isn't known until it has been read, so
+	// write a placeholder and patch it afterwards
+	off_t header = lseek(_dumpfile, 0, SEEK_CUR);
+	WriteChunkHeader("MAPS", 0);
+	uint64_t length = 0;
+	int mapsfd = open("/proc/self/maps", O_RDONLY);
+	char cpybuf[4096];
+	int n = read(mapsfd, cpybuf, sizeof(cpybuf));
+	while (n > 0)
+	{
+		WriteAll(_dumpfile, cpybuf, n);
+		length += n;
+		n = read(mapsfd, cpybuf, sizeof(cpybuf));
+	}
+	close(mapsfd);
+	lseek(_dumpfile, header + 4, SEEK_SET);
+	WriteAll(_dumpfile, &length, sizeof(length));
+	lseek(_dumpfile, 0, SEEK_END);
 }
 
 void Aprof::HandleSIGUSR1(int signo)
@@ -150,4 +731,4 @@ void Aprof::HandleSIGUSR1(int signo)
 
 Aprof GlobalProfiler;
 
-}
\ No newline at end of file
+}
@@ -1,8 +1,10 @@
 #ifndef GUM_Aprof_h
 #define GUM_Aprof_h
 
+#include <stdint.h>
 #include <pthread.h>
 #include <signal.h>
+#include <time.h>
 
 namespace GUM {
 
@@ -12,24 +14,95 @@ public:
 	Aprof();
 	~Aprof();
 
-	static bool Begin(const char* outfilename);
+	// What the sampling frequency counts
+	enum ClockMode
+	{
+		PROCESS_CPU, // CPU time of the whole process, delivered to whichever thread is running
+		THREAD_CPU, // CPU time of each thread, on a timer of its own
+		WALL_CLOCK, // elapsed time, on a timer for each thread, so blocked threads are sampled too
+	};
+	static const int DEFAULT_FREQUENCY = 100;
+	// Deepest stack recorded in stack-sampling mode
+	static const int MAX_STACK_DEPTH = 128;
+
+	// A stackdepth above 0 records up to that many frames per sample (the PC,
+	// the link register and the return addresses found by walking the frame
+	// pointers) instead of the PC alone
+	static bool Begin(const char* outfilename, int frequency = DEFAULT_FREQUENCY, ClockMode clockmode = PROCESS_CPU, int stackdepth = 0);
 	static bool End();
-	
+
 private:
 	static void Handler(int signo, siginfo_t* info, void* context);
+	static void Sample(void* context);
 	static void HandleSIGUSR1(int signo);
+	static void* Flusher(void* arg);
+	struct Ring;
+	static Ring* FindRing(int32_t tid);
+	static bool AllocateRings(uint32_t words);
+	static void Flush();
+	static void WriteChunkHeader(const char* id, uint64_t length);
+	static void WriteInfo(bool final);
+	static void StartTimers();
+	static void StopTimers();
+	static void UpdateThreadTimers();
+	static void WriteMaps();
+
+	// Samples are recorded into a per-thread ring buffer. The signal handler
+	// only ever touches the ring of the thread it interrupted, so each ring has
+	// a single producer (that thread) and a single consumer (the flusher thread)
+	// and needs no lock. A ring is freed once its thread has exited and its
+	// samples are flushed, so MAX_THREADS bounds live threads, not all threads.
+	static const int MAX_THREADS = 256;
+	// Ring capacity in samples; in stack mode, each sample takes a word for
+	// its frame count plus one per frame
+	static const uint32_t RING_SIZE = 1024;
+	static const uint32_t STACK_RING_SIZE = 256;
+	struct Ring
+	{
+		volatile int32_t tid; // 0 while the slot is free
+		volatile uint32_t head; // next word to write, only advanced by the handler
+		volatile uint32_t tail; // next word to flush, only advanced by the flusher
+		void** words;
+	};
+	static Ring _rings[MAX_THREADS];
+	// Ring storage, replaced when a session needs bigger rings. That is safe
+	// because End() waits for running handlers (_inhandler) to finish.
+	static void** _ringmemory;
+	static uint32_t _ringwords; // words per ring, a power of two
+	static uint32_t _ringcapacity; // words per ring for this session
+
+	// Set in stack records when the second frame is the link register, which
+	// may belong to the same function as the PC
+	static const uintptr_t STACK_LR_FLAG = 1 << 16;
+	static const uintptr_t STACK_COUNT_MASK = 0xffff;
+
+	// Milliseconds between flushes of the rings to the file
+	static const int FLUSH_INTERVAL_MS = 50;
+
+	// Per-thread timers, only touched by the flusher thread while it runs
+	struct ThreadTimer
+	{
+		int32_t tid; // 0 while the slot is free
+		timer_t timer;
+		bool alive;
+	};
+	static ThreadTimer _timers[MAX_THREADS];
+
+	static int _frequency;
+	static ClockMode _clockmode;
+	static int _stackdepth;
+	static volatile int _sampling;
+	static volatile int _inhandler; // handlers running right now
+	static int32_t _flushertid;
 
 	static int _dumpfile;
-	static const int BUFFER_SIZE = 1024;
-	static void* _buffer[BUFFER_SIZE];
-	static int _bufferpos;
-	
-	static uint64_t _samplecount;
-	static int _samplecountoffset;
-	
-	static pthread_mutex_t _mutex;
+	static pthread_t _flusher;
+	static volatile int _running;
+
+	static volatile uint64_t _samplecount;
+	static volatile uint32_t _droppedcount;
 };
 
 }
 
-#endif // GUM_Aprof_h
\ No newline at end of file
+#endif // GUM_Aprof_h
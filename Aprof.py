@@ -2,6 +2,9 @@ import sys
 import glob
 
 from Aprof.Profiler import *
+from Aprof.ProfileDiff import *
+from Aprof.ProfileMerge import *
+from Aprof.LiveProfiler import *
 
 # Look for '-s devid' flag
 for i in xrange(1, len(sys.argv) - 1):
@@ -10,9 +13,141 @@ for i in xrange(1, len(sys.argv) - 1):
 		os.environ['ANDROID_SERIAL'] = sys.argv[i + 1]
 		break
 
-localfiles = []
+# Look for '-j jobs' flag
+jobs = 1
+for i in xrange(1, len(sys.argv) - 1):
+	if sys.argv[i] == '-j':
+		jobs = int(sys.argv[i + 1])
+		break
+
+# Look for '--top n' and '--coverage percent' flags, which limit the report to
+# the n hottest symbols and/or those covering the given percentage of the
+# samples (and only resolve source lines for them)
+top = None
+coverage = None
+for i in xrange(1, len(sys.argv) - 1):
+	if sys.argv[i] == '--top':
+		top = int(sys.argv[i + 1])
+	elif sys.argv[i] == '--coverage':
+		coverage = float(sys.argv[i + 1].rstrip('%'))
+if (top is not None and top <= 0) or (coverage is not None and not 0 < coverage <= 100):
+	Fatal('--top must be positive and --coverage between 0 and 100')
+
+# Look for '--folded' flag, which prints collapsed stacks instead of the CSV
+folded = '--folded' in sys.argv[1:-1]
+
+# Look for '--diff' flag, which compares the last two arguments (base and new
+# captures) and exits with status 1 if a symbol's share of the samples grew by
+# more than '--threshold' percentage points with a z score of at least '--z'
+diff = '--diff' in sys.argv[1:-2]
+threshold = DEFAULT_THRESHOLD
+z = DEFAULT_Z
+for i in xrange(1, len(sys.argv) - 1):
+	if sys.argv[i] == '--threshold':
+		threshold = float(sys.argv[i + 1])
+	elif sys.argv[i] == '--z':
+		z = float(sys.argv[i + 1])
+
+# Look for '--lines' flag, which makes '--diff' compare source lines instead of
+# symbols
+lines = '--lines' in sys.argv[1:-1]
+
+# Look for '--merge' flag: every argument after it is a capture (or a glob of
+# captures), and they are reported on together. '--per-capture' adds each
+# capture's own breakdown.
+merge = None
+if '--merge' in sys.argv:
+	i = sys.argv.index('--merge')
+	merge = []
+	for arg in sys.argv[i + 1:]:
+		merge += sorted(glob.glob(arg)) or [arg]
+	sys.argv = sys.argv[:i] + ['']
+percapture = '--per-capture' in sys.argv[1:-1]
+
+# Look for '--window length' flag, which reports the top symbols of each window
+# of that length (like '5s' or '250ms') every '--step' (by default, the length)
+# between '--from' and '--to' (by default, the whole capture)
+window = None
+step = None
+start = 0.0
+end = None
 for i in xrange(1, len(sys.argv) - 1):
-	localfiles += glob.glob(sys.argv[i])
-p = Profiler(localfiles, sys.argv[-1])
-p.dump_csv(sys.stdout)
-p.close()
\ No newline at end of file
+	if sys.argv[i] == '--window':
+		window = ParseDuration(sys.argv[i + 1])
+	elif sys.argv[i] == '--step':
+		step = ParseDuration(sys.argv[i + 1])
+	elif sys.argv[i] == '--from':
+		start = ParseDuration(sys.argv[i + 1])
+	elif sys.argv[i] == '--to':
+		end = ParseDuration(sys.argv[i + 1])
+if window is not None:
+	if step is None:
+		step = window
+	if window <= 0 or step <= 0:
+		Fatal('--window and --step must be positive')
+
+# Look for '--live pid' flag: the last argument is then the path of a capture
+# still being written on the device by that process, and the top symbols are
+# shown every '--refresh' seconds until it ends
+live = None
+refresh = DEFAULT_REFRESH
+for i in xrange(1, len(sys.argv) - 1):
+	if sys.argv[i] == '--live':
+		live = int(sys.argv[i + 1])
+	elif sys.argv[i] == '--refresh':
+		refresh = float(sys.argv[i + 1])
+
+# Look for '--stats' flag, which reports phase times and counters on stderr
+stats = '--stats' in sys.argv[1:-1]
+
+# Look for '--base-files glob' flags, the base build's local files for
+# '--diff' (by default, the same files as the new build). Libraries the base
+# build has no local file for are pulled from the device, so pass them when
+# the device now runs the new build.
+basefiles = None
+baseargs = []
+for i in xrange(1, len(sys.argv) - 1):
+	if sys.argv[i] == '--base-files':
+		basefiles = (basefiles or []) + glob.glob(sys.argv[i + 1])
+		baseargs.append(i + 1)
+
+localfiles = []
+for i in xrange(1, len(sys.argv) - (2 if diff else 1)):
+	if i not in baseargs:
+		localfiles += glob.glob(sys.argv[i])
+if diff:
+	p = ProfileDiff(localfiles, sys.argv[-2], sys.argv[-1], jobs, basefiles)
+	p.dump_csv(sys.stdout, lines)
+	regressions = p.get_regressions(threshold, z, lines)
+	for (key, basecount, newcount, delta, score) in regressions:
+		where = ' '.join([key[0], p.demangle(key[1])] + list(key[2:]))
+		print >> sys.stderr, 'REGRESSION: %s: %+0.2f%% of samples (z %0.1f)' % (where, delta, score)
+	p.close()
+	if stats:
+		Stats.Dump(sys.stderr, p.stats)
+	sys.exit(1 if regressions else 0)
+if live is not None:
+	p = LiveProfiler(localfiles, sys.argv[-1], live, jobs)
+	p.run(sys.stdout, refresh, top or DEFAULT_LIVE_TOP)
+	p.close()
+	if stats:
+		Stats.Dump(sys.stderr, p.stats)
+	sys.exit(0)
+if merge is not None:
+	if not merge:
+		Fatal('--merge needs at least one capture')
+	p = ProfileMerge(localfiles, merge, jobs, None, top, coverage)
+else:
+	p = Profiler(localfiles, sys.argv[-1], jobs, None, top, coverage)
+if window is not None:
+	p.dump_windows(sys.stdout, window, step, start, end, top or DEFAULT_WINDOW_TOP)
+elif folded:
+	p.dump_folded(sys.stdout)
+else:
+	p.dump_csv(sys.stdout)
+	if percapture and merge is not None:
+		print
+		p.dump_captures(sys.stdout)
+p.close()
+if stats:
+	Stats.Dump(sys.stderr, p.stats)
\ No newline at end of file
@@ -0,0 +1,52 @@
+import os
+import subprocess
+
+import Stats
+from Message import *
+
+class AdbShell:
+	# One 'adb shell' session that runs any number of device commands, instead
+	# of an adb process (and a device-side shell) per command. Each command's
+	# output is delimited by a marker line carrying its exit status.
+	def __init__(self):
+		Stats.Count('spawn.adb')
+		self._devnull = open(os.devnull, 'w')
+		try:
+			self._process = subprocess.Popen(['adb', 'shell'], stdin=subprocess.PIPE,
+				stdout=subprocess.PIPE, stderr=self._devnull)
+		except OSError:
+			Fatal('could not run adb (make sure it is on the PATH)')
+		self._count = 0
+
+	def run(self, command):
+		# Returns (output, status). The command's stderr is discarded.
+		self._count += 1
+		marker = '__APROF_%d_%d__' % (os.getpid(), self._count)
+		Stats.Count('roundtrips.adb')
+		# The empty echo ends an unterminated last line of output, so the
+		# marker always starts a line of its own
+		self._process.stdin.write('%s 2>/dev/null; s=$?; echo; echo "%s $s"\n' % (command, marker))
+		self._process.stdin.flush()
+		lines = []
+		while True:
+			line = self._process.stdout.readline()
+			if not line:
+				Fatal('adb shell session ended unexpectedly (make sure the device is connected)')
+			line = line.rstrip('\r\n')
+			if line.startswith(marker):
+				status = int(line[len(marker):].strip() or 0)
+				break
+			lines.append(line + '\n')
+		# Drop the newline the empty echo added
+		output = ''.join(lines)[:-1]
+		return (output, status)
+
+	def close(self):
+		if self._process.poll() is None:
+			try:
+				self._process.stdin.write('exit\n')
+				self._process.stdin.close()
+			except IOError:
+				pass
+			self._process.wait()
+		self._devnull.close()
@@ -0,0 +1,57 @@
+import bisect
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+class AddressMap:
+	# Sorted index of non-overlapping [begin, end) address ranges. Each range maps
+	# to the object that owns it and the "tweak" that converts an address inside
+	# it to a VMA. Lookups are O(log n) in the number of ranges.
+	def __init__(self):
+		self._ranges = []
+		self._begins = None
+		self._ends = None
+
+	def add(self, begin, end, owner, tweak):
+		self._ranges.append((begin, end, owner, tweak))
+		self._begins = None
+
+	def build(self):
+		self._ranges.sort(key=lambda r: r[0])
+		self._begins = [r[0] for r in self._ranges]
+		self._ends = [r[1] for r in self._ranges]
+
+	def lookup(self, addr):
+		# Returns (owner, (begin, end), tweak), or None if addr isn't mapped
+		if self._begins is None:
+			self.build()
+		i = bisect.bisect_right(self._begins, addr) - 1
+		if i < 0 or addr >= self._ends[i]:
+			return None
+		(begin, end, owner, tweak) = self._ranges[i]
+		return (owner, (begin, end), tweak)
+
+	def lookup_many(self, addrs):
+		# Batch version of lookup. Returns a list with one entry per address.
+		if self._begins is None:
+			self.build()
+		if numpy is None or len(self._ranges) == 0:
+			return [self.lookup(addr) for addr in addrs]
+		addrs = numpy.asarray(addrs, dtype=numpy.uint64)
+		idx = numpy.searchsorted(numpy.asarray(self._begins, dtype=numpy.uint64), addrs, side='right') - 1
+		inside = (idx >= 0) & (addrs < numpy.asarray(self._ends, dtype=numpy.uint64)[numpy.maximum(idx, 0)])
+		result = []
+		for (i, ok) in zip(idx.tolist(), inside.tolist()):
+			if not ok:
+				result.append(None)
+				continue
+			(begin, end, owner, tweak) = self._ranges[i]
+			result.append((owner, (begin, end), tweak))
+		return result
+
+	def get_ranges(self):
+		if self._begins is None:
+			self.build()
+		return list(self._ranges)
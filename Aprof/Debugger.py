@@ -1,92 +1,159 @@
 import subprocess
+import hashlib
 import re
 import os
-import tempfile
+from multiprocessing.pool import ThreadPool
 
 from Module import *
 from ModCache import *
+from AdbShell import *
+from Profiler import ParseMaps
 from Message import *
+import Stats
 
-def GetPID(appname):
-	args = ['adb', 'shell', 'ps']
-	p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	(outdata, errdata) = p.communicate()
+# Number of modules prepared concurrently
+DEFAULT_PREPARE_JOBS = 4
+
+def GetPID(shell, appname):
+	# pidof is much cheaper than listing every process, but older devices
+	# don't have it
+	(outdata, status) = shell.run('pidof %s' % appname)
+	fields = outdata.split()
+	if status == 0 and fields and fields[0].isdigit():
+		return int(fields[0])
+	(outdata, status) = shell.run('ps')
 	ws = re.compile('\s+')
 	for fields in map(ws.split, outdata.split('\n')):
-		if len(fields) >= 9 and appname == fields[8]:
+		# The name is the last column, wherever the device's ps puts it
+		if len(fields) >= 9 and appname == fields[-1]:
 			return int(fields[1])
 	return -1
 
-def GetMaps(pid):
-	args = ['adb', 'shell', 'su', '-c', 'cat', '/proc/%d/maps' % pid]
-	p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	(outdata, errdata) = p.communicate()
+def GetMaps(shell, pid):
+	(outdata, status) = shell.run('su -c cat /proc/%d/maps' % pid)
 	return outdata
-	
+
+def PrepareModule(job):
+	# ThreadPool entry point: the module, or None when the library has no
+	# debug info worth giving to gdb
+	(modpath, mappings, modcache) = job
+	localpath = modcache.get(modpath)
+	if not localpath:
+		return None
+	try:
+		elf = ElfFile(localpath)
+	except ElfError:
+		return None
+	debug = elf.has_debug_info()
+	elf.close()
+	if not debug:
+		return None
+	mod = Module(modpath, modcache)
+	for (begin, end, offset, perm) in mappings:
+		mod.add_map(begin, end, offset, perm)
+	return mod
+
 class Debugger:
-	def __init__(self, localfiles, appname):
+	# Attaches gdb to a running app with symbols for its libraries. Device
+	# commands share one adb shell session, and the generated gdb command file
+	# is cached under the hash of the process's maps, so attaching again to the
+	# same process needs no module preparation.
+	def __init__(self, localfiles, appname, jobs=DEFAULT_PREPARE_JOBS):
 		self._appname = appname
 		self._gdbserver_process = None
-		self._tmpcommandfile = None
-		self._pid = GetPID(self._appname)
+		self._jobs = jobs
+		self._shell = AdbShell()
+		self._pid = GetPID(self._shell, self._appname)
 		if self._pid < 0:
+			self._shell.close()
 			raise Exception('No such process')
 		self._modules = {}
 		self._modcache = ModCache(localfiles)
-		self._pull_modules()
-		# Generate the add-symbol-file commands
-		(fd, self._tmpcommandfile) = tempfile.mkstemp()
-		os.close(fd)
-		cmdfile = open(self._tmpcommandfile, 'w')
-		for (modname, mod) in self._modules.items():
-			localpath = self._modcache.get(modname)
-			base = mod.get_base()
-			offset = mod.textoffset
-			if base is not None and offset is not None:
-				print >> cmdfile, 'add-symbol-file %s 0x%x' % (localpath.replace('\\', '/'), base + offset)
-		print >> cmdfile, 'target remote :9999'
-		cmdfile.close()
+		maps = GetMaps(self._shell, self._pid)
+		self._shell.close()
+		self._commandfile = self._get_commandfile(maps, localfiles)
 		# Run gdbserver
 		self._run_gdbserver()
 		# Launch gdb, passing it the cmdfile
-		args = ['cmd', '/C', 'start', '/WAIT', 'arm-linux-androideabi-gdb', '-x', self._tmpcommandfile]
+		args = ['cmd', '/C', 'start', '/WAIT', 'arm-linux-androideabi-gdb', '-x', self._commandfile]
 		self._gdb_process = subprocess.Popen(args)
 		self._gdb_process.wait()
-		
+
 	def close(self):
 		if self._gdbserver_process is not None:
 			self._gdbserver_process.wait()
-		if self._tmpcommandfile is not None:
-			os.unlink(self._tmpcommandfile)
-	
+		self._modcache.close()
+
+	def _get_commandfile(self, maps, localfiles):
+		# The local overrides are part of the key, as they change which files
+		# the commands point at
+		key = hashlib.sha1(maps + '\0' + '\0'.join(localfiles)).hexdigest()
+		cachedir = os.path.join(self._modcache.get_cachepath(), 'gdb')
+		if not os.path.isdir(cachedir):
+			os.makedirs(cachedir)
+		commandfile = os.path.join(cachedir, key + '.gdb')
+		if self._is_current(commandfile):
+			Stats.Count('gdbcache.hit')
+			Verbose('reusing gdb commands %s' % commandfile)
+			return commandfile
+		Stats.Count('gdbcache.miss')
+		self._prepare_modules(maps)
+		# Generate the add-symbol-file commands, writing to a temporary name
+		# so an interrupted run never leaves a partial file behind
+		cmdfile = open(commandfile + '.part', 'w')
+		for (modname, mod) in sorted(self._modules.items()):
+			localpath = self._modcache.get(modname)
+			base = mod.get_base()
+			offset = mod.textoffset
+			if base is not None and offset is not None:
+				print >> cmdfile, 'add-symbol-file %s 0x%x' % (localpath.replace('\\', '/'), base + offset)
+		print >> cmdfile, 'target remote :9999'
+		cmdfile.close()
+		if os.path.exists(commandfile):
+			os.remove(commandfile)
+		os.rename(commandfile + '.part', commandfile)
+		return commandfile
+
+	def _is_current(self, commandfile):
+		# A cached command file is usable while every file it names still exists
+		if not os.path.isfile(commandfile):
+			return False
+		f = open(commandfile)
+		lines = f.read().split('\n')
+		f.close()
+		for l in lines:
+			if l.startswith('add-symbol-file '):
+				localpath = l.split(' ')[1]
+				if not os.path.isfile(localpath):
+					return False
+		return True
+
 	def _run_gdbserver(self):
 		# Ensure the port is forwarded
 		os.system('adb forward tcp:9999 tcp:9999')
-		# Run gdbserver
+		# Run gdbserver. It lives as long as the debugging session, so it gets
+		# its own adb process rather than the shared shell.
 		args = ['adb', 'shell', 'su', '-c', '/data/tmp/gdbserver', '--attach', 'localhost:9999', '%d' % self._pid]
 		self._gdbserver_process = subprocess.Popen(args, stdin=subprocess.PIPE)
-	
-	# Pull the modules from the device
-	def _pull_modules(self):
-		# Get process maps
-		maps = GetMaps(self._pid)
-		# Parse the maps
-		mapre = re.compile(r'([0-9a-fA-F]+)-([0-9a-fA-F]+)\s+(....)\s+([0-9a-fA-F]+)\s+\S+\s+\S+\s+(.+)')
-		for ml in maps.split('\n'):
-			mat = mapre.match(ml.strip())
-			if mat:
-				begin = long(mat.group(1), 16)
-				end = long(mat.group(2), 16)
-				perm = mat.group(3)
-				offset = long(mat.group(4), 16)
-				modpath = mat.group(5)
-				# Exclude unacceptable modules
-				if perm[2] != 'x':
-					continue
-				if modpath[:5] == '/dev/':
-					continue
-				if modpath == '[vectors]':
-					continue
-				if modpath not in self._modules:
-					self._modules[modpath] = Module(modpath, self._modcache)
-				self._modules[modpath].add_map(begin, end, offset, perm)
+
+	# Pull the modules from the device and load those with debug info
+	def _prepare_modules(self, maps):
+		modmaps = {}
+		for (begin, end, offset, perm, modpath) in ParseMaps(maps):
+			modmaps.setdefault(modpath, []).append((begin, end, offset, perm))
+		if not modmaps:
+			return
+		# Pull everything up front, concurrently
+		self._modcache.prefetch(modmaps.keys())
+		jobs = [(modpath, mappings, self._modcache) for (modpath, mappings) in modmaps.items()]
+		pool = ThreadPool(min(self._jobs, len(jobs)))
+		try:
+			modules = pool.map(PrepareModule, jobs)
+		finally:
+			pool.close()
+			pool.join()
+		for ((modpath, mappings, modcache), mod) in zip(jobs, modules):
+			if mod is None:
+				Verbose('skipping %s (no debug info)' % modpath)
+				continue
+			self._modules[modpath] = mod
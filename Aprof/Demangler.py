@@ -1,16 +1,31 @@
 import subprocess
 
+from Pipe import *
+import Stats
+
 class Demangler:
 	def __init__(self):
 		args = ['arm-linux-androideabi-c++filt']
+		Stats.Count('spawn.c++filt')
 		self._demangler = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 		
 	def demangle(self, sym):
 		if not self._demangler:
 			return sym
+		Stats.Count('roundtrips.c++filt')
+		Stats.Count('queries.c++filt')
 		self._demangler.stdin.write('%s\n' % sym)
 		return self._demangler.stdout.readline().strip()
 		
+	def demangle_many(self, syms):
+		if not self._demangler:
+			return list(syms)
+		if syms:
+			# Transact pipelines the whole batch: one round trip
+			Stats.Count('roundtrips.c++filt')
+			Stats.Count('queries.c++filt', len(syms))
+		return Transact(self._demangler, syms)
+		
 	def close(self):
 		self._demangler.stdin.close()
 		self._demangler = None
@@ -0,0 +1,522 @@
+import array
+import bisect
+import marshal
+import re
+import struct
+import zlib
+
+from ElfFile import *
+from SampleData import *
+
+# Line number program opcodes
+DW_LNS_copy = 1
+DW_LNS_advance_pc = 2
+DW_LNS_advance_line = 3
+DW_LNS_set_file = 4
+DW_LNS_set_column = 5
+DW_LNS_negate_stmt = 6
+DW_LNS_set_basic_block = 7
+DW_LNS_const_add_pc = 8
+DW_LNS_fixed_advance_pc = 9
+DW_LNS_set_prologue_end = 10
+DW_LNS_set_epilogue_begin = 11
+DW_LNS_set_isa = 12
+
+DW_LNE_end_sequence = 1
+DW_LNE_set_address = 2
+DW_LNE_define_file = 3
+DW_LNE_set_discriminator = 4
+
+# DWARF 5 line table entry content types
+DW_LNCT_path = 1
+DW_LNCT_directory_index = 2
+
+# Attributes and forms needed to find each unit's compilation directory
+DW_AT_stmt_list = 0x10
+DW_AT_comp_dir = 0x1b
+
+DW_FORM_addr = 0x01
+DW_FORM_block2 = 0x03
+DW_FORM_block4 = 0x04
+DW_FORM_data2 = 0x05
+DW_FORM_data4 = 0x06
+DW_FORM_data8 = 0x07
+DW_FORM_string = 0x08
+DW_FORM_block = 0x09
+DW_FORM_block1 = 0x0a
+DW_FORM_data1 = 0x0b
+DW_FORM_flag = 0x0c
+DW_FORM_sdata = 0x0d
+DW_FORM_strp = 0x0e
+DW_FORM_udata = 0x0f
+DW_FORM_ref_addr = 0x10
+DW_FORM_ref1 = 0x11
+DW_FORM_ref2 = 0x12
+DW_FORM_ref4 = 0x13
+DW_FORM_ref8 = 0x14
+DW_FORM_ref_udata = 0x15
+DW_FORM_indirect = 0x16
+DW_FORM_sec_offset = 0x17
+DW_FORM_exprloc = 0x18
+DW_FORM_flag_present = 0x19
+DW_FORM_implicit_const = 0x21
+DW_FORM_line_strp = 0x1f
+DW_FORM_data16 = 0x1e
+
+# Forms with a fixed size, in bytes
+fixedformsizes = {
+	DW_FORM_data1: 1, DW_FORM_ref1: 1, DW_FORM_flag: 1, 0x25: 1, 0x29: 1,
+	DW_FORM_data2: 2, DW_FORM_ref2: 2, 0x26: 2, 0x2a: 2,
+	0x27: 3, 0x2b: 3,
+	DW_FORM_data4: 4, DW_FORM_ref4: 4, 0x1c: 4, 0x28: 4, 0x2c: 4,
+	DW_FORM_data8: 8, DW_FORM_ref8: 8, 0x20: 8, 0x24: 8,
+	DW_FORM_data16: 16,
+	DW_FORM_flag_present: 0, DW_FORM_implicit_const: 0,
+}
+# Forms encoded as a single LEB128 number
+lebforms = set([DW_FORM_sdata, DW_FORM_udata, DW_FORM_ref_udata, 0x1a, 0x1b, 0x22, 0x23, 0x1f01, 0x1f02])
+# Forms holding a section offset
+offsetforms = set([DW_FORM_strp, DW_FORM_sec_offset, DW_FORM_line_strp, 0x1d, 0x1f20, 0x1f21])
+
+# Absolute paths, including Windows ones from NDK builds on Windows hosts
+abspathre = re.compile(r'^([/\\]|[A-Za-z]:)')
+
+class DwarfError(Exception):
+	pass
+
+def ReadULEB(data, pos):
+	result = 0
+	shift = 0
+	while True:
+		b = data[pos]
+		pos += 1
+		result |= (b & 0x7f) << shift
+		shift += 7
+		if b < 0x80:
+			return (result, pos)
+
+def ReadSLEB(data, pos):
+	result = 0
+	shift = 0
+	while True:
+		b = data[pos]
+		pos += 1
+		result |= (b & 0x7f) << shift
+		shift += 7
+		if b < 0x80:
+			if b & 0x40:
+				result -= 1 << shift
+			return (result, pos)
+
+def ReadCString(data, pos):
+	end = data.index('\0', pos)
+	return (str(data[pos:end]), end + 1)
+
+def JoinPath(dir, name):
+	if not dir or abspathre.match(name):
+		return name
+	if dir.endswith('/') or dir.endswith('\\'):
+		return dir + name
+	return dir + '/' + name
+
+def SectionBytes(elf, name):
+	# Contents of a debug section as a bytearray (decompressed if necessary), or
+	# None if the file doesn't have it
+	sec = elf.get_section(name)
+	if sec is not None:
+		data = elf.section_data(sec)
+		if sec['flags'] & SHF_COMPRESSED:
+			if elf.is64:
+				chdr = struct.Struct(elf.endian + 'IIQQ')
+			else:
+				chdr = struct.Struct(elf.endian + 'III')
+			if struct.unpack_from(elf.endian + 'I', data)[0] != 1:
+				raise DwarfError('%s: unknown compression in %s' % (elf.path, name))
+			data = zlib.decompress(data[chdr.size:])
+		return bytearray(data)
+	sec = elf.get_section('.z' + name[1:])
+	if sec is not None:
+		data = elf.section_data(sec)
+		if data[:4] != 'ZLIB':
+			raise DwarfError('%s: unknown compression in %s' % (elf.path, sec['name']))
+		return bytearray(zlib.decompress(data[12:]))
+	return None
+
+class LineTable:
+	# Address -> (file, line) table decoded from the .debug_line section of an
+	# ELF file. Handles DWARF versions 2 to 5; anything else raises DwarfError.
+	def __init__(self, elf=None):
+		self._files = []
+		self._fileids = {}
+		if elf is None:
+			# Empty table, to be filled by load()
+			self._build([])
+			return
+		self._path = elf.path
+		self._endian = elf.endian
+		self._debug_line = SectionBytes(elf, '.debug_line')
+		self._debug_str = SectionBytes(elf, '.debug_str')
+		self._debug_line_str = SectionBytes(elf, '.debug_line_str')
+		sequences = []
+		if self._debug_line is not None:
+			compdirs = {}
+			try:
+				compdirs = self._read_comp_dirs(elf)
+			except (DwarfError, IndexError, ValueError, struct.error):
+				# Without the compilation directories, relative file names are
+				# reported as they are
+				pass
+			try:
+				offset = 0
+				while offset < len(self._debug_line):
+					offset = self._decode_unit(offset, compdirs.get(offset), sequences)
+			except (IndexError, ValueError, struct.error):
+				raise DwarfError('%s: malformed .debug_line' % self._path)
+		self._debug_line = None
+		self._debug_str = None
+		self._debug_line_str = None
+		self._build(sequences)
+
+	def _build(self, sequences):
+		# Concatenate the sequences in address order. Each row applies up to the
+		# next row; a file id of -1 marks the end of a sequence. Sequences that
+		# overlap an earlier one (code discarded by the linker) are dropped.
+		sequences.sort(key=lambda s: s[0][0])
+		addrs = []
+		files = []
+		lines = []
+		end = 0
+		for seq in sequences:
+			if seq[0][0] < end:
+				continue
+			for (addr, file, line) in seq:
+				addrs.append(addr)
+				files.append(file)
+				lines.append(line)
+			end = seq[-1][0]
+		tc = ArrayTypecode(8)
+		self._addrs = array.array(tc, addrs) if tc else addrs
+		self._filecol = array.array('i', files)
+		self._linecol = array.array('L', lines)
+
+	def dump(self):
+		return marshal.dumps((list(self._addrs), self._filecol.tostring(), self._linecol.tostring(), self._files))
+
+	def load(self, data):
+		(addrs, files, lines, self._files) = marshal.loads(data)
+		tc = ArrayTypecode(8)
+		self._addrs = array.array(tc, addrs) if tc else addrs
+		self._filecol = array.array('i')
+		self._filecol.fromstring(files)
+		self._linecol = array.array('L')
+		self._linecol.fromstring(lines)
+
+	def lookup(self, addr):
+		# Returns 'file:line' for the address, or None
+		i = bisect.bisect_right(self._addrs, addr) - 1
+		if i < 0 or self._filecol[i] < 0 or self._linecol[i] == 0:
+			return None
+		return '%s:%d' % (self._files[self._filecol[i]], self._linecol[i])
+
+	def lookup_many(self, addrs):
+		return [self.lookup(addr) for addr in addrs]
+
+	def _fileid(self, path):
+		if not self._fileids.has_key(path):
+			self._fileids[path] = len(self._files)
+			self._files.append(path)
+		return self._fileids[path]
+
+	def _unsigned(self, data, pos, size):
+		return struct.unpack_from(self._endian + {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}[size], buffer(data), pos)[0]
+
+	def _unit_length(self, data, pos):
+		# Returns (length, offset size, position after the length field)
+		length = self._unsigned(data, pos, 4)
+		if length == 0xffffffff:
+			return (self._unsigned(data, pos + 4, 8), 8, pos + 12)
+		if length >= 0xfffffff0:
+			raise DwarfError('%s: reserved unit length' % self._path)
+		return (length, 4, pos + 4)
+
+	def _string(self, section, offset):
+		if section is None:
+			raise DwarfError('%s: missing string section' % self._path)
+		return ReadCString(section, offset)[0]
+
+	def _decode_unit(self, offset, compdir, sequences):
+		data = self._debug_line
+		(length, offsize, pos) = self._unit_length(data, offset)
+		end = pos + length
+		version = self._unsigned(data, pos, 2)
+		pos += 2
+		if version < 2 or version > 5:
+			raise DwarfError('%s: unsupported .debug_line version %d' % (self._path, version))
+		addrsize = None
+		if version >= 5:
+			addrsize = data[pos]
+			pos += 2
+		headerlength = self._unsigned(data, pos, offsize)
+		pos += offsize
+		program = pos + headerlength
+		mininst = data[pos]
+		pos += 1
+		if version >= 4:
+			if data[pos] != 1:
+				raise DwarfError('%s: VLIW line programs are not supported' % self._path)
+			pos += 1
+		defaultisstmt = data[pos]
+		linebase = data[pos + 1]
+		if linebase >= 0x80:
+			linebase -= 0x100
+		linerange = data[pos + 2]
+		opcodebase = data[pos + 3]
+		pos += 4
+		oplengths = [0] + list(data[pos:pos + opcodebase - 1])
+		pos += opcodebase - 1
+		if linerange == 0:
+			raise DwarfError('%s: zero line_range' % self._path)
+
+		if version >= 5:
+			(dirs, pos) = self._read_entries(data, pos, offsize)
+			dirs = [d[0] for d in dirs]
+			if dirs and compdir is None:
+				compdir = dirs[0]
+			(entries, pos) = self._read_entries(data, pos, offsize)
+			files = []
+			for (name, diridx) in entries:
+				dir = dirs[diridx] if diridx < len(dirs) else ''
+				if diridx != 0:
+					dir = JoinPath(compdir, dir)
+				files.append(self._fileid(JoinPath(dir, name)))
+		else:
+			dirs = [compdir or '']
+			while data[pos] != 0:
+				(name, pos) = ReadCString(data, pos)
+				dirs.append(JoinPath(compdir, name))
+			pos += 1
+			# File numbers start at 1 before DWARF 5
+			files = [-1]
+			while data[pos] != 0:
+				(name, pos) = ReadCString(data, pos)
+				(diridx, pos) = ReadULEB(data, pos)
+				(mtime, pos) = ReadULEB(data, pos)
+				(size, pos) = ReadULEB(data, pos)
+				dir = dirs[diridx] if diridx < len(dirs) else ''
+				files.append(self._fileid(JoinPath(dir, name)))
+
+		# Run the line number program
+		pos = program
+		constaddpc = mininst * ((255 - opcodebase) // linerange)
+		address = 0
+		file = 1
+		line = 1
+		seq = []
+		while pos < end:
+			op = data[pos]
+			pos += 1
+			if op >= opcodebase:
+				adjusted = op - opcodebase
+				address += mininst * (adjusted // linerange)
+				line += linebase + adjusted % linerange
+				seq.append((address, file, line))
+			elif op == DW_LNS_copy:
+				seq.append((address, file, line))
+			elif op == DW_LNS_advance_pc:
+				(adv, pos) = ReadULEB(data, pos)
+				address += mininst * adv
+			elif op == DW_LNS_advance_line:
+				(adv, pos) = ReadSLEB(data, pos)
+				line += adv
+			elif op == DW_LNS_set_file:
+				(file, pos) = ReadULEB(data, pos)
+			elif op == DW_LNS_const_add_pc:
+				address += constaddpc
+			elif op == DW_LNS_fixed_advance_pc:
+				address += self._unsigned(data, pos, 2)
+				pos += 2
+			elif op == 0:
+				(oplen, pos) = ReadULEB(data, pos)
+				next = pos + oplen
+				subop = data[pos]
+				if subop == DW_LNE_end_sequence:
+					seq.append((address, -1, 0))
+					self._add_sequence(seq, files, sequences)
+					seq = []
+					address = 0
+					file = 1
+					line = 1
+				elif subop == DW_LNE_set_address:
+					size = oplen - 1
+					if size not in (4, 8):
+						raise DwarfError('%s: bad DW_LNE_set_address size' % self._path)
+					address = self._unsigned(data, pos + 1, size)
+				elif subop == DW_LNE_define_file:
+					(name, p) = ReadCString(data, pos + 1)
+					(diridx, p) = ReadULEB(data, p)
+					dir = dirs[diridx] if diridx < len(dirs) else ''
+					files.append(self._fileid(JoinPath(dir, name)))
+				pos = next
+			else:
+				# Column, stmt, basic block, prologue/epilogue, ISA, and anything
+				# newer: skip the operands
+				for i in xrange(oplengths[op]):
+					(dummy, pos) = ReadULEB(data, pos)
+		return end
+
+	def _add_sequence(self, seq, files, sequences):
+		# Translate file numbers and drop sequences for discarded code, which
+		# linkers leave at address 0 or at an all-ones tombstone
+		start = seq[0][0]
+		if start == 0 or start in (0xffffffff, 0xfffffffe, 0xffffffffffffffff, 0xfffffffffffffffe):
+			return
+		rows = []
+		for (address, file, line) in seq:
+			if file >= 0:
+				file = files[file] if file < len(files) else -1
+			rows.append((address, file, line))
+		sequences.append(rows)
+
+	def _read_entries(self, data, pos, offsize):
+		# DWARF 5 directory/file table: returns ([(path, dirindex)], pos)
+		nformats = data[pos]
+		pos += 1
+		formats = []
+		for i in xrange(nformats):
+			(ctype, pos) = ReadULEB(data, pos)
+			(form, pos) = ReadULEB(data, pos)
+			formats.append((ctype, form))
+		(count, pos) = ReadULEB(data, pos)
+		entries = []
+		for i in xrange(count):
+			path = ''
+			diridx = 0
+			for (ctype, form) in formats:
+				if form == DW_FORM_string:
+					(value, pos) = ReadCString(data, pos)
+				elif form == DW_FORM_line_strp:
+					value = self._string(self._debug_line_str, self._unsigned(data, pos, offsize))
+					pos += offsize
+				elif form == DW_FORM_strp:
+					value = self._string(self._debug_str, self._unsigned(data, pos, offsize))
+					pos += offsize
+				elif form == DW_FORM_udata:
+					(value, pos) = ReadULEB(data, pos)
+				elif form in (DW_FORM_data1, DW_FORM_data2, DW_FORM_data4, DW_FORM_data8, DW_FORM_data16):
+					size = fixedformsizes[form]
+					value = None
+					if size <= 8:
+						value = self._unsigned(data, pos, size)
+					pos += size
+				elif form == DW_FORM_block:
+					(size, pos) = ReadULEB(data, pos)
+					pos += size
+					value = None
+				else:
+					raise DwarfError('%s: unsupported form 0x%x in line table header' % (self._path, form))
+				if ctype == DW_LNCT_path:
+					path = value
+				elif ctype == DW_LNCT_directory_index:
+					diridx = value
+			entries.append((path, diridx))
+		return (entries, pos)
+
+	def _read_comp_dirs(self, elf):
+		# Map each line program offset to the DW_AT_comp_dir of the unit that
+		# refers to it. Only the first DIE of every unit is decoded.
+		info = SectionBytes(elf, '.debug_info')
+		abbrev = SectionBytes(elf, '.debug_abbrev')
+		compdirs = {}
+		if info is None or abbrev is None:
+			return compdirs
+		abbrevcache = {}
+		offset = 0
+		while offset < len(info):
+			(length, offsize, pos) = self._unit_length(info, offset)
+			unitend = pos + length
+			version = self._unsigned(info, pos, 2)
+			pos += 2
+			if version >= 5:
+				unittype = info[pos]
+				addrsize = info[pos + 1]
+				abbrevoffset = self._unsigned(info, pos + 2, offsize)
+				pos += 2 + offsize
+				if unittype not in (1, 3):
+					offset = unitend
+					continue
+			elif version >= 2:
+				abbrevoffset = self._unsigned(info, pos, offsize)
+				addrsize = info[pos + offsize]
+				pos += offsize + 1
+			else:
+				raise DwarfError('%s: unsupported .debug_info version %d' % (self._path, version))
+			(code, pos) = ReadULEB(info, pos)
+			key = (abbrevoffset, code)
+			if not abbrevcache.has_key(key):
+				abbrevcache[key] = self._read_abbrev(abbrev, abbrevoffset, code)
+			stmtlist = None
+			compdir = None
+			for (attr, form, implicit) in abbrevcache[key]:
+				if form == DW_FORM_indirect:
+					(form, pos) = ReadULEB(info, pos)
+				if attr == DW_AT_stmt_list and form in (DW_FORM_sec_offset, DW_FORM_data4, DW_FORM_data8):
+					size = offsize if form == DW_FORM_sec_offset else fixedformsizes[form]
+					stmtlist = self._unsigned(info, pos, size)
+				elif attr == DW_AT_comp_dir:
+					if form == DW_FORM_string:
+						compdir = ReadCString(info, pos)[0]
+					elif form == DW_FORM_strp:
+						compdir = self._string(self._debug_str, self._unsigned(info, pos, offsize))
+					elif form == DW_FORM_line_strp:
+						compdir = self._string(self._debug_line_str, self._unsigned(info, pos, offsize))
+				pos = self._skip_form(info, pos, form, offsize, addrsize, version)
+			if stmtlist is not None and compdir is not None:
+				compdirs[stmtlist] = compdir
+			offset = unitend
+		return compdirs
+
+	def _read_abbrev(self, abbrev, offset, code):
+		# Returns the [(attr, form, implicit_const)] list of an abbreviation
+		pos = offset
+		while True:
+			(c, pos) = ReadULEB(abbrev, pos)
+			if c == 0:
+				raise DwarfError('%s: abbreviation %d not found' % (self._path, code))
+			(tag, pos) = ReadULEB(abbrev, pos)
+			pos += 1
+			attrs = []
+			while True:
+				(attr, pos) = ReadULEB(abbrev, pos)
+				(form, pos) = ReadULEB(abbrev, pos)
+				implicit = None
+				if form == DW_FORM_implicit_const:
+					(implicit, pos) = ReadSLEB(abbrev, pos)
+				if attr == 0 and form == 0:
+					break
+				attrs.append((attr, form, implicit))
+			if c == code:
+				return attrs
+
+	def _skip_form(self, data, pos, form, offsize, addrsize, version):
+		if fixedformsizes.has_key(form):
+			return pos + fixedformsizes[form]
+		if form in lebforms:
+			return ReadULEB(data, pos)[1]
+		if form in offsetforms:
+			return pos + offsize
+		if form == DW_FORM_addr:
+			return pos + addrsize
+		if form == DW_FORM_ref_addr:
+			return pos + (addrsize if version == 2 else offsize)
+		if form == DW_FORM_string:
+			return ReadCString(data, pos)[1]
+		if form in (DW_FORM_block, DW_FORM_exprloc):
+			(size, pos) = ReadULEB(data, pos)
+			return pos + size
+		if form == DW_FORM_block1:
+			return pos + 1 + data[pos]
+		if form == DW_FORM_block2:
+			return pos + 2 + self._unsigned(data, pos, 2)
+		if form == DW_FORM_block4:
+			return pos + 4 + self._unsigned(data, pos, 4)
+		raise DwarfError('%s: unknown form 0x%x' % (self._path, form))
@@ -0,0 +1,187 @@
+import mmap
+import struct
+
+# Program header types
+PT_LOAD = 1
+PT_NOTE = 4
+
+# Segment flags
+PF_X = 1
+PF_W = 2
+PF_R = 4
+
+# Section header types
+SHT_SYMTAB = 2
+SHT_NOTE = 7
+SHT_DYNSYM = 11
+
+# Section flags
+SHF_COMPRESSED = 0x800
+
+# Special section indices
+SHN_UNDEF = 0
+SHN_XINDEX = 0xffff
+
+# Symbol types
+STT_NOTYPE = 0
+STT_OBJECT = 1
+STT_FUNC = 2
+STT_SECTION = 3
+STT_FILE = 4
+
+# Machine types
+EM_ARM = 40
+
+NT_GNU_BUILD_ID = 3
+
+class ElfError(Exception):
+	pass
+
+class ElfFile:
+	# Minimal ELF32/ELF64 reader. The file is memory-mapped and the headers and
+	# tables are decoded directly with struct, so nothing needs to be forked.
+	def __init__(self, path):
+		self.path = path
+		self._mm = None
+		f = open(path, 'rb')
+		try:
+			try:
+				self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except (ValueError, EnvironmentError) as e:
+				raise ElfError('%s: %s' % (path, e))
+		finally:
+			f.close()
+		mm = self._mm
+		if len(mm) < 16 or mm[:4] != '\x7fELF':
+			raise ElfError('%s: not an ELF file' % path)
+		elfclass = ord(mm[4])
+		elfdata = ord(mm[5])
+		if elfclass not in (1, 2) or elfdata not in (1, 2):
+			raise ElfError('%s: bad ELF identification' % path)
+		self.is64 = (elfclass == 2)
+		self.endian = '<' if elfdata == 1 else '>'
+		e = self.endian
+		if self.is64:
+			self._ehdr = struct.Struct(e + 'HHIQQQIHHHHHH')
+			self._phdr = struct.Struct(e + 'IIQQQQQQ')
+			self._shdr = struct.Struct(e + 'IIQQQQIIQQ')
+			self._sym = struct.Struct(e + 'IBBHQQ')
+		else:
+			self._ehdr = struct.Struct(e + 'HHIIIIIHHHHHH')
+			self._phdr = struct.Struct(e + 'IIIIIIII')
+			self._shdr = struct.Struct(e + 'IIIIIIIIII')
+			self._sym = struct.Struct(e + 'IIIBBH')
+		(self.type, self.machine, version, self.entry, phoff, shoff, flags, ehsize,
+			phentsize, phnum, shentsize, shnum, shstrndx) = self._unpack(self._ehdr, 16)
+		self._read_segments(phoff, phentsize, phnum)
+		self._read_sections(shoff, shentsize, shnum, shstrndx)
+
+	def close(self):
+		if self._mm is not None:
+			self._mm.close()
+			self._mm = None
+
+	def _unpack(self, st, offset):
+		if offset < 0 or offset + st.size > len(self._mm):
+			raise ElfError('%s: truncated ELF file' % self.path)
+		return st.unpack_from(self._mm, offset)
+
+	def _read_segments(self, phoff, phentsize, phnum):
+		# Each segment is (type, offset, vaddr, filesz, memsz, flags)
+		self.segments = []
+		for i in xrange(phnum):
+			ph = self._unpack(self._phdr, phoff + i * phentsize)
+			if self.is64:
+				(ptype, pflags, poffset, pvaddr, ppaddr, pfilesz, pmemsz, palign) = ph
+			else:
+				(ptype, poffset, pvaddr, ppaddr, pfilesz, pmemsz, pflags, palign) = ph
+			self.segments.append((ptype, poffset, pvaddr, pfilesz, pmemsz, pflags))
+
+	def _read_sections(self, shoff, shentsize, shnum, shstrndx):
+		# Each section is a dict with name, type, flags, addr, offset, size,
+		# link, info and entsize keys
+		self.sections = []
+		if shoff == 0:
+			return
+		if shnum == 0 or shstrndx == SHN_XINDEX:
+			# Extended numbering: the real values live in section header 0
+			first = self._unpack(self._shdr, shoff)
+			if shnum == 0:
+				shnum = first[5]
+			if shstrndx == SHN_XINDEX:
+				shstrndx = first[6]
+		for i in xrange(shnum):
+			(name, shtype, flags, addr, offset, size, link, info, align, entsize) = self._unpack(self._shdr, shoff + i * shentsize)
+			self.sections.append({'nameoff': name, 'type': shtype, 'flags': flags, 'addr': addr,
+				'offset': offset, 'size': size, 'link': link, 'info': info, 'entsize': entsize})
+		strtab = None
+		if shstrndx < len(self.sections):
+			strtab = self.sections[shstrndx]
+		for sec in self.sections:
+			sec['name'] = ''
+			if strtab is not None:
+				sec['name'] = self._string(strtab, sec['nameoff'])
+
+	def _string(self, strtab, offset):
+		start = strtab['offset'] + offset
+		if offset >= strtab['size'] or start >= len(self._mm):
+			return ''
+		end = self._mm.find('\0', start, strtab['offset'] + strtab['size'])
+		if end < 0:
+			end = strtab['offset'] + strtab['size']
+		return self._mm[start:end]
+
+	def get_section(self, name):
+		for sec in self.sections:
+			if sec['name'] == name:
+				return sec
+		return None
+
+	def has_debug_info(self):
+		# True if the file carries DWARF sections (compressed or not)
+		for sec in self.sections:
+			if sec['name'].startswith('.debug_') or sec['name'].startswith('.zdebug_'):
+				return True
+		return False
+
+	def section_data(self, sec):
+		if sec['offset'] + sec['size'] > len(self._mm):
+			raise ElfError('%s: section %s is truncated' % (self.path, sec['name']))
+		return self._mm[sec['offset']:sec['offset'] + sec['size']]
+
+	def load_segments(self):
+		# (offset, vaddr, flags) for every PT_LOAD segment
+		return [(s[1], s[2], s[5]) for s in self.segments if s[0] == PT_LOAD]
+
+	def symbols(self):
+		# Yields (value, size, name, type, bind, shndx) for every entry of .symtab
+		# and .dynsym. Values are returned as stored (ARM Thumb bit included).
+		for sec in self.sections:
+			if sec['type'] not in (SHT_SYMTAB, SHT_DYNSYM):
+				continue
+			if sec['link'] >= len(self.sections):
+				continue
+			strtab = self.sections[sec['link']]
+			entsize = sec['entsize'] or self._sym.size
+			for off in xrange(sec['offset'], sec['offset'] + sec['size'] - entsize + 1, entsize):
+				if self.is64:
+					(name, info, other, shndx, value, size) = self._unpack(self._sym, off)
+				else:
+					(name, value, size, info, other, shndx) = self._unpack(self._sym, off)
+				yield (value, size, self._string(strtab, name), info & 0xf, info >> 4, shndx)
+
+	def build_id(self):
+		# The GNU build-id note as a hex string, or None if there isn't one
+		notes = [(s['offset'], s['size']) for s in self.sections if s['type'] == SHT_NOTE]
+		notes += [(s[1], s[3]) for s in self.segments if s[0] == PT_NOTE]
+		hdr = struct.Struct(self.endian + 'III')
+		for (offset, size) in notes:
+			pos = offset
+			while pos + hdr.size <= offset + size:
+				(namesz, descsz, ntype) = self._unpack(hdr, pos)
+				name = self._mm[pos + hdr.size:pos + hdr.size + namesz]
+				desc = pos + hdr.size + ((namesz + 3) & ~3)
+				if ntype == NT_GNU_BUILD_ID and name.rstrip('\0') == 'GNU':
+					return self._mm[desc:desc + descsz].encode('hex')
+				pos = desc + ((descsz + 3) & ~3)
+		return None
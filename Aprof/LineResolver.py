@@ -1,18 +1,49 @@
 import subprocess
 
+from ElfFile import *
+from DwarfLine import *
+from Pipe import *
+import Stats
 from Message import *
 
 class LineResolver:
 	def __init__(self, remotepath, modcache):
 		self._remotepath = remotepath
 		self._ok = False
+		self._table = None
+		self._a2l = None
 		
 		localpath = modcache.get(self._remotepath)
 		if not localpath:
 			Warning('won\'t be able to resolve line numbers inside %s' % self._remotepath)
 			return
+		# Reuse the line table decoded by an earlier run if we have it
+		symbolcache = modcache.get_symbolcache()
+		key = symbolcache.key(localpath)
+		data = symbolcache.get_table(key, 'lines')
+		if data is not None:
+			self._table = LineTable()
+			self._table.load(data)
+			self._ok = True
+			return
+		# Otherwise decode the DWARF line table ourselves if we can
+		try:
+			elf = ElfFile(localpath)
+		except ElfError:
+			Warning('Module %s is not a valid ELF file' % self._remotepath)
+			return
+		try:
+			self._table = LineTable(elf)
+			symbolcache.put_table(key, 'lines', self._table.dump())
+			self._ok = True
+			return
+		except DwarfError as e:
+			Verbose('falling back to addr2line: %s' % e)
+		finally:
+			elf.close()
 		# Test out addr2line to see if it works
 		args = ['arm-linux-androideabi-addr2line', '-C', '-e', localpath, '123']
+		Stats.Count('spawn.addr2line')
 		a2ltest = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 		a2ltest.communicate()
 		if a2ltest.returncode:
@@ -20,22 +51,40 @@ class LineResolver:
 			return
 		# Now start it for real
 		args = ['arm-linux-androideabi-addr2line', '-C', '-e', localpath]
+		Stats.Count('spawn.addr2line')
 		self._a2l = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 		self._ok = True
 		
 	def resolve(self, addr):
 		if not self._ok:
 			return None
+		if self._table is not None:
+			return self._table.lookup(addr)
 		query = '0x%x\n' % addr
+		Stats.Count('roundtrips.addr2line')
+		Stats.Count('queries.addr2line')
 		self._a2l.stdin.write(query)
 		response = self._a2l.stdout.readline().strip()
 		if response == '??:0':
 			response = None
 		return response
 		
+	def resolve_many(self, addrs):
+		if not self._ok:
+			return [None] * len(addrs)
+		if self._table is not None:
+			return self._table.lookup_many(addrs)
+		if addrs:
+			Stats.Count('roundtrips.addr2line')
+			Stats.Count('queries.addr2line', len(addrs))
+		responses = Transact(self._a2l, ['0x%x' % addr for addr in addrs])
+		return [None if r == '??:0' else r for r in responses]
+		
 	def close(self):
 		if not self._ok:
 			return
-		self._a2l.stdin.close()
-		self._a2l = None
+		if self._a2l is not None:
+			self._a2l.stdin.close()
+			self._a2l = None
+		self._table = None
 		self._ok = False
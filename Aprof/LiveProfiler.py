@@ -0,0 +1,220 @@
+import heapq
+import os
+import subprocess
+import threading
+import time
+import zlib
+import Queue
+
+from Profiler import *
+import Stats
+
+# Seconds between refreshes of the top symbols view
+DEFAULT_REFRESH = 2.0
+# Symbols in the view
+DEFAULT_LIVE_TOP = 20
+# Seconds between reads of the stream
+LIVE_POLL = 0.1
+# Shortest time between two reads of the process's maps, which are re-read
+# when samples land outside every known mapping (libraries loaded late).
+# Such samples wait for the next read before they are counted.
+MAPS_REFRESH = 1.0
+
+class LiveProfiler(Profiler):
+	# Profile of a capture that is still being written on the device. The file
+	# is tailed over a single 'adb exec-out tail -f' stream, and the chunks the
+	# sampler flushes are counted into the histograms as they arrive; only PCs
+	# not seen before are symbolized. The capture's maps are only written when
+	# it ends, so they are read from /proc/<pid>/maps instead.
+	def __init__(self, localfiles, remotepath, pid, jobs=1):
+		self._pid = pid
+		Profiler.__init__(self, localfiles, remotepath, jobs)
+
+	def _parseprofile(self, remotepath):
+		self._profiledatafile = None
+		self._version = 2
+		self._byteorder = None
+		self._pcsize = None
+		self._nsamps = 0
+		self._info = {}
+		self._threadsamples = {}
+		self._clock = DEFAULT_CLOCK
+		self._frequency = DEFAULT_FREQUENCY
+		self._pchits = {}
+		self._stackhits = {}
+		self._seenmaps = set()
+		self._unmapped = {}
+		self._mapstime = 0
+		self._done = False
+		self._eof = False
+		self._stream = ProfileStream()
+		self._refreshmaps()
+
+		args = ['adb', 'exec-out', 'tail', '-c', '+1', '-f', remotepath]
+		Stats.Count('spawn.adb')
+		try:
+			self._tail = subprocess.Popen(args, stdout=subprocess.PIPE)
+		except OSError:
+			Fatal('could not run adb (make sure it is on the PATH)')
+		# The reader thread only moves bytes from the pipe to the queue, so the
+		# main thread never blocks on the device
+		self._queue = Queue.Queue()
+		self._reader = threading.Thread(target=self._read)
+		self._reader.daemon = True
+		self._reader.start()
+
+	def _read(self):
+		fd = self._tail.stdout.fileno()
+		while True:
+			data = os.read(fd, 1 << 16)
+			if not data:
+				break
+			self._queue.put(data)
+		self._queue.put(None)
+
+	def _refreshmaps(self):
+		# Add the mappings that appeared since the last read. A range reused by
+		# a different library after an unload keeps its first owner.
+		self._mapstime = time.time()
+		args = ['adb', 'shell', 'cat', '/proc/%d/maps' % self._pid]
+		Stats.Count('spawn.adb')
+		try:
+			p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		except OSError:
+			Fatal('could not run adb (make sure it is on the PATH)')
+		(maps, errout) = p.communicate()
+		if p.returncode != 0:
+			Warning('could not read the maps of process %d' % self._pid)
+			return
+		# Older adb versions turn the newlines into CRLF
+		maps = maps.replace('\r', '')
+		loaded = set()
+		for (begin, end, offset, perm, modpath) in ParseMaps(maps):
+			if (begin, end, offset, modpath) in self._seenmaps:
+				continue
+			self._seenmaps.add((begin, end, offset, modpath))
+			self._modmaps.setdefault(modpath, []).append((begin, end, offset, perm))
+			self._mapindex.add(begin, end, modpath, 0)
+			if self._modules.has_key(modpath):
+				m = self._modules[modpath]
+				known = len(m.get_mappings())
+				m.add_map(begin, end, offset, perm)
+				for (mbegin, mend, tweak) in m.get_mappings()[known:]:
+					self._addrmap.add(mbegin, mend, m, tweak)
+				loaded.add(modpath)
+		self._mapindex.build()
+		if loaded:
+			self._addrmap.build()
+
+	def update(self):
+		# Count whatever has arrived since the last update. Returns the number
+		# of new samples.
+		data = []
+		while True:
+			try:
+				block = self._queue.get_nowait()
+			except Queue.Empty:
+				break
+			if block is None:
+				self._eof = True
+				break
+			data.append(block)
+		newhits = {}
+		for (cid, tid, codec, count, payload) in self._stream.feed(''.join(data)):
+			if cid == 'INFO':
+				info = {}
+				for l in payload.split('\n'):
+					if '=' in l:
+						(key, value) = l.split('=', 1)
+						info[key.strip()] = value.strip()
+				self._info.update(info)
+				self._clock = self._info.get('clock', DEFAULT_CLOCK)
+				# Keep the last good frequency until a complete value arrives
+				try:
+					self._frequency = float(self._info.get('frequency', DEFAULT_FREQUENCY)) or self._frequency
+				except ValueError:
+					pass
+				# The final INFO chunk, which has the totals, ends the capture
+				# (only the maps follow)
+				if info.has_key('samples'):
+					self._done = True
+			elif cid == 'SAMP':
+				CountSamples(DecodeChunkSamples(payload, codec, count, self._stream.pcsize, self._stream.byteorder), newhits)
+			elif cid == 'STAK':
+				if codec == CODEC_ZLIB:
+					payload = zlib.decompress(payload)
+				stacks = DecodeStacks(payload, count, self._stream.pcsize, self._stream.byteorder)
+				CountSamples([frames[0] for (frames, haslr) in stacks if frames], newhits)
+			else:
+				continue
+			self._threadsamples[tid] = self._threadsamples.get(tid, 0) + count
+			self._nsamps += count
+		if self._stream.pcsize is not None:
+			self._pcsize = self._stream.pcsize
+			self._byteorder = self._stream.byteorder
+		total = sum(newhits.values())
+		Stats.Count('pcs.total', total)
+		for (pc, count) in newhits.items():
+			self._pchits[pc] = self._pchits.get(pc, 0) + count
+		newpcs = [pc for pc in newhits.keys() if not self._symcache.has_key(pc)]
+		for (pc, hit) in zip(newpcs, self._mapindex.lookup_many(newpcs)):
+			if hit is None:
+				self._unmapped[pc] = self._unmapped.get(pc, 0) + newhits.pop(pc)
+		if self._unmapped and (self.is_done() or time.time() - self._mapstime >= MAPS_REFRESH):
+			# Whatever is still unmapped after this read is outside every module
+			self._refreshmaps()
+			for (pc, count) in self._unmapped.items():
+				newhits[pc] = newhits.get(pc, 0) + count
+			self._unmapped = {}
+		if newhits:
+			self._addhits(newhits)
+		return total
+
+	def is_done(self):
+		# True once the capture has ended, or the stream has
+		return self._done or self._eof
+
+	@Stats.Timed('dump')
+	def show(self, f, n=DEFAULT_LIVE_TOP):
+		# The top n symbols so far; on a terminal, in place of the last view
+		symhits = heapq.nlargest(n, self._symhitcounter.get_hits())
+		self.demangle_many([sym for (count, (modname, sym)) in symhits])
+		if f.isatty():
+			f.write('\x1b[H\x1b[2J')
+		print >> f, 'Samples,Seconds,Distinct PCs'
+		print >> f, '%d,%0.3f,%d' % (self._nsamps, self.get_seconds(self._nsamps), len(self._pchits))
+		print >> f
+		print >> f, 'Module,Symbol,Samples,Percent'
+		for (count, (modname, sym)) in symhits:
+			percent = 100.0 * count / self._nsamps
+			print >> f, '%s,"%s",%d,%0.2f' % (modname, self.demangle(sym), count, percent)
+		print >> f
+		f.flush()
+
+	def run(self, f, refresh=DEFAULT_REFRESH, n=DEFAULT_LIVE_TOP):
+		# Show the top symbols every refresh seconds until the capture ends (or
+		# the user interrupts), then once more with the final counts
+		nextshow = time.time() + refresh
+		try:
+			while not self.is_done():
+				self.update()
+				now = time.time()
+				if now >= nextshow:
+					self.show(f, n)
+					nextshow = max(nextshow + refresh, now)
+				time.sleep(LIVE_POLL)
+			self.update()
+		except KeyboardInterrupt:
+			pass
+		self.show(f, n)
+		if int(self._info.get('dropped', 0)):
+			Warning('%s samples were dropped during capture' % self._info['dropped'])
+
+	def get_timeline(self):
+		Fatal('time windows need a complete capture')
+
+	def close(self):
+		if self._tail.poll() is None:
+			self._tail.terminate()
+		self._tail.wait()
+		Profiler.close(self)
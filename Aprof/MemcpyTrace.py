@@ -0,0 +1,178 @@
+import itertools
+import mmap
+import multiprocessing
+import os
+import re
+
+import Stats
+from Message import *
+
+# Ranges of the log smaller than this are not split further
+MIN_SPLIT = 1 << 20
+# Ranges per worker, so a slow range doesn't hold the others up
+SPLITS_PER_JOB = 4
+# Percentiles reported for each caller
+PERCENTILES = (50, 90, 99)
+
+# One pattern for both the lines tracememcpy.gdb logs for a call: the value of
+# the size register ('$N = size') and the caller's frame ('#1 ... in caller').
+# It starts with the newline before the line, as a pattern with a literal
+# first character is searched for much faster than one anchored with ^.
+LINEPATTERN = r'(?:\$[0-9]+ = (-?[0-9]+)|#1[ \t].* in (.*))'
+RECORDRE = re.compile(r'\n' + LINEPATTERN)
+FIRSTRE = re.compile(LINEPATTERN)
+
+def ParseTraceRange(job):
+	# Worker process entry point: ({caller: {size: calls}}, negative calls)
+	# over [start, end) of the log, which must start at the newline ending the
+	# last record's final line (or at the start of the log). gdb prints the
+	# size register signed, so a negative size is a copy of 2GB or more, which
+	# is a corrupted call or a misread register rather than a real copy; such
+	# calls are left out of the histograms and only counted.
+	(path, start, end) = job
+	callers = {}
+	negative = 0
+	f = open(path, 'rb')
+	mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		nbyte = None
+		matches = RECORDRE.finditer(mm, start, end)
+		if start == 0:
+			first = FIRSTRE.match(mm, 0, end)
+			if first:
+				matches = itertools.chain([first], matches)
+		for mat in matches:
+			(size, frame) = mat.groups()
+			if size is not None:
+				nbyte = int(size)
+				if nbyte < 0:
+					negative += 1
+					nbyte = None
+			elif nbyte is not None:
+				frame = frame.rstrip()
+				sizes = callers.setdefault(frame, {})
+				sizes[nbyte] = sizes.get(nbyte, 0) + 1
+				nbyte = None
+	finally:
+		mm.close()
+		f.close()
+	return (callers, negative)
+
+def SizeBucket(size):
+	# log2 bucket of a copy size: 0 for empty copies, otherwise b for sizes in
+	# [2^(b-1), 2^b)
+	if size < 0:
+		raise ValueError('negative copy size %d' % size)
+	return size.bit_length()
+
+def BucketLabel(bucket):
+	if bucket == 0:
+		return '0'
+	return '%d-%d' % (1 << (bucket - 1), (1 << bucket) - 1)
+
+def Percentile(sizes, calls, p):
+	# Nearest-rank percentile of a sorted [(size, calls)] histogram
+	rank = max(1, -(-calls * p // 100))
+	seen = 0
+	for (size, count) in sizes:
+		seen += count
+		if seen >= rank:
+			return size
+	return sizes[-1][0]
+
+class MemcpyTrace:
+	# Per-caller statistics of the memcpy calls in a log written by
+	# Scripts/tracememcpy.gdb. The log is memory-mapped and split at the
+	# '$N = size' lines that start each record, the ranges are parsed in a
+	# process pool, and the per-caller size histograms are merged.
+	def __init__(self, path, jobs=1):
+		self._path = path
+		self._jobs = jobs
+		self._callers = {}
+		self._parse()
+
+	@Stats.Timed('parse')
+	def _parse(self):
+		ranges = self._split()
+		if self._jobs > 1 and len(ranges) > 1:
+			pool = multiprocessing.Pool(min(self._jobs, len(ranges)))
+			try:
+				results = pool.map(ParseTraceRange, ranges)
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			results = [ParseTraceRange(r) for r in ranges]
+		negative = 0
+		for (callers, n) in results:
+			for (frame, sizes) in callers.items():
+				merged = self._callers.setdefault(frame, {})
+				for (size, count) in sizes.items():
+					merged[size] = merged.get(size, 0) + count
+			negative += n
+		if negative:
+			Warning('ignored %d calls with a negative size' % negative)
+		Stats.Count('memcpy.ranges', len(ranges))
+		Stats.Count('memcpy.negative', negative)
+		Stats.Count('memcpy.calls', sum([sum(sizes.values()) for sizes in self._callers.values()]))
+
+	def _split(self):
+		# [(path, start, end)] covering the log, each starting at a record
+		try:
+			length = os.path.getsize(self._path)
+		except OSError:
+			Fatal('could not open %s' % self._path)
+		if length == 0:
+			return []
+		nsplits = 1
+		if self._jobs > 1:
+			nsplits = max(1, min(self._jobs * SPLITS_PER_JOB, length // MIN_SPLIT))
+		f = open(self._path, 'rb')
+		mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		bounds = [0]
+		for i in xrange(1, nsplits):
+			pos = mm.find('\n$', max(bounds[-1], length * i // nsplits))
+			if pos < 0:
+				break
+			bounds.append(pos)
+		bounds.append(length)
+		mm.close()
+		f.close()
+		return [(self._path, start, end) for (start, end) in zip(bounds[:-1], bounds[1:]) if start < end]
+
+	def get_callers(self):
+		# {caller: {size: calls}}
+		return self._callers
+
+	def get_summary(self):
+		# [(bytes, calls, caller, sizes)] by bytes copied, most first, with
+		# sizes the caller's sorted [(size, calls)] histogram
+		summary = []
+		for (frame, sizes) in self._callers.items():
+			sizes = sorted(sizes.items())
+			calls = sum([count for (size, count) in sizes])
+			nbyte = sum([size * count for (size, count) in sizes])
+			summary.append((nbyte, calls, frame, sizes))
+		summary.sort(key=lambda s: (-s[0], -s[1], s[2]))
+		return summary
+
+	@Stats.Timed('dump')
+	def dump_csv(self, f):
+		summary = self.get_summary()
+		print >> f, 'Context,Calls,BytesCopied,Mean,Min,%s,Max' % ','.join(['P%d' % p for p in PERCENTILES])
+		for (nbyte, calls, frame, sizes) in summary:
+			percentiles = [Percentile(sizes, calls, p) for p in PERCENTILES]
+			print >> f, '"%s",%d,%d,%0.1f,%d,%s,%d' % (frame, calls, nbyte, float(nbyte) / calls,
+				sizes[0][0], ','.join(['%d' % s for s in percentiles]), sizes[-1][0])
+
+		print >> f
+		print >> f, 'Context,Size,Calls,BytesCopied,Percent'
+		for (nbyte, calls, frame, sizes) in summary:
+			buckets = {}
+			for (size, count) in sizes:
+				b = SizeBucket(size)
+				(bcalls, bbytes) = buckets.get(b, (0, 0))
+				buckets[b] = (bcalls + count, bbytes + size * count)
+			for (b, (bcalls, bbytes)) in sorted(buckets.items()):
+				percent = 100.0 * bcalls / calls
+				print >> f, '"%s",%s,%d,%d,%0.2f' % (frame, BucketLabel(b), bcalls, bbytes, percent)
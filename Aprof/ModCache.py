@@ -1,38 +1,101 @@
+import hashlib
 import os
 import subprocess
+from multiprocessing.pool import ThreadPool
 
+from SymbolCache import *
+import Stats
 from Message import *
 
+# Number of concurrent adb pulls
+DEFAULT_PULL_JOBS = 4
+# Number of paths passed to a single adb shell stat/md5sum command
+SIGNATURE_BATCH = 64
+
 class ModCache:
-	def __init__(self, localfiles=[]):
+	# Local copies of device files. A cached copy is only reused while it still
+	# matches the device: either its size and mtime (verify='stat', compared with
+	# what the device reported when it was pulled) or its md5sum (verify='md5').
+	#
+	# Caches holding different builds of the same device paths pull into their
+	# own pulldir under .aprof_cache, and may share the symbol cache of another
+	# ModCache (which stays the owner, and closes it).
+	def __init__(self, localfiles=[], jobs=DEFAULT_PULL_JOBS, verify='stat', pulldir=None, symbolcache=None):
 		# If .aprof_cache directory doesn't exist, create it
 		self._cachepath = '.aprof_cache'
-		if not os.path.isdir(self._cachepath):
-			os.makedirs(self._cachepath)
+		self._pullpath = self._cachepath
+		if pulldir is not None:
+			self._pullpath = os.path.join(self._cachepath, pulldir)
+		if not os.path.isdir(self._pullpath):
+			os.makedirs(self._pullpath)
 		self._local = {}
 		self._localoverride = localfiles
-		
+		self._symbolcache = symbolcache
+		self._ownsymbolcache = symbolcache is None
+		self._jobs = jobs
+		self._verify = verify
+
 	def get(self, filename, fresh=False):
-		if self._local.has_key(filename):
-			return self._local[filename]
-		# Is there a local override?
-		target = self.get_local(filename)
-		if not target:
-			# Not a local file
-			cachename = filename.replace('/', '__')
-			target = os.path.join(self._cachepath, cachename)
-			# If we've been requested to get a fresh copy, or the file isn't in the
-			# cache yet, pull it from the device
+		if fresh and self._local.has_key(filename):
+			del self._local[filename]
+		self.prefetch([filename], fresh)
+		return self._local[filename]
+
+	def prefetch(self, filenames, fresh=False):
+		# Make sure each of the files has a current local copy, pulling the
+		# missing or stale ones from the device concurrently
+		remote = []
+		for filename in filenames:
+			if self._local.has_key(filename) or filename in remote:
+				Stats.Count('modcache.hit')
+				continue
+			# Is there a local override?
+			target = self.get_local(filename)
+			if target:
+				Stats.Count('modcache.hit')
+				self._local[filename] = target
+			else:
+				remote.append(filename)
+		if not remote:
+			return
+		signatures = self._remote_signatures(remote)
+		pulls = []
+		for filename in remote:
+			target = self._cachename(filename)
+			signature = signatures.get(filename)
 			if fresh or not os.path.isfile(target):
-				args = ['adb', 'pull', filename, target]
-				p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-				p.communicate()
-				if p.returncode or not os.path.isfile(target):
-					Warning('failed to download %s' % filename)
-					return None
-		self._local[filename] = target
-		return target
-		
+				pulls.append((filename, target, signature))
+			elif signature is None:
+				# Can't check against the device, so trust what we have
+				Verbose('using unverified cached copy of %s' % filename)
+				Stats.Count('modcache.hit')
+				self._local[filename] = target
+			elif self._local_signature(target) != signature:
+				Verbose('cached copy of %s is stale' % filename)
+				pulls.append((filename, target, signature))
+			else:
+				Stats.Count('modcache.hit')
+				self._local[filename] = target
+		if not pulls:
+			return
+		# Counted here rather than in the pulling threads
+		Stats.Count('modcache.miss', len(pulls))
+		Stats.Count('spawn.adb', len(pulls))
+		pool = ThreadPool(min(self._jobs, len(pulls)))
+		try:
+			results = pool.map(self._pull, pulls)
+		finally:
+			pool.close()
+			pool.join()
+		for ((filename, target, signature), ok) in zip(pulls, results):
+			if ok:
+				Stats.Count('adb.bytes', os.path.getsize(target))
+				self._local[filename] = target
+			else:
+				Stats.Count('adb.failed')
+				Warning('failed to download %s' % filename)
+				self._local[filename] = None
+
 	def get_local(self, filename):
 		for f in self._localoverride:
 			(dir, fn) = os.path.split(f)
@@ -43,3 +106,80 @@ class ModCache:
 					continue
 				return f
 		return None
+
+	def get_cachepath(self):
+		return self._cachepath
+
+	def get_symbolcache(self):
+		if self._symbolcache is None:
+			self._symbolcache = SymbolCache(self._cachepath)
+		return self._symbolcache
+
+	def close(self):
+		if self._symbolcache is not None and self._ownsymbolcache:
+			self._symbolcache.close()
+		self._symbolcache = None
+
+	def _cachename(self, filename):
+		return os.path.join(self._pullpath, filename.replace('/', '__'))
+
+	def _pull(self, pull):
+		(filename, target, signature) = pull
+		# Pull to a temporary name first so an interrupted pull never leaves a
+		# truncated file that looks like a valid cache entry
+		tmp = target + '.part'
+		args = ['adb', 'pull', filename, tmp]
+		try:
+			p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		except OSError:
+			return False
+		p.communicate()
+		if p.returncode or not os.path.isfile(tmp):
+			return False
+		if os.path.isfile(target):
+			os.remove(target)
+		os.rename(tmp, target)
+		stamp = open(target + '.stamp', 'w')
+		if signature is not None and self._verify == 'stat':
+			stamp.write(signature)
+		stamp.close()
+		return True
+
+	def _local_signature(self, target):
+		if self._verify == 'md5':
+			h = hashlib.md5()
+			f = open(target, 'rb')
+			data = f.read(1 << 20)
+			while data:
+				h.update(data)
+				data = f.read(1 << 20)
+			f.close()
+			return h.hexdigest()
+		if not os.path.isfile(target + '.stamp'):
+			return None
+		return open(target + '.stamp').read()
+
+	def _remote_signatures(self, filenames):
+		# Ask the device for the size+mtime or md5sum of each file. Files the
+		# device can't report on (or all of them, if there is no device) are
+		# missing from the result.
+		signatures = {}
+		for i in xrange(0, len(filenames), SIGNATURE_BATCH):
+			batch = filenames[i:i + SIGNATURE_BATCH]
+			if self._verify == 'md5':
+				args = ['adb', 'shell', 'md5sum'] + batch
+			else:
+				args = ['adb', 'shell', 'stat', '-c', '\'%s %Y %n\''] + batch
+			Stats.Count('spawn.adb')
+			try:
+				p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			except OSError:
+				return signatures
+			(out, errout) = p.communicate()
+			for l in out.replace('\r', '').split('\n'):
+				fields = l.split()
+				if self._verify == 'md5' and len(fields) == 2 and fields[1] in batch:
+					signatures[fields[1]] = fields[0]
+				elif self._verify != 'md5' and len(fields) == 3 and fields[2] in batch and fields[0].isdigit():
+					signatures[fields[2]] = '%s %s' % (fields[0], fields[1])
+		return signatures
@@ -1,6 +1,4 @@
-import re
-import subprocess
-
+from ElfFile import *
 from SymbolResolver import *
 from LineResolver import *
 from Message import *
@@ -23,32 +21,20 @@ class Module:
 		if not localpath:
 			Warning('Module %s could not be found (make sure the device is connected)' % self._remotepath)
 			return
-		p = subprocess.Popen(['arm-linux-androideabi-readelf', '-l', '-W', localpath], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		(out, errout) = p.communicate()
-		if p.returncode:
+		try:
+			elf = ElfFile(localpath)
+		except ElfError:
 			Warning('Module %s is not a valid ELF file' % self._remotepath)
 			return
-		loadre = re.compile(r'\s*LOAD\s+(0x\S+)\s+(0x\S+).*')
-		for ll in out.split('\n'):
-			mat = loadre.match(ll)
-			if mat:
-				offset = long(mat.group(1), 16)
-				vma = long(mat.group(2), 16)
-				self._segvma[offset] = vma
+		for (offset, vma, flags) in elf.load_segments():
+			self._segvma[offset] = vma
 		# Get the offset of the .text segment. We need this to calculate the
 		# correct load address to pass to gdb add-symbol-file.
-		p = subprocess.Popen(['arm-linux-androideabi-readelf', '-S', '-W', localpath], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		(out, errout) = p.communicate()
-		if p.returncode:
-			Warning('Module %s is not a valid ELF file' % self._remotepath)
-			return
-		textre = re.compile('.*]\s+(\S+)\s+\S+\s+\S+\s+(\S+).*')
 		self.textoffset = None
-		for sl in out.split('\n'):
-			mat = textre.match(sl)
-			if mat and mat.group(1) == '.text':
-				self.textoffset = int(mat.group(2), 16)
-				break
+		text = elf.get_section('.text')
+		if text is not None:
+			self.textoffset = text['offset']
+		elf.close()
 		self._ok = True
 	
 	def add_map(self, begin, end, offset, perm):
@@ -62,6 +48,18 @@ class Module:
 		tweak = self._segvma[offset] - begin
 		self._mappings.append((begin, end, tweak))
 	
+	def get_path(self):
+		return self._remotepath
+	
+	def get_cache_key(self):
+		# Key of this module's entries in the persistent symbol cache
+		if not self._ok:
+			return None
+		return self._modcache.get_symbolcache().key(self._modcache.get(self._remotepath))
+	
+	def get_mappings(self):
+		return self._mappings
+	
 	def get_base(self):
 		base = None
 		if len(self._mappings) > 0:
@@ -88,6 +86,19 @@ class Module:
 			if addr >= begin and addr < end:
 				return self._get_line_resolver().resolve(addr + tweak)
 		return None
+	
+	# Resolve an already-translated VMA (see AddressMap)
+	def get_vma_symbol(self, vma):
+		return self._get_symbol_resolver().resolve(vma)
+	
+	def get_vma_line(self, vma):
+		return self._get_line_resolver().resolve(vma)
+	
+	def get_vma_symbols(self, vmas):
+		return self._get_symbol_resolver().resolve_many(vmas)
+	
+	def get_vma_lines(self, vmas):
+		return self._get_line_resolver().resolve_many(vmas)
 		
 	def close(self):
 		if self._symbol_resolver:
@@ -0,0 +1,23 @@
+import threading
+
+def Transact(process, queries):
+	# Send a batch of one-line queries to a line-oriented filter process (such as
+	# addr2line or c++filt) and return its one-line responses, in order. The
+	# queries are written from a separate thread so that the tool can never block
+	# on a full stdout pipe while we are still blocked writing to its stdin.
+	if not queries:
+		return []
+	def writer():
+		try:
+			process.stdin.write(''.join(['%s\n' % q for q in queries]))
+			process.stdin.flush()
+		except IOError:
+			pass
+	t = threading.Thread(target=writer)
+	t.daemon = True
+	t.start()
+	responses = []
+	for i in xrange(len(queries)):
+		responses.append(process.stdout.readline().strip())
+	t.join()
+	return responses
@@ -0,0 +1,451 @@
+import struct
+import zlib
+
+from SampleData import *
+from Message import *
+
+# PROFDAT2 layout
+#
+#   'PROFDAT2'            8 bytes
+#   pcsize                u32, 4 or 8, in the byte order of the profiled process
+#                         (every other number in the file uses the same order)
+#   reserved              u32, 0
+#   chunks, until end of file:
+#     id                  4 ASCII bytes
+#     length              u64, payload bytes
+#     payload
+#
+# Chunks (readers skip ids they don't know):
+#   'INFO'  'key=value' lines describing the capture. libAprof writes 'clock'
+#           (prof, thread or wall) and 'frequency' (Hz) first, and 'samples'
+#           and 'dropped' when the capture ends.
+#   'SAMP'  u32 thread id, u8 codec, 3 bytes padding, u32 sample count, then the
+#           PCs of that thread in sample order, encoded with the codec
+#   'HIST'  u32 thread id (0 for all threads), u8 codec, 3 bytes padding, u32
+#           pair count, then (PC, u64 count) pairs, encoded with the codec. If a
+#           file has HIST chunks, they describe the same samples as its SAMP
+#           chunks, so readers only need one or the other.
+#   'STAK'  u32 thread id, u8 codec, 3 bytes padding, u32 sample count, then a
+#           stack record per sample, as PC-sized words encoded with the codec:
+#           a header (frame count in the low 16 bits, STACK_LR_FLAG if the
+#           second frame is the link register), then the frames, leaf first.
+#           Captures taken in stack-sampling mode have STAK chunks instead of
+#           SAMP chunks.
+#   'MAPS'  contents of /proc/self/maps
+#
+# Codecs:
+#   0  raw: PCs (or pairs) as fixed-size numbers
+#   1  delta: each PC as a zigzag-encoded LEB128 difference from the previous
+#      one (SAMP only)
+#   2  zlib: the raw encoding, zlib-compressed
+
+CODEC_RAW = 0
+CODEC_DELTA = 1
+CODEC_ZLIB = 2
+
+# Stack record header fields
+STACK_COUNT_MASK = 0xffff
+STACK_LR_FLAG = 1 << 16
+
+# Sampling setup of captures that don't record one (every PROFDAT1 file)
+DEFAULT_CLOCK = 'prof'
+DEFAULT_FREQUENCY = 100
+
+# Samples per SAMP chunk written by ProfileWriter
+WRITER_CHUNK = 1 << 16
+
+class ProfileData:
+	# Reader for PROFDAT1 and PROFDAT2 files. Only the chunk directory is read up
+	# front; samples are streamed on demand.
+	def __init__(self, path):
+		self._path = path
+		self._f = open(path, 'rb')
+		f = self._f
+		self.info = {}
+		self._chunks = []
+		signature = f.read(8)
+		if signature == 'PROFDAT1':
+			self.version = 1
+		elif signature == 'PROFDAT2':
+			self.version = 2
+		else:
+			Fatal('corrupted file: bad chunk ID (expected PROFDAT1 or PROFDAT2)')
+		pcsize = f.read(4)
+		if len(pcsize) != 4:
+			Fatal('corrupted file: too short')
+		self.byteorder = ByteOrder(pcsize)
+		if self.byteorder is None:
+			Fatal('corrupted file: crazy PC size')
+		self.pcsize = struct.unpack(self.byteorder + 'I', pcsize)[0]
+		if self.version == 1:
+			self._scan_v1()
+		else:
+			self._scan_v2()
+
+	def close(self):
+		self._f.close()
+
+	def _unpack(self, fmt, size):
+		data = self._f.read(size)
+		if len(data) != size:
+			Fatal('corrupted file: too short')
+		return struct.unpack(self.byteorder + fmt, data)
+
+	def _scan_v1(self):
+		# One sample block for the whole process, then MAPSDATA
+		f = self._f
+		(self.nsamps,) = self._unpack('Q', 8)
+		sampleoffset = f.tell()
+		self._chunks.append(('SAMP', 0, CODEC_RAW, self.nsamps, sampleoffset, self.nsamps * self.pcsize))
+		# Skip over the samples to the MAPSDATA chunk which contains the mapping information
+		f.seek(sampleoffset + self.nsamps * self.pcsize)
+		if f.read(8) != 'MAPSDATA':
+			Fatal('corrupted file: no MAPSDATA chunk')
+		# The next 8 bytes are supposed to contain the size of MAPSDATA, but libAprof
+		# writes zero there. In that case the maps run to the end of the file.
+		(mapssize,) = self._unpack('Q', 8)
+		mapsoffset = f.tell()
+		if not mapssize:
+			f.seek(0, 2)
+			mapssize = f.tell() - mapsoffset
+		self._chunks.append(('MAPS', 0, CODEC_RAW, 0, mapsoffset, mapssize))
+
+	def _scan_v2(self):
+		f = self._f
+		self._unpack('I', 4)
+		self.nsamps = 0
+		while True:
+			chunkid = f.read(4)
+			if not chunkid:
+				break
+			if len(chunkid) != 4:
+				Fatal('corrupted file: truncated chunk header')
+			(length,) = self._unpack('Q', 8)
+			offset = f.tell()
+			if chunkid in ('SAMP', 'HIST', 'STAK'):
+				(tid, codec, count) = self._unpack('IB3xI', 12)
+				self._chunks.append((chunkid, tid, codec, count, offset + 12, length - 12))
+				if chunkid != 'HIST':
+					self.nsamps += count
+			else:
+				self._chunks.append((chunkid, 0, CODEC_RAW, 0, offset, length))
+			f.seek(offset + length)
+			if f.tell() != offset + length or offset + length > self._filesize():
+				Fatal('corrupted file: truncated %s chunk' % chunkid)
+		for l in self._read_text('INFO').split('\n'):
+			if '=' in l:
+				(key, value) = l.split('=', 1)
+				self.info[key.strip()] = value.strip()
+
+	def _filesize(self):
+		pos = self._f.tell()
+		self._f.seek(0, 2)
+		size = self._f.tell()
+		self._f.seek(pos)
+		return size
+
+	def _read_text(self, chunkid):
+		text = []
+		for (cid, tid, codec, count, offset, length) in self._chunks:
+			if cid == chunkid:
+				self._f.seek(offset)
+				text.append(self._f.read(length))
+		return ''.join(text)
+
+	def get_maps(self):
+		return self._read_text('MAPS')
+
+	def get_threads(self):
+		return sorted(set([tid for (cid, tid, codec, count, offset, length) in self._chunks if cid in ('SAMP', 'STAK')]))
+
+	def get_thread_samples(self):
+		# {tid: number of samples}, from the chunk headers alone
+		counts = {}
+		for (cid, tid, codec, count, offset, length) in self._chunks:
+			if cid in ('SAMP', 'STAK'):
+				counts[tid] = counts.get(tid, 0) + count
+		return counts
+
+	def get_thread_chunks(self):
+		# [(tid, number of samples)] per sample chunk, in file order
+		return [(tid, count) for (cid, tid, codec, count, offset, length) in self._chunks if cid in ('SAMP', 'STAK')]
+
+	def get_clock(self):
+		return self.info.get('clock', DEFAULT_CLOCK)
+
+	def get_frequency(self):
+		try:
+			frequency = float(self.info.get('frequency', DEFAULT_FREQUENCY))
+		except ValueError:
+			frequency = 0
+		if frequency <= 0:
+			Warning('bad sampling frequency %s, assuming %d Hz' % (self.info['frequency'], DEFAULT_FREQUENCY))
+			frequency = DEFAULT_FREQUENCY
+		return frequency
+
+	def has_stacks(self):
+		return len([c for c in self._chunks if c[0] == 'STAK']) > 0
+
+	def iter_samples(self, tid=None):
+		# Yield the PCs as typed arrays, chunk by chunk in file order, for one
+		# thread or for all of them. For stack samples these are the leaf frames.
+		for (cid, ctid, codec, count, offset, length) in self._chunks:
+			if cid not in ('SAMP', 'STAK') or (tid is not None and ctid != tid):
+				continue
+			if cid == 'STAK':
+				leaves = [stack[0] for (stack, haslr) in self._stack_records(count, codec, offset, length) if stack]
+				yield SampleArray(leaves, self.pcsize)
+				continue
+			self._f.seek(offset)
+			if codec == CODEC_RAW:
+				for chunk in IterSampleChunks(self._f, self.pcsize, count, self.byteorder):
+					yield chunk
+			elif codec == CODEC_ZLIB:
+				for chunk in self._iter_zlib(length, count * self.pcsize, self.pcsize):
+					yield DecodeSamples(chunk, self.pcsize, self.byteorder)
+			elif codec == CODEC_DELTA:
+				yield DecodeDeltas(self._f.read(length), count, self.pcsize)
+			else:
+				Fatal('corrupted file: unknown sample codec %d' % codec)
+
+	def iter_stacks(self, tid=None):
+		# Yield (frames, haslr) per sample, frames being a tuple of PCs, leaf first
+		for (cid, ctid, codec, count, offset, length) in self._chunks:
+			if cid == 'STAK' and (tid is None or ctid == tid):
+				for record in self._stack_records(count, codec, offset, length):
+					yield record
+
+	def stack_histogram(self, tid=None):
+		# {(frames, haslr): count}. Captures repeat a small set of stacks many
+		# times, so each distinct stack is stored (and later resolved) once.
+		counts = {}
+		for record in self.iter_stacks(tid):
+			counts[record] = counts.get(record, 0) + 1
+		return counts
+
+	def _stack_records(self, count, codec, offset, length):
+		self._f.seek(offset)
+		if codec == CODEC_RAW:
+			data = self._f.read(length)
+		elif codec == CODEC_ZLIB:
+			data = ''.join(self._iter_zlib(length, None, self.pcsize))
+		else:
+			Fatal('corrupted file: unknown stack codec %d' % codec)
+		return DecodeStacks(data, count, self.pcsize, self.byteorder)
+
+	def histogram(self, tid=None):
+		# {pc: count}, from the HIST chunks if the file has them, otherwise by
+		# streaming the samples
+		hists = [c for c in self._chunks if c[0] == 'HIST' and (tid is None or c[1] == tid)]
+		counts = {}
+		if not hists:
+			for chunk in self.iter_samples(tid):
+				CountSamples(chunk, counts)
+			return counts
+		pair = struct.Struct(self.byteorder + ('I' if self.pcsize == 4 else 'Q') + 'Q')
+		for (cid, ctid, codec, count, offset, length) in hists:
+			self._f.seek(offset)
+			if codec == CODEC_RAW:
+				data = self._f.read(length)
+			elif codec == CODEC_ZLIB:
+				data = ''.join(self._iter_zlib(length, count * pair.size, pair.size))
+			else:
+				Fatal('corrupted file: unknown histogram codec %d' % codec)
+			if len(data) != count * pair.size:
+				Fatal('corrupted file: truncated HIST chunk')
+			for i in xrange(count):
+				(pc, n) = pair.unpack_from(data, i * pair.size)
+				counts[pc] = counts.get(pc, 0) + n
+		return counts
+
+	def _iter_zlib(self, length, rawsize, itemsize):
+		# Inflate a zlib stream from the current position a window at a time,
+		# yielding strings that are a multiple of itemsize long
+		d = zlib.decompressobj()
+		pending = ''
+		produced = 0
+		remaining = length
+		while remaining > 0:
+			data = self._f.read(min(remaining, 1 << 20))
+			if not data:
+				Fatal('corrupted file: truncated compressed chunk')
+			remaining -= len(data)
+			pending += d.decompress(data)
+			usable = len(pending) - len(pending) % itemsize
+			if usable:
+				yield pending[:usable]
+				produced += usable
+				pending = pending[usable:]
+		pending += d.flush()
+		if pending:
+			yield pending
+			produced += len(pending)
+		if rawsize is not None and produced != rawsize:
+			Fatal('corrupted file: compressed chunk has the wrong size')
+
+def DecodeStacks(data, count, pcsize, byteorder):
+	# Decode the (uncompressed) payload of a STAK chunk into (frames, haslr)
+	if len(data) % pcsize:
+		Fatal('corrupted file: truncated STAK chunk')
+	words = DecodeSamples(data, pcsize, byteorder).tolist()
+	records = []
+	pos = 0
+	while pos < len(words):
+		header = words[pos]
+		end = pos + 1 + (header & STACK_COUNT_MASK)
+		if end > len(words):
+			Fatal('corrupted file: truncated stack record')
+		records.append((tuple(words[pos + 1:end]), (header & STACK_LR_FLAG) != 0))
+		pos = end
+	if len(records) != count:
+		Fatal('corrupted file: STAK chunk has the wrong sample count')
+	return records
+
+def DecodeChunkSamples(data, codec, count, pcsize, byteorder):
+	# Decode a whole SAMP payload into a typed array of PCs
+	if codec == CODEC_RAW:
+		pcs = DecodeSamples(data, pcsize, byteorder)
+	elif codec == CODEC_ZLIB:
+		pcs = DecodeSamples(zlib.decompress(data), pcsize, byteorder)
+	elif codec == CODEC_DELTA:
+		return DecodeDeltas(data, count, pcsize)
+	else:
+		Fatal('corrupted file: unknown sample codec %d' % codec)
+	if len(pcs) != count:
+		Fatal('corrupted file: SAMP chunk has the wrong sample count')
+	return pcs
+
+def DecodeDeltas(data, count, pcsize):
+	# Decode zigzag LEB128 deltas into a typed array of PCs
+	data = bytearray(data)
+	pcs = []
+	pc = 0
+	value = 0
+	shift = 0
+	for b in data:
+		value |= (b & 0x7f) << shift
+		shift += 7
+		if b < 0x80:
+			if value & 1:
+				pc -= (value + 1) >> 1
+			else:
+				pc += value >> 1
+			pcs.append(pc)
+			value = 0
+			shift = 0
+	if len(pcs) != count:
+		Fatal('corrupted file: delta chunk has the wrong sample count')
+	return SampleArray(pcs, pcsize)
+
+def SampleArray(pcs, pcsize):
+	# A typed array like DecodeSamples returns, from a list of PCs
+	if numpy is not None:
+		return numpy.array(pcs, dtype=numpy.dtype('u%d' % pcsize))
+	return array.array(ArrayTypecode(pcsize), pcs)
+
+def EncodeDeltas(pcs):
+	out = bytearray()
+	prev = 0
+	for pc in pcs:
+		delta = pc - prev
+		prev = pc
+		value = delta << 1 if delta >= 0 else ((-delta) << 1) - 1
+		while value >= 0x80:
+			out.append((value & 0x7f) | 0x80)
+			value >>= 7
+		out.append(value)
+	return str(out)
+
+class ProfileStream:
+	# Incremental PROFDAT2 parser for a capture that is still being written:
+	# feed it bytes as they arrive and it returns the chunks completed so far,
+	# as (id, tid, codec, count, payload). tid, codec and count are 0 for
+	# chunks without a sample header.
+	def __init__(self):
+		self.pcsize = None
+		self.byteorder = None
+		self._pending = ''
+
+	def feed(self, data):
+		self._pending += data
+		chunks = []
+		pos = 0
+		if self.pcsize is None:
+			if len(self._pending) < 16:
+				return chunks
+			if self._pending[:8] != 'PROFDAT2':
+				Fatal('corrupted stream: expected PROFDAT2 (PROFDAT1 captures can\'t be read live)')
+			self.byteorder = ByteOrder(self._pending[8:12])
+			if self.byteorder is None:
+				Fatal('corrupted stream: crazy PC size')
+			self.pcsize = struct.unpack(self.byteorder + 'I', self._pending[8:12])[0]
+			pos = 16
+		while len(self._pending) - pos >= 12:
+			chunkid = self._pending[pos:pos + 4]
+			(length,) = struct.unpack(self.byteorder + 'Q', self._pending[pos + 4:pos + 12])
+			if len(self._pending) - pos - 12 < length:
+				break
+			payload = self._pending[pos + 12:pos + 12 + length]
+			pos += 12 + length
+			if chunkid in ('SAMP', 'HIST', 'STAK'):
+				if len(payload) < 12:
+					Fatal('corrupted stream: truncated %s chunk' % chunkid)
+				(tid, codec, count) = struct.unpack(self.byteorder + 'IB3xI', payload[:12])
+				chunks.append((chunkid, tid, codec, count, payload[12:]))
+			else:
+				chunks.append((chunkid, 0, CODEC_RAW, 0, payload))
+		self._pending = self._pending[pos:]
+		return chunks
+
+class ProfileWriter:
+	# Reference PROFDAT2 writer, for tests and benchmarks that need captures
+	# without a device
+	def __init__(self, f, pcsize=4, byteorder='<'):
+		self._f = f
+		self._pcsize = pcsize
+		self._byteorder = byteorder
+		self._pcfmt = 'I' if pcsize == 4 else 'Q'
+		f.write('PROFDAT2')
+		f.write(struct.pack(byteorder + 'II', pcsize, 0))
+
+	def _chunk(self, chunkid, payload):
+		self._f.write(chunkid)
+		self._f.write(struct.pack(self._byteorder + 'Q', len(payload)))
+		self._f.write(payload)
+
+	def write_info(self, info):
+		self._chunk('INFO', ''.join(['%s=%s\n' % (k, info[k]) for k in sorted(info.keys())]))
+
+	def write_samples(self, pcs, tid=0, codec=CODEC_ZLIB):
+		for i in xrange(0, len(pcs), WRITER_CHUNK):
+			chunk = [int(pc) for pc in pcs[i:i + WRITER_CHUNK]]
+			if codec == CODEC_DELTA:
+				data = EncodeDeltas(chunk)
+			else:
+				data = struct.pack('%s%d%s' % (self._byteorder, len(chunk), self._pcfmt), *chunk)
+				if codec == CODEC_ZLIB:
+					data = zlib.compress(data)
+			self._chunk('SAMP', struct.pack(self._byteorder + 'IB3xI', tid, codec, len(chunk)) + data)
+
+	def write_stacks(self, stacks, tid=0, codec=CODEC_ZLIB):
+		# stacks is a list of (frames, haslr), frames leaf first
+		for i in xrange(0, len(stacks), WRITER_CHUNK):
+			words = []
+			for (frames, haslr) in stacks[i:i + WRITER_CHUNK]:
+				words.append(len(frames) | (STACK_LR_FLAG if haslr else 0))
+				words.extend([int(pc) for pc in frames])
+			data = struct.pack('%s%d%s' % (self._byteorder, len(words), self._pcfmt), *words)
+			if codec == CODEC_ZLIB:
+				data = zlib.compress(data)
+			count = len(stacks[i:i + WRITER_CHUNK])
+			self._chunk('STAK', struct.pack(self._byteorder + 'IB3xI', tid, codec, count) + data)
+
+	def write_histogram(self, counts, tid=0, codec=CODEC_ZLIB):
+		pairs = sorted(counts.items())
+		data = ''.join([struct.pack(self._byteorder + self._pcfmt + 'Q', pc, n) for (pc, n) in pairs])
+		if codec == CODEC_ZLIB:
+			data = zlib.compress(data)
+		self._chunk('HIST', struct.pack(self._byteorder + 'IB3xI', tid, codec, len(pairs)) + data)
+
+	def write_maps(self, maps):
+		self._chunk('MAPS', maps)
@@ -0,0 +1,109 @@
+import math
+
+from Profiler import *
+import Stats
+
+# Default regression gate: a symbol's share of the samples must grow by more
+# than this many percentage points...
+DEFAULT_THRESHOLD = 1.0
+# ...and the growth must be this many standard errors away from no change
+DEFAULT_Z = 3.0
+
+def ShareZ(basecount, basetotal, newcount, newtotal):
+	# Two-proportion z statistic for the change in a symbol's share of the
+	# samples. Samples are treated as independent draws, which overstates the
+	# significance of bursty behavior, so gate on a generous z.
+	if not basetotal or not newtotal:
+		return 0.0
+	pooled = float(basecount + newcount) / (basetotal + newtotal)
+	variance = pooled * (1 - pooled) * (1.0 / basetotal + 1.0 / newtotal)
+	if variance <= 0:
+		return 0.0
+	delta = float(newcount) / newtotal - float(basecount) / basetotal
+	return delta / math.sqrt(variance)
+
+class ProfileDiff:
+	# Compares two captures of the same workload, typically from two builds.
+	# Each capture gets its own module cache, so the base capture is never
+	# symbolized with the new build's copy of a library (or the other way
+	# round): the base build's files are basefiles, and libraries pulled for it
+	# go to a pull directory of their own. Work is only shared through the
+	# persistent symbol cache, which is keyed by build, so identical builds
+	# are only symbolized once.
+	def __init__(self, localfiles, basefile, newfile, jobs=1, basefiles=None):
+		Stats.Reset()
+		self.stats = {}
+		if basefiles is None:
+			basefiles = localfiles
+		self._newcache = ModCache(localfiles)
+		self._basecache = ModCache(basefiles, pulldir='base', symbolcache=self._newcache.get_symbolcache())
+		self._base = Profiler(basefiles, basefile, jobs, self._basecache)
+		self._new = Profiler(localfiles, newfile, jobs, self._newcache)
+
+	def get_deltas(self, lines=False):
+		# [(key, basecount, newcount, delta, z)], largest share increase first.
+		# Keys are (module, symbol), or (module, symbol, line) if lines is set;
+		# delta is the change in percent of each capture's samples.
+		if lines:
+			(basehits, newhits) = (self._base.get_line_hits(), self._new.get_line_hits())
+		else:
+			(basehits, newhits) = (self._base.get_symbol_hits(), self._new.get_symbol_hits())
+		basetotal = sum(basehits.values())
+		newtotal = sum(newhits.values())
+		deltas = []
+		for key in set(basehits.keys()) | set(newhits.keys()):
+			basecount = basehits.get(key, 0)
+			newcount = newhits.get(key, 0)
+			delta = 0.0
+			if basetotal:
+				delta -= 100.0 * basecount / basetotal
+			if newtotal:
+				delta += 100.0 * newcount / newtotal
+			deltas.append((key, basecount, newcount, delta, ShareZ(basecount, basetotal, newcount, newtotal)))
+		deltas.sort(key=lambda d: (-d[3], d[0]))
+		return deltas
+
+	def get_regressions(self, threshold=DEFAULT_THRESHOLD, z=DEFAULT_Z, lines=False):
+		# The deltas whose share grew by more than threshold percentage points
+		# with at least the given significance
+		return [d for d in self.get_deltas(lines) if d[3] > threshold and d[4] >= z]
+
+	@Stats.Timed('dump')
+	def dump_csv(self, f, lines=False):
+		basetotal = self._base.get_sample_count()
+		newtotal = self._new.get_sample_count()
+		print >> f, 'Capture,Samples,Seconds'
+		print >> f, 'base,%d,%0.3f' % (basetotal, self._base.get_seconds(basetotal))
+		print >> f, 'new,%d,%0.3f' % (newtotal, self._new.get_seconds(newtotal))
+
+		print >> f
+		deltas = self.get_deltas(lines)
+		self._new.demangle_many([key[1] for (key, basecount, newcount, delta, z) in deltas])
+		if lines:
+			print >> f, 'Module,Symbol,File,Line,Base Samples,Base Percent,New Samples,New Percent,Delta,Z'
+		else:
+			print >> f, 'Module,Symbol,Base Samples,Base Percent,New Samples,New Percent,Delta,Z'
+		basehits = sum([d[1] for d in deltas])
+		newhits = sum([d[2] for d in deltas])
+		for (key, basecount, newcount, delta, z) in deltas:
+			basepercent = 100.0 * basecount / basehits if basehits else 0.0
+			newpercent = 100.0 * newcount / newhits if newhits else 0.0
+			name = '%s,"%s"' % (key[0], self._new.demangle(key[1]))
+			if lines:
+				if key[2] == '<unknown>':
+					name += ',<unknown>,<unknown>'
+				else:
+					colon = key[2].rfind(':')
+					name += ',%s,%s' % (key[2][:colon], key[2][colon+1:])
+			print >> f, '%s,%d,%0.2f,%d,%0.2f,%+0.2f,%0.2f' % (name, basecount, basepercent, newcount, newpercent, delta, z)
+
+	def demangle(self, sym):
+		return self._new.demangle(sym)
+
+	def close(self):
+		self._base.close()
+		self._new.close()
+		self._basecache.close()
+		self._newcache.close()
+		self.stats.clear()
+		self.stats.update(Stats.Snapshot())
@@ -0,0 +1,162 @@
+from Profiler import *
+import Stats
+
+# Merged captures are symbolized in a synthetic address space where module i
+# is laid out at (i + 1) << MERGE_BASE_SHIFT plus the file offset, above any
+# real user-space address, so PCs outside every module keep their own value.
+MERGE_BASE_SHIFT = 48
+
+def HistogramCapture(profiledatafile):
+	# Worker process entry point: histogram one capture, with each PC turned
+	# into (module, file offset) so captures with different load addresses
+	# line up. PCs outside every module become (None, pc).
+	profile = ProfileData(profiledatafile)
+	mapindex = AddressMap()
+	mappings = []
+	for (begin, end, offset, perm, modpath) in ParseMaps(profile.get_maps()):
+		mapindex.add(begin, end, modpath, offset - begin)
+		mappings.append((modpath, offset, end - begin, perm))
+	mapindex.build()
+	def normalize(pcs):
+		keys = []
+		for (pc, hit) in zip(pcs, mapindex.lookup_many(pcs)):
+			if hit is None:
+				keys.append((None, pc))
+			else:
+				(modpath, mapping, tweak) = hit
+				keys.append((modpath, pc + tweak))
+		return keys
+	pchits = profile.histogram()
+	hits = dict(zip(normalize(pchits.keys()), pchits.values()))
+	stacks = {}
+	if profile.has_stacks():
+		for ((frames, haslr), count) in profile.stack_histogram().items():
+			key = (tuple(normalize(frames)), haslr)
+			stacks[key] = stacks.get(key, 0) + count
+	capture = {'path': profiledatafile, 'version': profile.version, 'pcsize': profile.pcsize,
+		'nsamps': profile.nsamps, 'clock': profile.get_clock(), 'frequency': profile.get_frequency(),
+		'dropped': int(profile.info.get('dropped', 0)), 'hits': hits, 'stacks': stacks, 'mappings': mappings}
+	profile.close()
+	return capture
+
+class ProfileMerge(Profiler):
+	# One report over many captures of the same program (different devices,
+	# sessions or processes). Each capture is histogrammed in its own worker
+	# process and normalized to module file offsets; the union of the distinct
+	# locations is then symbolized once, as a single profile.
+	def __init__(self, localfiles, profiledatafiles, jobs=1, modcache=None, top=None, coverage=None):
+		Profiler.__init__(self, localfiles, profiledatafiles, jobs, modcache, top, coverage)
+
+	@Stats.Timed('parse')
+	def _parseprofile(self, profiledatafiles):
+		if self._jobs > 1 and len(profiledatafiles) > 1:
+			pool = multiprocessing.Pool(min(self._jobs, len(profiledatafiles)))
+			try:
+				captures = pool.map(HistogramCapture, profiledatafiles)
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			captures = [HistogramCapture(f) for f in profiledatafiles]
+
+		self._version = max([c['version'] for c in captures])
+		self._byteorder = None
+		self._pcsize = max([c['pcsize'] for c in captures])
+		self._nsamps = sum([c['nsamps'] for c in captures])
+		self._info = {}
+		# Thread ids from different processes have nothing to do with each other
+		self._threadsamples = {}
+		clocks = set([c['clock'] for c in captures])
+		if len(clocks) > 1:
+			Warning('merging captures taken with different clocks (%s)' % ', '.join(sorted(clocks)))
+		self._clock = '/'.join(sorted(clocks))
+		# The frequency that gives the total of the captures' own durations
+		seconds = sum([c['nsamps'] / c['frequency'] for c in captures])
+		self._frequency = self._nsamps / seconds if seconds > 0 else DEFAULT_FREQUENCY
+		dropped = sum([c['dropped'] for c in captures])
+		if dropped:
+			Warning('%d samples were dropped during capture' % dropped)
+
+		# Lay the modules out in the synthetic address space, with every
+		# executable range of the file that any capture mapped
+		modpaths = sorted(set([m[0] for c in captures for m in c['mappings']]))
+		self._mergebases = dict([(modpath, (i + 1) << MERGE_BASE_SHIFT) for (i, modpath) in enumerate(modpaths)])
+		ranges = {}
+		for c in captures:
+			for (modpath, offset, size, perm) in c['mappings']:
+				key = (modpath, offset)
+				ranges[key] = (max(size, ranges.get(key, (0, perm))[0]), perm)
+		# [offset, end, perm, modpath] per synthetic mapping
+		layout = []
+		last = {}
+		for ((modpath, offset), (size, perm)) in sorted(ranges.items()):
+			# Ranges must not overlap; one that starts inside the previous range
+			# of its module only extends it (a single mapping is linear in the
+			# file, so the previous range's translation holds for the rest)
+			previous = last.get(modpath)
+			if previous is not None and previous[1] > offset:
+				previous[1] = max(previous[1], offset + size)
+				continue
+			last[modpath] = [offset, offset + size, perm, modpath]
+			layout.append(last[modpath])
+		maps = []
+		for (offset, end, perm, modpath) in layout:
+			base = self._mergebases[modpath]
+			maps.append('%x-%x %s %08x 00:00 0 %s' % (base + offset, base + end, perm, offset, modpath))
+		self._parsemaps('\n'.join(maps))
+
+		self._captures = []
+		self._pchits = {}
+		self._stackhits = {}
+		for c in captures:
+			hits = {}
+			for (key, count) in c['hits'].items():
+				pc = self._mergepc(key)
+				hits[pc] = hits.get(pc, 0) + count
+				self._pchits[pc] = self._pchits.get(pc, 0) + count
+			for ((frames, haslr), count) in c['stacks'].items():
+				key = (tuple([self._mergepc(frame) for frame in frames]), haslr)
+				self._stackhits[key] = self._stackhits.get(key, 0) + count
+			self._captures.append((c['path'], c['nsamps'], c['clock'], c['frequency'], c['dropped'], hits))
+		Stats.Count('captures', len(captures))
+		Stats.Count('pcs.total', self._nsamps)
+		Stats.Count('pcs.unique', len(self._pchits))
+
+	def get_timeline(self):
+		Fatal('time windows need a single capture')
+
+	def _mergepc(self, key):
+		(modpath, offset) = key
+		if modpath is None:
+			return offset
+		return self._mergebases[modpath] + offset
+
+	def get_capture_symbol_hits(self):
+		# [(path, {(module, symbol): samples})], one per capture
+		result = []
+		for (path, nsamps, clock, frequency, dropped, hits) in self._captures:
+			counter = HitCounter()
+			for (pc, count) in hits.items():
+				counter.hit(self._symbolkey(pc), count)
+			result.append((path, dict([(key, count) for (count, key) in counter.get_hits()])))
+		return result
+
+	@Stats.Timed('dump')
+	def dump_captures(self, f):
+		# The share of each capture in the total, then each capture's symbols
+		print >> f, 'Capture,Samples,Percent,Clock,Frequency,Seconds,Dropped'
+		for (path, nsamps, clock, frequency, dropped, hits) in self._captures:
+			percent = 100.0 * nsamps / self._nsamps if self._nsamps else 0.0
+			print >> f, '%s,%d,%0.2f,%s,%g,%0.3f,%d' % (path, nsamps, percent, clock, frequency, nsamps / frequency, dropped)
+
+		print >> f
+		print >> f, 'Capture,Module,Symbol,Samples,Percent'
+		for (path, symhits) in self.get_capture_symbol_hits():
+			symhits = [(count, key) for (key, count) in symhits.items()]
+			self.demangle_many([sym for (count, (modname, sym)) in symhits])
+			symhits.sort()
+			symhits.reverse()
+			total = sum([count for count, x in symhits])
+			for (count, (modname, sym)) in symhits:
+				percent = 100.0 * count / total
+				print >> f, '%s,%s,"%s",%d,%0.2f' % (path, modname, self.demangle(sym), count, percent)
@@ -1,17 +1,113 @@
+import heapq
 import struct
-import array
 import re
+import multiprocessing
 
 from Module import *
+from SymbolResolver import *
+from LineResolver import *
+from SymbolCache import *
+from AddressMap import *
 from ModCache import *
 from Demangler import *
 from HitCounter import *
+from SampleData import *
+from ProfileData import *
+from Timeline import *
 from Message import *
+import Stats
+
+class WorkerModCache:
+	# Stands in for ModCache inside symbolization worker processes. The parent
+	# has already fetched the module, so only its local path is needed.
+	def __init__(self, remotepath, localpath, cachepath):
+		self._remotepath = remotepath
+		self._localpath = localpath
+		self._symbolcache = SymbolCache(cachepath)
+		
+	def get(self, filename, fresh=False):
+		if filename == self._remotepath:
+			return self._localpath
+		return None
+		
+	def get_symbolcache(self):
+		return self._symbolcache
+		
+	def close(self):
+		# Eviction is left to the parent, which knows every module in use
+		self._symbolcache.close(evict=False)
+
+def ParseMaps(maps):
+	# The executable mappings of /proc/<pid>/maps text that may hold code to
+	# symbolize, as [(begin, end, offset, perm, modpath)]
+	mappings = []
+	mapre = re.compile(r'([0-9a-fA-F]+)-([0-9a-fA-F]+)\s+(....)\s+([0-9a-fA-F]+)\s+\S+\s+\S+\s+(.+)')
+	for ml in maps.split('\n'):
+		mat = mapre.match(ml)
+		if mat:
+			begin = long(mat.group(1), 16)
+			end = long(mat.group(2), 16)
+			perm = mat.group(3)
+			offset = long(mat.group(4), 16)
+			modpath = mat.group(5)
+			# Exclude unacceptable modules
+			if perm[2] != 'x':
+				continue
+			if modpath[:5] == '/dev/':
+				continue
+			if modpath == '[vectors]':
+				continue
+			if modpath == '[sigpage]':
+				continue
+			mappings.append((begin, end, offset, perm, modpath))
+	return mappings
+
+def ResolveModuleVMAs(job):
+	# Worker process entry point: resolve a batch of VMAs in one module, with
+	# resolvers private to this process. Returns the symbols and the lines of
+	# the VMAs (None for whichever wasn't asked for) and the counters the work
+	# added.
+	(remotepath, localpath, cachepath, vmas, symbols, lines) = job
+	# Workers are forked with the parent's counters, and reused across jobs
+	Stats.Reset()
+	modcache = WorkerModCache(remotepath, localpath, cachepath)
+	(syms, vmalines) = (None, None)
+	if symbols:
+		symbol_resolver = SymbolResolver(remotepath, modcache)
+		syms = symbol_resolver.resolve_many(vmas)
+		symbol_resolver.close()
+	if lines:
+		line_resolver = LineResolver(remotepath, modcache)
+		vmalines = line_resolver.resolve_many(vmas)
+		line_resolver.close()
+	modcache.close()
+	return ((syms, vmalines), Stats.Counters())
 
 class Profiler:
-	def __init__(self, localfiles, profiledatafile):
-		self._modcache = ModCache(localfiles)
+	def __init__(self, localfiles, profiledatafile, jobs=1, modcache=None, top=None, coverage=None):
+		# A modcache passed in is shared with other Profilers (and closed by
+		# its owner), so modules and their symbolization results are reused
+		# across captures. Such a Profiler is part of a larger run, which
+		# resets the statistics itself.
+		#
+		# With top (a number of symbols) and/or coverage (a percentage of the
+		# samples), only the hottest symbols are reported, and source lines
+		# are only resolved for the PCs inside them.
+		self._top = top
+		self._coverage = coverage
+		self._hot = None
+		self._ownmodcache = modcache is None
+		if self._ownmodcache:
+			modcache = ModCache(localfiles)
+			Stats.Reset()
+		# Phase times and counters for this run, refreshed on close
+		self.stats = {}
+		self._jobs = jobs
+		self._modcache = modcache
 		self._modules = {}
+		self._modmaps = {}
+		self._mapindex = AddressMap()
+		self._addrmap = AddressMap()
 		self._symcache = {}
 		self._linecache = {}
 		self._vmacache = {}
@@ -21,144 +117,334 @@ class Profiler:
 		self._vmahitcounter = HitCounter()
 		self._symhitcounter = HitCounter()
 		self._combinedhitcounter = HitCounter()
+		self._inclusivehitcounter = HitCounter()
+		self._foldedhitcounter = HitCounter()
+		self._timeline = None
 
 		self._parseprofile(profiledatafile)
 		self._buildhits()
+		self._buildstacks()
+		self._updatestats()
+		
+	def _updatestats(self):
+		self.stats.clear()
+		self.stats.update(Stats.Snapshot())
 		
+	@Stats.Timed('parse')
 	def _parseprofile(self, profiledatafile):
-		f = open(profiledatafile, 'rb')
-		chunkid = f.read(8)
-		
-		# Read the PROFDAT1 chunk which contains the PC samples
-		if chunkid != 'PROFDAT1':
-			Fatal('corrupted file: bad chunk ID (expected PROFDAT1)')
-		pcsize = f.read(4)
-		if len(pcsize) != 4:
-			Fatal('corrupted file: too short')
-		self._pcsize = struct.unpack('<I', pcsize)[0]
-		if self._pcsize != 4 and self._pcsize != 8:
-			Fatal('corrupted file: crazy PC size')
-		nsamps = f.read(8)
-		if len(nsamps) != 8:
-			Fatal('corrupted file: too short')
-		self._nsamps = struct.unpack('<Q', nsamps)[0]
-		# Read the actual samples
-		if self._pcsize != 4:
-			# This is irritating. array.array doesn't support 64-bit integers.
-			Fatal('64-bit Android is not supported yet')
-		samps = array.array('L')
-		try:
-			samps.fromfile(f, self._nsamps)
-		except Exception as e:
-			Fatal('corrupted file: %s' % e)
-		self._samples = samps.tolist()
-		
-		# Read the MAPSDATA chunk which contains the mapping information
-		mapsid = f.read(8)
-		if mapsid != 'MAPSDATA':
-			Fatal('corrupted file: no MAPSDATA chunk')
-		# Next 4 bytes supposed to contain the size of MAPSDATA, but they aren't written correctly
-		# by libAprof yet. So we ignore them, and read to end of file.
-		if len(f.read(4)) != 4:
-			Fatal('corrupted file: too short')
-		maps = f.read()
-		
-		self._parsemaps(maps)
+		# ProfileData reads both PROFDAT1 and PROFDAT2 captures
+		self._profiledatafile = profiledatafile
+		profile = ProfileData(profiledatafile)
+		self._version = profile.version
+		self._byteorder = profile.byteorder
+		self._pcsize = profile.pcsize
+		self._nsamps = profile.nsamps
+		self._info = profile.info
+		self._threadsamples = profile.get_thread_samples()
+		self._clock = profile.get_clock()
+		self._frequency = profile.get_frequency()
+		if int(self._info.get('dropped', 0)):
+			Warning('%s samples were dropped during capture' % self._info['dropped'])
+		self._parsemaps(profile.get_maps())
+		
+		# The histogram streams the samples a window at a time (or uses the
+		# capture's own histogram), so memory use depends on the number of
+		# distinct PCs, not the capture length
+		self._pchits = profile.histogram()
+		Stats.Count('pcs.total', self._nsamps)
+		Stats.Count('pcs.unique', len(self._pchits))
+		# Stack samples, as counts per distinct stack
+		self._stackhits = {}
+		if profile.has_stacks():
+			self._stackhits = profile.stack_histogram()
+		profile.close()
 		
 	def _buildhits(self):
-		# Build the hit tables for module, symbol, and line
-		for pc in self._samples:
-			vma = self.get_vma(pc)
+		# Collapse the samples into (PC, count) pairs first. Captures contain far
+		# fewer distinct PCs than samples, so each PC is only resolved once.
+		if self._top is None and self._coverage is None:
+			self._addhits(self._pchits)
+			return
+		# Symbols first; lines (the expensive part) only for the hot symbols
+		self._addhits(self._pchits, lines=False)
+		self._hot = self._selecthot()
+		hot = set(self._hot)
+		self._addlines(dict([(pc, count) for (pc, count) in self._pchits.items() if self._symbolkey(pc) in hot]))
+	
+	@Stats.Timed('aggregate')
+	def _addhits(self, pchits, lines=True):
+		# Count {pc: count} into the module and symbol tables, and the line
+		# tables if lines is set. PCs that were resolved before are not
+		# resolved again.
+		self._resolve(pchits.keys(), lines)
+		# Every PC is in the caches now, so read them directly
+		symcache = self._symcache
+		for (pc, count) in pchits.items():
+			(mod, sym) = symcache[pc]
+			mod = mod or '<unknown>'
+			self._modhitcounter.hit(mod, count)
+			self._symhitcounter.hit((mod, sym or '<unknown>'), count)
+		if lines:
+			self._addlines(pchits)
+	
+	@Stats.Timed('aggregate')
+	def _addlines(self, pchits):
+		# Count {pc: count} into the line and VMA tables
+		self._resolve(pchits.keys())
+		(symcache, vmacache, linecache) = (self._symcache, self._vmacache, self._linecache)
+		for (pc, count) in pchits.items():
+			vma = vmacache[pc] if vmacache.has_key(pc) else self.get_vma(pc)
 			# If VMA can't be resolved, it means PC was in a region we don't
 			# know about. The module is probably unknown. Use PC directly
 			# as the key in this case.
 			if vma is None:
 				vma = pc
-			(mod, sym) = self.get_symbol(pc)
-			line = self.get_line(pc)
-			if not mod:
-				mod = '<unknown>'
-			if not sym:
-				sym = '<unknown>'
+			(mod, sym) = symcache[pc]
+			(mod, sym) = (mod or '<unknown>', sym or '<unknown>')
+			line = linecache[pc]
 			if not line:
 				line = '<unknown>'
-			self._modhitcounter.hit(mod)
-			self._vmahitcounter.hit((mod, sym, line, vma))
-			self._symhitcounter.hit((mod, sym))
-			self._combinedhitcounter.hit((mod, sym, line))
+			self._vmahitcounter.hit((mod, sym, line, vma), count)
+			self._combinedhitcounter.hit((mod, sym, line), count)
+	
+	def _symbolkey(self, pc):
+		(mod, sym) = self.get_symbol(pc)
+		return (mod or '<unknown>', sym or '<unknown>')
+	
+	def _selecthot(self):
+		# The hottest symbols, most samples first: the top ones, or as many as
+		# it takes to cover the given percentage of the samples (but no more
+		# than top). Only the selected symbols come off the heap.
+		symhits = self._symhitcounter.get_hits()
+		if self._coverage is None:
+			return [key for (count, key) in heapq.nlargest(self._top, symhits)]
+		heap = [(-count, key) for (count, key) in symhits]
+		heapq.heapify(heap)
+		target = sum([count for (count, key) in symhits]) * self._coverage / 100.0
+		hot = []
+		covered = 0
+		while heap and covered < target and (self._top is None or len(hot) < self._top):
+			(count, key) = heapq.heappop(heap)
+			covered -= count
+			hot.append((-count, key))
+		hot.sort()
+		hot.reverse()
+		return [key for (count, key) in hot]
+	
+	@Stats.Timed('aggregate')
+	def _buildstacks(self):
+		# Resolve each distinct frame of the distinct stacks once, then count
+		# every symbol on a stack as inclusive time and collapse the stacks for
+		# folded output. Exclusive time is the flat per-symbol count.
+		if not self._stackhits:
+			return
+		frames = set()
+		for (stack, haslr) in self._stackhits.keys():
+			frames.update(self._stackframes(stack))
+		self._resolve(frames)
+		for ((stack, haslr), count) in self._stackhits.items():
+			syms = []
+			for pc in self._stackframes(stack):
+				(mod, sym) = self.get_symbol(pc)
+				syms.append((mod or '<unknown>', sym or '<unknown>'))
+			# A link register that points into the sampled function is left over
+			# from a call it already returned from, not its caller
+			if haslr and len(syms) > 1 and syms[1] == syms[0]:
+				del syms[1]
+			for key in set(syms):
+				self._inclusivehitcounter.hit(key, count)
+			syms.reverse()
+			self._foldedhitcounter.hit(tuple(syms), count)
+	
+	def _stackframes(self, stack):
+		# The callers' frames are return addresses, which point after the call;
+		# look up the call itself, which might be the last instruction of its
+		# function
+		return stack[:1] + tuple([pc - 1 for pc in stack[1:]])
+	
+	@Stats.Timed('symbolize')
+	def _resolve(self, pcs, lines=True):
+		# Resolve a batch of PCs into the VMA, symbol and (if lines is set) line
+		# caches. The PCs are grouped by module so that each module's resolvers
+		# handle a single batch.
+		pcs = list(pcs)
+		total = len(pcs)
+		pcs = [pc for pc in pcs if not self._symcache.has_key(pc) or (lines and not self._linecache.has_key(pc))]
+		Stats.Count('symcache.hit', total - len(pcs))
+		Stats.Count('symcache.miss', len(pcs))
+		self._loadmodules(pcs)
+		bymodule = {}
+		for (pc, hit) in zip(pcs, self._addrmap.lookup_many(pcs)):
+			if hit is None:
+				self._vmacache[pc] = None
+				self._symcache[pc] = (None, None)
+				self._linecache[pc] = None
+				continue
+			(m, mapping, tweak) = hit
+			bymodule.setdefault(m.get_path(), (m, []))[1].append((pc, pc + tweak))
+		symbolcache = self._modcache.get_symbolcache()
+		# {modname: {vma: sym}} and {modname: {vma: line}}
+		(resolvedsyms, resolvedlines) = ({}, {})
+		jobs = []
+		for modname in sorted(bymodule.keys()):
+			(m, pairs) = bymodule[modname]
+			# Results from earlier runs on the same build need no resolving, and
+			# go straight into the caches
+			key = m.get_cache_key()
+			cached = {}
+			if key is not None:
+				cached = symbolcache.get_results(key)
+			missing = []
+			for (pc, vma) in pairs:
+				result = cached.get(vma)
+				if result is None:
+					missing.append((pc, vma))
+					continue
+				self._vmacache[pc] = vma
+				self._symcache[pc] = (modname, result[0])
+				self._linecache[pc] = result[1]
+			Stats.Count('symbolcache.hit', len(pairs) - len(missing))
+			Stats.Count('symbolcache.miss', len(missing))
+			bymodule[modname] = (m, missing)
+			resolvedsyms[modname] = {}
+			resolvedlines[modname] = {}
+			for (pc, vma) in missing:
+				if self._symcache.has_key(pc):
+					resolvedsyms[modname][vma] = self._symcache[pc][1]
+			vmas = sorted(set([vma for (pc, vma) in missing]))
+			if vmas:
+				symbols = len([vma for vma in vmas if not resolvedsyms[modname].has_key(vma)]) > 0
+				jobs.append((modname, m, key, vmas, symbols, lines))
+		if self._jobs > 1 and len(jobs) > 1:
+			# Modules are independent, so resolve each one in its own worker
+			# process. Results come back in job order, so the merge is
+			# deterministic.
+			symbolcache.commit()
+			pool = multiprocessing.Pool(min(self._jobs, len(jobs)))
+			try:
+				results = pool.map(ResolveModuleVMAs, [(modname, self._modcache.get(modname), self._modcache.get_cachepath(), vmas, symbols, lines)
+					for (modname, m, key, vmas, symbols, lines) in jobs])
+			finally:
+				pool.close()
+				pool.join()
+			for (result, counters) in results:
+				Stats.Merge(counters)
+			results = [result for (result, counters) in results]
+		else:
+			results = [(m.get_vma_symbols(vmas) if symbols else None, m.get_vma_lines(vmas) if lines else None)
+				for (modname, m, key, vmas, symbols, lines) in jobs]
+		for ((modname, m, key, vmas, symbols, lines), (syms, vmalines)) in zip(jobs, results):
+			if syms is not None:
+				resolvedsyms[modname].update(zip(vmas, syms))
+			if vmalines is not None:
+				resolvedlines[modname].update(zip(vmas, vmalines))
+				# Only complete results are kept across runs
+				if key is not None:
+					symbolcache.put_results(key, [(vma, resolvedsyms[modname][vma], line) for (vma, line) in zip(vmas, vmalines)])
+		for modname in sorted(bymodule.keys()):
+			(m, pairs) = bymodule[modname]
+			for (pc, vma) in pairs:
+				self._vmacache[pc] = vma
+				self._symcache[pc] = (modname, resolvedsyms[modname][vma])
+				if resolvedlines[modname].has_key(vma):
+					self._linecache[pc] = resolvedlines[modname][vma]
 	
 	def get_symbol(self, addr):
 		if self._symcache.has_key(addr):
+			Stats.Count('symcache.hit')
 			return self._symcache[addr]
-		containing_mod = None
-		for (modname, m) in self._modules.items():
-			# Try to get the VMA of this address, so we can at least report which module the symbol comes
-			# from
-			vma = m.get_vma(addr)
-			if vma is not None:
-				# VMA lookup succeeded, so remember this as the right module
-				containing_mod = modname
-			sym = m.get_symbol(addr)
-			if sym:
-				self._symcache[addr] = (modname, sym)
-				return (modname, sym)
-		result = (containing_mod, None)
+		Stats.Count('symcache.miss')
+		self._loadmodules([addr])
+		result = (None, None)
+		hit = self._addrmap.lookup(addr)
+		if hit is not None:
+			(m, mapping, tweak) = hit
+			result = (m.get_path(), m.get_vma_symbol(addr + tweak))
 		self._symcache[addr] = result
 		return result
 
 	def get_line(self, addr):
 		if self._linecache.has_key(addr):
+			Stats.Count('linecache.hit')
 			return self._linecache[addr]
-		for (modname, m) in self._modules.items():
-			line = m.get_line(addr)
-			if line:
-				self._linecache[addr] = line
-				return line
-		self._linecache[addr] = None
-		return None
+		Stats.Count('linecache.miss')
+		self._loadmodules([addr])
+		line = None
+		hit = self._addrmap.lookup(addr)
+		if hit is not None:
+			(m, mapping, tweak) = hit
+			line = m.get_vma_line(addr + tweak)
+		self._linecache[addr] = line
+		return line
 	
 	def get_vma(self, addr):
 		if self._vmacache.has_key(addr):
 			return self._vmacache[addr]
+		self._loadmodules([addr])
 		vma = None
-		for (modname, m) in self._modules.items():
-			vma = m.get_vma(addr)
-			if vma is not None:
-				break
+		hit = self._addrmap.lookup(addr)
+		if hit is not None:
+			(m, mapping, tweak) = hit
+			vma = addr + tweak
 		self._vmacache[addr] = vma
 		return vma
 	
+	@Stats.Timed('demangle')
+	def demangle_many(self, syms):
+		unique = set(syms)
+		missing = [sym for sym in unique if not self._demanglecache.has_key(sym)]
+		Stats.Count('demanglecache.hit', len(unique) - len(missing))
+		Stats.Count('demanglecache.miss', len(missing))
+		symbolcache = self._modcache.get_symbolcache()
+		self._demanglecache.update(symbolcache.get_demangled(missing))
+		stored = len(missing)
+		missing = [sym for sym in missing if not self._demanglecache.has_key(sym)]
+		Stats.Count('demangledb.hit', stored - len(missing))
+		Stats.Count('demangledb.miss', len(missing))
+		demangled = zip(missing, self._demangler.demangle_many(missing))
+		self._demanglecache.update(demangled)
+		symbolcache.put_demangled(demangled)
+		return [self._demanglecache[sym] for sym in syms]
+	
 	def demangle(self, sym):
 		if self._demanglecache.has_key(sym):
+			Stats.Count('demanglecache.hit')
 			return self._demanglecache[sym]
+		Stats.Count('demanglecache.miss')
 		dsym = self._demangler.demangle(sym)
 		self._demanglecache[sym] = dsym
 		return dsym
 		
+	@Stats.Timed('maps')
 	def _parsemaps(self, maps):
-		# Parse the maps
-		mapre = re.compile(r'([0-9a-fA-F]+)-([0-9a-fA-F]+)\s+(....)\s+([0-9a-fA-F]+)\s+\S+\s+\S+\s+(.+)')
-		for ml in maps.split('\n'):
-			mat = mapre.match(ml)
-			if mat:
-				begin = long(mat.group(1), 16)
-				end = long(mat.group(2), 16)
-				perm = mat.group(3)
-				offset = long(mat.group(4), 16)
-				modpath = mat.group(5)
-				# Exclude unacceptable modules
-				if perm[2] != 'x':
-					continue
-				if modpath[:5] == '/dev/':
-					continue
-				if modpath == '[vectors]':
-					continue
-				if modpath == '[sigpage]':
-					continue
-				if modpath not in self._modules:
-					self._modules[modpath] = Module(modpath, self._modcache)
-				self._modules[modpath].add_map(begin, end, offset, perm)
+		for (begin, end, offset, perm, modpath) in ParseMaps(maps):
+			# Only record the mapping here. The Module (and the pull and ELF
+			# parsing that go with it) is created later, if any PC lands in it.
+			self._modmaps.setdefault(modpath, []).append((begin, end, offset, perm))
+			self._mapindex.add(begin, end, modpath, 0)
+		self._mapindex.build()
+	
+	@Stats.Timed('load')
+	def _loadmodules(self, pcs):
+		# Create the Module for every not-yet-loaded module that owns one of the
+		# PCs, and index its mappings so PCs can be translated to VMAs
+		needed = set()
+		for hit in self._mapindex.lookup_many(pcs):
+			if hit is not None and not self._modules.has_key(hit[0]):
+				needed.add(hit[0])
+		if not needed:
+			return
+		self._modcache.prefetch(sorted(needed))
+		for modpath in sorted(needed):
+			m = Module(modpath, self._modcache)
+			for (begin, end, offset, perm) in self._modmaps[modpath]:
+				m.add_map(begin, end, offset, perm)
+			self._modules[modpath] = m
+			for (begin, end, tweak) in m.get_mappings():
+				self._addrmap.add(begin, end, m, tweak)
+		self._addrmap.build()
 		
+	@Stats.Timed('dump')
 	def dump_csv(self, f):
 		print >> f, 'Module,Samples,Percent'
 		modhits = self._modhitcounter.get_hits()
@@ -173,20 +459,44 @@ class Profiler:
 		print >> f
 		print >> f, 'Module,Symbol,Samples,Percent'
 		symhits = self._symhitcounter.get_hits()
-		symhits.sort()
-		symhits.reverse()
-		total = sum([count for count, x in symhits])
+		# Every table's percentages are of all the samples, whether or not
+		# the table is limited to the hot symbols
+		symtotal = sum([count for count, x in symhits])
+		if self._hot is not None:
+			exclusive = dict([(key, count) for (count, key) in symhits])
+			symhits = [(exclusive[key], key) for key in self._hot]
+		else:
+			symhits.sort()
+			symhits.reverse()
+		self.demangle_many([sym for (count, (modname, sym)) in symhits])
+		total = symtotal
 		if total > 0:
 			for (count, (modname, sym)) in symhits:
 				percent = 100.0 * count / total
 				print >> f, '%s,"%s",%d,%0.2f' % (modname, self.demangle(sym), count, percent)
 				
+		if self._stackhits:
+			print >> f
+			print >> f, 'Module,Symbol,Inclusive,Exclusive,Inclusive Percent'
+			exclusive = dict([(key, count) for (count, key) in self._symhitcounter.get_hits()])
+			inclhits = self._inclusivehitcounter.get_hits()
+			if self._hot is not None:
+				inclhits = heapq.nlargest(len(self._hot), inclhits)
+			else:
+				inclhits.sort()
+				inclhits.reverse()
+			self.demangle_many([sym for (count, (modname, sym)) in inclhits])
+			total = sum(self._stackhits.values())
+			for (count, (modname, sym)) in inclhits:
+				percent = 100.0 * count / total
+				print >> f, '%s,"%s",%d,%d,%0.2f' % (modname, self.demangle(sym), count, exclusive.get((modname, sym), 0), percent)
+				
 		print >> f
 		print >> f, 'Module,Symbol,File,Line,Samples,Percent'
 		combhits = self._combinedhitcounter.get_hits()
 		combhits.sort()
 		combhits.reverse()
-		total = sum([count for count, x in combhits])
+		total = symtotal
 		if total > 0:
 			for (count, (modname, sym, line)) in combhits:
 				if line == '<unknown>':
@@ -202,7 +512,7 @@ class Profiler:
 		vmahits = self._vmahitcounter.get_hits()
 		vmahits.sort()
 		vmahits.reverse()
-		total = sum([count for count, x in vmahits])
+		total = symtotal
 		if total > 0:
 			for (count, (modname, sym, line, vma)) in vmahits:
 				if line == '<unknown>':
@@ -215,9 +525,88 @@ class Profiler:
 					print >> f, '%s,"%s",%s,%s,<unknown>,%d,%0.2f' % (modname, self.demangle(sym), file, line, count, percent)
 				else:
 					print >> f, '%s,"%s",%s,%s,0x%x,%d,%0.2f' % (modname, self.demangle(sym), file, line, vma, count, percent)
+		
+		if self._version >= 2 and self._threadsamples:
+			# Only PROFDAT2 captures know which thread took each sample
+			print >> f
+			print >> f, 'Thread,Samples,Percent,Seconds'
+			threadhits = [(count, tid) for (tid, count) in self._threadsamples.items()]
+			threadhits.sort()
+			threadhits.reverse()
+			total = sum([count for count, x in threadhits])
+			if total > 0:
+				for (count, tid) in threadhits:
+					percent = 100.0 * count / total
+					print >> f, '%d,%d,%0.2f,%0.3f' % (tid, count, percent, self.get_seconds(count))
+		
+		print >> f
+		print >> f, 'Clock,Frequency,Samples,Seconds'
+		print >> f, '%s,%g,%d,%0.3f' % (self._clock, self._frequency, self._nsamps, self.get_seconds(self._nsamps))
+		
+		print >> f
+		print >> f, 'Modules mapped,Modules loaded,Modules skipped'
+		print >> f, '%d,%d,%d' % (len(self._modmaps), len(self._modules), len(self._modmaps) - len(self._modules))
 				
+	@Stats.Timed('dump')
+	def dump_folded(self, f):
+		# Collapsed stacks, root first, one per line with its sample count (the
+		# input format of flame graph tools)
+		foldedhits = self._foldedhitcounter.get_hits()
+		self.demangle_many([sym for (count, stack) in foldedhits for (modname, sym) in stack])
+		lines = []
+		for (count, stack) in foldedhits:
+			names = []
+			for (modname, sym) in stack:
+				if sym == '<unknown>':
+					names.append('[%s]' % modname.split('/')[-1].strip('<>'))
+				else:
+					names.append(self.demangle(sym).replace(';', ':'))
+			lines.append('%s %d' % (';'.join(names), count))
+		lines.sort()
+		for l in lines:
+			print >> f, l
+		
+	@Stats.Timed('timeline')
+	def get_timeline(self):
+		# Per-symbol counts over time ranges of the capture, built on first use
+		if self._timeline is None:
+			self._timeline = Timeline(self._profiledatafile, self._symbolkey)
+		return self._timeline
+		
+	@Stats.Timed('dump')
+	def dump_windows(self, f, window, step, start=0.0, end=None, n=DEFAULT_WINDOW_TOP):
+		# The top n symbols of each window of the given length, every step
+		# seconds, between start and end
+		timeline = self.get_timeline()
+		windows = list(timeline.iter_windows(window, step, start, end, n))
+		self.demangle_many([sym for (wstart, wend, total, top) in windows for (count, (modname, sym)) in top])
+		print >> f, 'Start,End,Window Samples,Module,Symbol,Samples,Percent'
+		for (wstart, wend, total, top) in windows:
+			for (count, (modname, sym)) in top:
+				percent = 100.0 * count / total
+				print >> f, '%0.3f,%0.3f,%d,%s,"%s",%d,%0.2f' % (wstart, wend, total, modname, self.demangle(sym), count, percent)
+		
+	def get_symbol_hits(self):
+		# {(module, symbol): samples}
+		return dict([(key, count) for (count, key) in self._symhitcounter.get_hits()])
+		
+	def get_line_hits(self):
+		# {(module, symbol, line): samples}
+		return dict([(key, count) for (count, key) in self._combinedhitcounter.get_hits()])
+		
+	def get_sample_count(self):
+		return self._nsamps
+		
+	def get_seconds(self, count):
+		# Estimated time represented by count samples: CPU time for the prof and
+		# thread clocks, elapsed time (summed over threads) for the wall clock
+		return count / self._frequency
+		
 	def close(self):
 		for m in self._modules.values():
 			m.close()
 		self._modules = {}
 		self._demangler.close()
+		if self._ownmodcache:
+			self._modcache.close()
+		self._updatestats()
@@ -0,0 +1,107 @@
+import array
+import mmap
+import struct
+import sys
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from Message import *
+
+# Number of samples handled at a time when building histograms. Keeps the
+# temporary arrays used by the counting code at a bounded size.
+COUNT_CHUNK = 1 << 22
+
+NATIVE_ORDER = '<' if sys.byteorder == 'little' else '>'
+
+def ByteOrder(pcsizebytes):
+	# The PC size field is written in the byte order of the profiled process, so
+	# it also tells us the byte order of everything that follows it.
+	if struct.unpack('<I', pcsizebytes)[0] in (4, 8):
+		return '<'
+	if struct.unpack('>I', pcsizebytes)[0] in (4, 8):
+		return '>'
+	return None
+
+def ArrayTypecode(pcsize):
+	# Find an array.array typecode that holds exactly one PC. Which typecodes
+	# are 8 bytes wide depends on the platform (and Python 2 has no 'Q').
+	for tc in 'ILQ':
+		try:
+			if array.array(tc).itemsize == pcsize:
+				return tc
+		except ValueError:
+			pass
+	return None
+
+def LoadSamples(f, pcsize, nsamps, byteorder):
+	# Load nsamps PCs of pcsize bytes starting at the current position of f.
+	# Returns a typed array (numpy.ndarray if numpy is available, otherwise
+	# array.array), leaving f positioned just past the sample block.
+	start = f.tell()
+	nbytes = nsamps * pcsize
+	if numpy is not None:
+		dtype = numpy.dtype('%su%d' % (byteorder, pcsize))
+		if nbytes == 0:
+			return numpy.zeros(0, dtype)
+		mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if start + nbytes > len(mm):
+			Fatal('corrupted file: truncated sample block')
+		samps = numpy.frombuffer(mm, dtype, nsamps, start)
+		f.seek(start + nbytes)
+		return samps
+	tc = ArrayTypecode(pcsize)
+	if tc is None:
+		Fatal('%d-bit samples need numpy on this platform' % (8 * pcsize))
+	samps = array.array(tc)
+	try:
+		samps.fromfile(f, nsamps)
+	except Exception as e:
+		Fatal('corrupted file: %s' % e)
+	if byteorder != NATIVE_ORDER:
+		samps.byteswap()
+	return samps
+
+def DecodeSamples(data, pcsize, byteorder):
+	# Turn a string of raw PCs into a typed array
+	if numpy is not None:
+		return numpy.frombuffer(data, numpy.dtype('%su%d' % (byteorder, pcsize)))
+	tc = ArrayTypecode(pcsize)
+	if tc is None:
+		Fatal('%d-bit samples need numpy on this platform' % (8 * pcsize))
+	samps = array.array(tc)
+	samps.fromstring(data)
+	if byteorder != NATIVE_ORDER:
+		samps.byteswap()
+	return samps
+
+def IterSampleChunks(f, pcsize, nsamps, byteorder, chunk=COUNT_CHUNK):
+	# Yield the nsamps PCs at the current position of f as typed arrays of at
+	# most chunk samples each, so the sample block is never in memory at once
+	remaining = nsamps
+	while remaining > 0:
+		n = min(chunk, remaining)
+		data = f.read(n * pcsize)
+		if len(data) != n * pcsize:
+			Fatal('corrupted file: truncated sample block')
+		yield DecodeSamples(data, pcsize, byteorder)
+		remaining -= n
+
+def CountSamples(samps, counts=None):
+	# Add a sample array to a {pc: count} histogram (a new one if counts is
+	# None), a chunk at a time so the working set is bounded by the chunk size
+	# and the number of distinct PCs
+	if counts is None:
+		counts = {}
+	for i in xrange(0, len(samps), COUNT_CHUNK):
+		chunk = samps[i:i + COUNT_CHUNK]
+		if numpy is not None:
+			(pcs, hits) = numpy.unique(chunk, return_counts=True)
+			for (pc, n) in zip(pcs.tolist(), hits.tolist()):
+				counts[pc] = counts.get(pc, 0) + n
+		else:
+			for pc in chunk:
+				counts[pc] = counts.get(pc, 0) + 1
+	return counts
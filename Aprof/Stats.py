@@ -0,0 +1,98 @@
+import os
+import time
+
+# Process-wide instrumentation: named counters and per-phase wall/CPU times.
+# It is always on; an update is a dict operation and a phase costs two clock
+# reads, which is noise next to the work being measured.
+
+_counters = {}
+_phases = {}
+_phasestack = []
+
+def Count(name, n=1):
+	_counters[name] = _counters.get(name, 0) + n
+
+def Merge(counters):
+	# Add counters collected elsewhere (by a worker process)
+	for (name, n) in counters.items():
+		Count(name, n)
+
+def Counters():
+	return dict(_counters)
+
+def Reset():
+	_counters.clear()
+	_phases.clear()
+	del _phasestack[:]
+
+def _cputime():
+	t = os.times()
+	return t[0] + t[1]
+
+class Phase:
+	# Times the enclosed block as the named phase. Phases nest, and each one is
+	# charged only for the time not spent in the phases inside it.
+	def __init__(self, name):
+		self._name = name
+
+	def __enter__(self):
+		self._wall = time.time()
+		self._cpu = _cputime()
+		_phasestack.append([0.0, 0.0])
+		return self
+
+	def __exit__(self, type, value, traceback):
+		wall = time.time() - self._wall
+		cpu = _cputime() - self._cpu
+		(innerwall, innercpu) = _phasestack.pop()
+		totals = _phases.setdefault(self._name, [0.0, 0.0, 0])
+		totals[0] += wall - innerwall
+		totals[1] += cpu - innercpu
+		totals[2] += 1
+		if _phasestack:
+			_phasestack[-1][0] += wall
+			_phasestack[-1][1] += cpu
+		return False
+
+def Timed(name):
+	# Decorator form of Phase, for timing a whole function
+	def decorate(func):
+		def timed(*args, **kwargs):
+			with Phase(name):
+				return func(*args, **kwargs)
+		timed.__name__ = func.__name__
+		timed.__doc__ = func.__doc__
+		return timed
+	return decorate
+
+def Snapshot():
+	# {'phases': {name: {'wall', 'cpu', 'calls'}}, 'counters': {name: n},
+	# 'hitrates': {cache: fraction}} for every '<cache>.hit'/'<cache>.miss' pair
+	phases = {}
+	for (name, (wall, cpu, calls)) in _phases.items():
+		phases[name] = {'wall': wall, 'cpu': cpu, 'calls': calls}
+	hitrates = {}
+	for name in _counters.keys():
+		if name.endswith('.hit'):
+			cache = name[:-4]
+			hits = _counters[name]
+			total = hits + _counters.get(cache + '.miss', 0)
+			hitrates[cache] = float(hits) / total if total else 0.0
+	for name in _counters.keys():
+		if name.endswith('.miss') and not hitrates.has_key(name[:-5]):
+			hitrates[name[:-5]] = 0.0
+	return {'phases': phases, 'counters': dict(_counters), 'hitrates': hitrates}
+
+def Dump(f, stats):
+	print >> f, 'Phase,Wall,CPU,Calls'
+	for name in sorted(stats['phases'].keys()):
+		p = stats['phases'][name]
+		print >> f, '%s,%0.3f,%0.3f,%d' % (name, p['wall'], p['cpu'], p['calls'])
+	print >> f
+	print >> f, 'Counter,Value'
+	for name in sorted(stats['counters'].keys()):
+		print >> f, '%s,%d' % (name, stats['counters'][name])
+	print >> f
+	print >> f, 'Cache,Hit percent'
+	for name in sorted(stats['hitrates'].keys()):
+		print >> f, '%s,%0.2f' % (name, 100.0 * stats['hitrates'][name])
@@ -0,0 +1,174 @@
+import hashlib
+import marshal
+import os
+import sqlite3
+import time
+
+from ElfFile import *
+from Message import *
+
+# Default upper bound on the size of the symbolization database
+DEFAULT_MAX_SIZE = 256 << 20
+# Demangled names are shared by all modules and bounded by count instead
+DEFAULT_MAX_DEMANGLED = 1000000
+# Bump whenever the cached tables or results would change meaning
+FORMAT_VERSION = 3
+
+def ModuleKey(localpath):
+	# Identify a module by its GNU build-id, or by a hash of its contents if it
+	# doesn't have one. Identical builds get the same key wherever they came from.
+	# A stripped library shares its build-id with the unstripped file, so the
+	# key also records the file's size and which symbol and line sections it
+	# has; otherwise the stripped copy's tables would be served for both.
+	try:
+		elf = ElfFile(localpath)
+		buildid = elf.build_id()
+		contents = ''
+		if elf.get_section('.symtab') is not None:
+			contents += 's'
+		if elf.get_section('.debug_line') is not None:
+			contents += 'l'
+		elf.close()
+		if buildid:
+			return 'buildid:%s:%d:%s' % (buildid, os.path.getsize(localpath), contents)
+	except ElfError:
+		pass
+	h = hashlib.sha1()
+	f = open(localpath, 'rb')
+	data = f.read(1 << 20)
+	while data:
+		h.update(data)
+		data = f.read(1 << 20)
+	f.close()
+	return 'sha1:%s' % h.hexdigest()
+
+class SymbolCache:
+	# Persistent, size-bounded store of parsed symbol/line tables, per-VMA
+	# resolution results and demangled names. Module data is keyed by ModuleKey
+	# and evicted least-recently-used first once the database outgrows maxsize.
+	def __init__(self, cachepath, maxsize=DEFAULT_MAX_SIZE):
+		self._maxsize = maxsize
+		# Symbolization workers share the database, so wait for their locks
+		self._db = sqlite3.connect(os.path.join(cachepath, 'symbols.db'), timeout=60)
+		self._db.text_factory = str
+		if self._db.execute('PRAGMA user_version').fetchone()[0] != FORMAT_VERSION:
+			self._db.executescript('''
+				DROP TABLE IF EXISTS modules;
+				DROP TABLE IF EXISTS tables;
+				DROP TABLE IF EXISTS results;
+				DROP TABLE IF EXISTS files;
+				DROP TABLE IF EXISTS demangled;
+				PRAGMA user_version = %d;
+			''' % FORMAT_VERSION)
+		self._db.executescript('''
+			CREATE TABLE IF NOT EXISTS modules (key TEXT PRIMARY KEY, used REAL, size INTEGER);
+			CREATE TABLE IF NOT EXISTS tables (key TEXT, kind TEXT, data BLOB, PRIMARY KEY (key, kind));
+			CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, key TEXT);
+			CREATE TABLE IF NOT EXISTS demangled (sym TEXT PRIMARY KEY, dsym TEXT);
+		''')
+		self._keys = {}
+		self._results = {}
+		self._touched = set()
+
+	def key(self, localpath):
+		# ModuleKey, remembered across runs for as long as the file keeps its
+		# size and mtime, so warm runs don't read the file at all
+		if not self._keys.has_key(localpath):
+			path = os.path.abspath(localpath)
+			st = os.stat(path)
+			row = self._db.execute('SELECT key FROM files WHERE path = ? AND size = ? AND mtime = ?', (path, st.st_size, st.st_mtime)).fetchone()
+			if row is not None:
+				self._keys[localpath] = str(row[0])
+			else:
+				self._keys[localpath] = ModuleKey(path)
+				self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (path, st.st_size, st.st_mtime, self._keys[localpath]))
+		return self._keys[localpath]
+
+	def get_table(self, key, kind):
+		row = self._db.execute('SELECT data FROM tables WHERE key = ? AND kind = ?', (key, kind)).fetchone()
+		if row is None:
+			return None
+		self._touch(key, 0)
+		return str(row[0])
+
+	def put_table(self, key, kind, data):
+		self._db.execute('INSERT OR REPLACE INTO tables VALUES (?, ?, ?)', (key, kind, sqlite3.Binary(data)))
+		self._touch(key, len(data))
+
+	def get_results(self, key):
+		# Returns {vma: (sym, line)} for every VMA of the module resolved
+		# before. A module's results are one 'results' table: parallel lists
+		# of VMAs, symbols and lines, marshalled with the symbols interned, as
+		# each symbol covers many VMAs.
+		if not self._results.has_key(key):
+			found = {}
+			data = self.get_table(key, 'results')
+			if data is not None:
+				(vmas, syms, lines) = marshal.loads(data)
+				found = dict(zip(vmas, zip(syms, lines)))
+			self._results[key] = (found, len(data or ''))
+		return self._results[key][0]
+
+	def put_results(self, key, results):
+		# results is a list of (vma, sym, line), added to the module's results
+		found = self.get_results(key)
+		for (vma, sym, line) in results:
+			found[vma] = (sym, line)
+		vmas = found.keys()
+		syms = [intern(sym) if sym is not None else None for (sym, line) in found.values()]
+		lines = [line for (sym, line) in found.values()]
+		data = marshal.dumps((vmas, syms, lines), 2)
+		self._db.execute('INSERT OR REPLACE INTO tables VALUES (?, ?, ?)', (key, 'results', sqlite3.Binary(data)))
+		# The table replaces the old one, so only the growth counts
+		self._touch(key, len(data) - self._results[key][1])
+		self._results[key] = (found, len(data))
+
+	def get_demangled(self, syms):
+		found = {}
+		syms = list(syms)
+		for i in xrange(0, len(syms), 500):
+			batch = syms[i:i + 500]
+			query = 'SELECT sym, dsym FROM demangled WHERE sym IN (%s)' % ','.join('?' * len(batch))
+			for (sym, dsym) in self._db.execute(query, batch):
+				found[sym] = dsym
+		return found
+
+	def put_demangled(self, pairs):
+		self._db.executemany('INSERT OR REPLACE INTO demangled VALUES (?, ?)', pairs)
+
+	def _touch(self, key, size):
+		if size == 0 and key in self._touched:
+			return
+		self._touched.add(key)
+		cur = self._db.execute('UPDATE modules SET used = ?, size = size + ? WHERE key = ?', (time.time(), size, key))
+		if cur.rowcount == 0:
+			self._db.execute('INSERT INTO modules VALUES (?, ?, ?)', (key, time.time(), size))
+
+	def _evict(self):
+		self._db.execute('''DELETE FROM demangled WHERE rowid IN
+			(SELECT rowid FROM demangled ORDER BY rowid LIMIT MAX(0, (SELECT COUNT(*) FROM demangled) - ?))''', (DEFAULT_MAX_DEMANGLED,))
+		total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM modules').fetchone()[0]
+		if total <= self._maxsize:
+			return
+		for (key, size) in self._db.execute('SELECT key, size FROM modules ORDER BY used').fetchall():
+			if total <= self._maxsize:
+				break
+			if key in self._touched:
+				# Never evict what this run is using
+				continue
+			Verbose('evicting cached symbols for %s' % key)
+			for table in ('modules', 'tables'):
+				self._db.execute('DELETE FROM %s WHERE key = ?' % table, (key,))
+			total -= size
+
+	def commit(self):
+		self._db.commit()
+
+	def close(self, evict=True):
+		if self._db is None:
+			return
+		if evict:
+			self._evict()
+		self._db.commit()
+		self._db.close()
+		self._db = None
@@ -1,41 +1,159 @@
+import array
+import bisect
+import marshal
 import re
-import subprocess
 
+from ElfFile import *
+from SampleData import *
 from Message import *
 
+# ARM mapping symbols ($a, $t, $d, $x, optionally followed by .suffix) mark
+# code/data boundaries, not functions
+mappingsymre = re.compile(r'^\$[atdx](\..*)?$')
+
+def AddressColumn(values):
+	# Sorted address columns are kept in a 64-bit array.array when the platform
+	# has one, and fall back to a plain list otherwise.
+	tc = ArrayTypecode(8)
+	if tc is None:
+		return list(values)
+	return array.array(tc, values)
+
+def FlattenSymbols(symbols):
+	# Turn possibly-overlapping (symaddr, symsize, symname) tuples into sorted,
+	# non-overlapping (begin, end, name) segments. Where symbols nest, the
+	# innermost one wins. Where several symbols cover exactly the same range,
+	# the first one in table order wins.
+	ordered = [(a, -(a + s), -i, n) for (i, (a, s, n)) in enumerate(symbols) if s > 0]
+	ordered.sort()
+	segments = []
+	stack = []
+	pos = 0
+	for (begin, negend, negorder, name) in ordered:
+		pos = _emitsegments(segments, stack, pos, begin)
+		pos = begin
+		stack.append((-negend, name))
+	_emitsegments(segments, stack, pos, None)
+	return segments
+
+def _emitsegments(segments, stack, pos, upto):
+	# Emit segments for the symbols on the stack from pos up to upto (or until
+	# the stack empties if upto is None). Returns the new position.
+	while stack and (upto is None or pos < upto):
+		(end, name) = stack[-1]
+		if end <= pos:
+			stack.pop()
+			continue
+		if upto is not None and end > upto:
+			segments.append((pos, upto, name))
+			return upto
+		segments.append((pos, end, name))
+		pos = end
+		stack.pop()
+	return pos
+
 class SymbolResolver:
 	def __init__(self, remotepath, modcache):
 		self._remotepath = remotepath
-		self._symbols = []
 		self._ok = False
-		
+
 		localpath = modcache.get(self._remotepath)
 		if not localpath:
 			Warning('won\'t be able to resolve symbols inside %s' % self._remotepath)
 			return
-		args = ['arm-linux-androideabi-readelf', '-s', '-W', localpath]
-		p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		(out, errout) = p.communicate()
-		if p.returncode:
+		# Reuse the table parsed by an earlier run if we have it
+		symbolcache = modcache.get_symbolcache()
+		key = symbolcache.key(localpath)
+		data = symbolcache.get_table(key, 'symbols')
+		if data is not None:
+			self._load(data)
+			self._ok = True
+			return
+		try:
+			elf = ElfFile(localpath)
+		except ElfError:
 			Warning('Module %s is not a valid ELF file' % self._remotepath)
 			return
-		symre = re.compile(r'\s+')
-		for sl in map(str.strip, out.split('\n')):
-			fields = symre.split(sl)
-			if len(fields) == 8 and fields[0] != 'Num:':
-				symaddr = int(fields[1], 16)
-				symsize = int(fields[2], 0)
-				symname = fields[7]
-				self._symbols.append((symaddr, symsize, symname))
+		symbols = []
+		for (symaddr, symsize, symname, symtype, symbind, shndx) in elf.symbols():
+			# Undefined, file and section symbols don't name any code
+			if shndx == SHN_UNDEF or symtype in (STT_FILE, STT_SECTION):
+				continue
+			if not symname or mappingsymre.match(symname):
+				continue
+			# Thumb functions have bit 0 of their address set
+			if elf.machine == EM_ARM and symtype == STT_FUNC:
+				symaddr &= ~1
+			symbols.append((symaddr, symsize, symname))
+		elf.close()
+		self._build(symbols)
+		symbolcache.put_table(key, 'symbols', self._dump())
 		self._ok = True
-					
+
+	def _build(self, symbols):
+		# Sized symbols cover [symaddr, symaddr + symsize)
+		segments = FlattenSymbols(symbols)
+		self._begins = AddressColumn([b for (b, e, n) in segments])
+		self._ends = AddressColumn([e for (b, e, n) in segments])
+		self._names = [n for (b, e, n) in segments]
+		# Zero-size symbols (typically assembly labels) are only used for
+		# addresses no sized symbol covers. They extend up to the next symbol.
+		starts = sorted(set([a for (a, s, n) in symbols]))
+		labels = {}
+		for (symaddr, symsize, symname) in symbols:
+			if symsize == 0 and not labels.has_key(symaddr):
+				labels[symaddr] = symname
+		lblsegments = []
+		for symaddr in sorted(labels.keys()):
+			i = bisect.bisect_right(starts, symaddr)
+			if i < len(starts):
+				lblsegments.append((symaddr, starts[i], labels[symaddr]))
+		self._lblbegins = AddressColumn([b for (b, e, n) in lblsegments])
+		self._lblends = AddressColumn([e for (b, e, n) in lblsegments])
+		self._lblnames = [n for (b, e, n) in lblsegments]
+
+	def _dump(self):
+		return marshal.dumps((list(self._begins), list(self._ends), self._names,
+			list(self._lblbegins), list(self._lblends), self._lblnames))
+
+	def _load(self, data):
+		(begins, ends, self._names, lblbegins, lblends, self._lblnames) = marshal.loads(data)
+		self._begins = AddressColumn(begins)
+		self._ends = AddressColumn(ends)
+		self._lblbegins = AddressColumn(lblbegins)
+		self._lblends = AddressColumn(lblends)
+
 	def resolve(self, addr):
 		if not self._ok:
 			return None
-		for (symaddr, symsize, symname) in self._symbols:
-			if addr >= symaddr and addr < symaddr + symsize:
-				return symname
+		i = bisect.bisect_right(self._begins, addr) - 1
+		if i >= 0 and addr < self._ends[i]:
+			return self._names[i]
+		i = bisect.bisect_right(self._lblbegins, addr) - 1
+		if i >= 0 and addr < self._lblends[i]:
+			return self._lblnames[i]
 		return None
-		
+
+	def resolve_many(self, addrs):
+		# Batch version of resolve. Returns a list with one entry per address.
+		# The addresses are sorted and merged against the segment table, so the
+		# cost is linear in the number of addresses plus segments.
+		result = [None] * len(addrs)
+		if not self._ok:
+			return result
+		order = sorted(xrange(len(addrs)), key=addrs.__getitem__)
+		for (begins, ends, names) in ((self._begins, self._ends, self._names), (self._lblbegins, self._lblends, self._lblnames)):
+			i = 0
+			n = len(begins)
+			for k in order:
+				if result[k] is not None:
+					continue
+				addr = addrs[k]
+				while i < n and ends[i] <= addr:
+					i += 1
+				if i < n and begins[i] <= addr:
+					result[k] = names[i]
+		return result
+
 	def close(self):
 		pass
@@ -0,0 +1,145 @@
+import array
+import bisect
+import heapq
+import itertools
+import re
+
+from ProfileData import *
+from Message import *
+
+# The cumulative count table holds at most this many cells (rows of per-symbol
+# counts, one row per block of samples); the block size grows to fit
+MAX_PREFIX_CELLS = 1 << 22
+# Smallest block of samples between two rows of the table
+MIN_BLOCK = 64
+# Symbols listed per window by default
+DEFAULT_WINDOW_TOP = 10
+
+def ParseDuration(text):
+	# Seconds in '5', '5s', '250ms', '2m' or '1h'
+	mat = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*(ms|s|m|h)?\s*$', text)
+	if not mat:
+		Fatal('bad duration %s' % text)
+	scale = {None: 1.0, 'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}[mat.group(2)]
+	return float(mat.group(1)) * scale
+
+class Timeline:
+	# Per-symbol sample counts over any time range of a capture. Samples are
+	# taken at a fixed interval, so a sample's index in its timeline is its
+	# time: the whole capture is one timeline for the process CPU clock (and
+	# PROFDAT1). For the thread and wall clocks each thread has its own, placed
+	# in the capture by when its chunks were written (to within a flush
+	# interval for the wall clock; the thread clock only has the busiest
+	# thread's CPU time to go by).
+	#
+	# The samples are kept as a sequence of symbol ids in time order, with a
+	# table of cumulative per-symbol counts at every block boundary, so the
+	# counts over a range are the difference of two rows plus the partial
+	# blocks at either end.
+	def __init__(self, profiledatafile, symbolize):
+		# symbolize maps a PC to the key it is counted under, typically
+		# (module, symbol)
+		profile = ProfileData(profiledatafile)
+		self._frequency = profile.get_frequency()
+		self._keys = []
+		keyids = {}
+		pcids = {}
+		def ids(pcs):
+			result = array.array('i')
+			for pc in pcs:
+				if not pcids.has_key(pc):
+					key = symbolize(pc)
+					if not keyids.has_key(key):
+						keyids[key] = len(self._keys)
+						self._keys.append(key)
+					pcids[pc] = keyids[key]
+				result.append(pcids[pc])
+			return result
+		if profile.version < 2 or profile.get_clock() == 'prof':
+			self._ids = array.array('i')
+			for chunk in profile.iter_samples():
+				self._ids.extend(ids(chunk.tolist()))
+			self._ticks = array.array('l', xrange(len(self._ids)))
+		else:
+			# A thread's samples are a tick apart, but a thread that started
+			# late, or slept, has fewer of them than the capture has ticks. Each
+			# chunk is written by the flusher when it drains the ring, so it
+			# ends about when the thread furthest along has got to, and the
+			# chunk is laid out to end there (or right after the thread's last
+			# chunk, if later).
+			threadticks = {}
+			cursors = {}
+			now = 0
+			for (tid, count) in profile.get_thread_chunks():
+				start = max(cursors.get(tid, 0), now - count)
+				threadticks.setdefault(tid, array.array('l')).extend(xrange(start, start + count))
+				cursors[tid] = start + count
+				now = max(now, cursors[tid])
+			# Interleave the threads' timelines by tick
+			threads = []
+			for tid in profile.get_threads():
+				threadids = array.array('i')
+				for chunk in profile.iter_samples(tid):
+					threadids.extend(ids(chunk.tolist()))
+				threads.append(itertools.izip(threadticks[tid], threadids))
+			self._ids = array.array('i')
+			self._ticks = array.array('l')
+			for (tick, keyid) in heapq.merge(*threads):
+				self._ids.append(keyid)
+				self._ticks.append(tick)
+		profile.close()
+		self._buildprefix()
+
+	def _buildprefix(self):
+		nkeys = max(len(self._keys), 1)
+		self._block = max(MIN_BLOCK, -(-len(self._ids) * nkeys // MAX_PREFIX_CELLS))
+		row = array.array('i', [0]) * nkeys
+		self._prefix = [row[:]]
+		for start in xrange(0, len(self._ids) - self._block + 1, self._block):
+			for i in self._ids[start:start + self._block]:
+				row[i] += 1
+			self._prefix.append(row[:])
+
+	def get_duration(self):
+		# Seconds covered by the capture
+		if not self._ticks:
+			return 0.0
+		return (self._ticks[-1] + 1) / self._frequency
+
+	def get_counts(self, start, end):
+		# {key: samples} over [start, end), in seconds from the start
+		i0 = bisect.bisect_left(self._ticks, int(-(-start * self._frequency // 1)))
+		i1 = bisect.bisect_left(self._ticks, int(-(-end * self._frequency // 1)))
+		counts = {}
+		b0 = -(-i0 // self._block)
+		b1 = i1 // self._block
+		if b0 < b1:
+			(first, last) = (self._prefix[b0], self._prefix[b1])
+			for i in xrange(len(self._keys)):
+				if last[i] != first[i]:
+					counts[i] = last[i] - first[i]
+			edges = [self._ids[i0:b0 * self._block], self._ids[b1 * self._block:i1]]
+		else:
+			edges = [self._ids[i0:i1]]
+		for edge in edges:
+			for i in edge:
+				counts[i] = counts.get(i, 0) + 1
+		return dict([(self._keys[i], n) for (i, n) in counts.items()])
+
+	def get_top(self, start, end, n=DEFAULT_WINDOW_TOP):
+		# [(samples, key)] of the n keys with the most samples in [start, end),
+		# and the number of samples in the range
+		counts = self.get_counts(start, end)
+		top = heapq.nlargest(n, [(count, key) for (key, count) in counts.items()])
+		return (top, sum(counts.values()))
+
+	def iter_windows(self, window, step, start=0.0, end=None, n=DEFAULT_WINDOW_TOP):
+		# Yield (start, end, samples, top) for windows of the given length every
+		# step seconds, as get_top reports them
+		if end is None:
+			end = self.get_duration()
+		t = start
+		while t < end:
+			(top, total) = self.get_top(t, min(t + window, end), n)
+			yield (t, min(t + window, end), total, top)
+			t += step
@@ -2,10 +2,12 @@
 
 import sys
 import subprocess
-import struct
 import re
 import os
 
+from Aprof.ElfFile import *
+from Aprof.ProfileData import *
+
 try:
 	import colorama
 	colorama.init()
@@ -73,46 +75,19 @@ optMergeLineCounts = True
 optTopPercent = 0
 
 def GetTextStart(fn):
-	splitter = re.compile(r'\s*(\S+)\s*(0x.*)\s+(0x.*)\s+(0x.*)\s+(0x.*)\s+(0x.*)\s+(.)(.)(.)\s+(0x.*)')
-	readelf = subprocess.Popen(['arm-linux-androideabi-readelf', '-l', fn], stdout=subprocess.PIPE)
-	elfdata = readelf.stdout.read()
-	inLoadSegments = False
-	for line in elfdata.split('\n'):
-		line = line.strip()
-		if not inLoadSegments:
-			if line == 'Program Headers:':
-				inLoadSegments = True
-		else:
-			mat = splitter.match(line)
-			if mat and mat.group(1) == 'LOAD' and mat.group(9) == 'E':
-				return int(mat.group(3), 16)
+	elf = ElfFile(fn)
+	for (offset, vaddr, flags) in elf.load_segments():
+		if flags & PF_X:
+			elf.close()
+			return vaddr
+	elf.close()
 
 def ReadSymTab(fn):
-	splitter = re.compile(r'\s+')
-	readelf = subprocess.Popen(['arm-linux-androideabi-readelf', '-s', '-W', fn], stdout=subprocess.PIPE)
-	elfdata = readelf.stdout.read()
-	inSymbols = 0
+	elf = ElfFile(fn)
 	syms = []
-	for line in elfdata.split('\n'):
-		line = line.strip()
-		if inSymbols == 0:
-			if line[:6] == 'Symbol':
-				inSymbols = 1
-		elif inSymbols == 1:
-			if line[:6] == 'Symbol':
-				inSymbols = 1
-			else:
-				inSymbols = 2
-		else:
-			if line[:6] == 'Symbol':
-				inSymbols = 1
-			else:
-				fields = splitter.split(line)
-				if len(fields) == 8:
-					addr = long(fields[1], 16)
-					size = long(fields[2],0)
-					name = fields[7]
-					syms.append((addr, size, name))
+	for (addr, size, name, symtype, symbind, shndx) in elf.symbols():
+		syms.append((addr, size, name))
+	elf.close()
 	syms.sort()
 	return syms
 	
@@ -125,62 +100,21 @@ def FindSym(syms, addr):
 # Get name of binary
 bin = sys.argv[1]
 
-# Open the PROFDATA file
-pdata = open(sys.argv[2], 'rb')
-sig = pdata.read(8)
-if sig != 'PROFDAT1':
-	print 'ERROR: %s is not a PROFDAT1 file' % sys.argv[2]
-	sys.exit(1)
-# Parse the size byte (32-bit or 64-bit)
-sizebyte = ord(pdata.read(1))
-pdata.read(3)
+# Open the PROFDATA file (PROFDAT1 or PROFDAT2)
+pdata = ProfileData(sys.argv[2])
+sizebyte = pdata.pcsize
 # Set up address format
 addrfmt = '%%0%dX' % (2 * sizebyte)
-# Parse the sample count
-samplecountbuf = pdata.read(8)
-samplecount = struct.unpack('Q', samplecountbuf)[0]
-
-# Clear the hash of counts
-counts = {}
+if int(pdata.info.get('dropped', 0)):
+	print 'WARNING: %s samples were dropped during capture' % pdata.info['dropped']
 
-# Open the addr2line executable
-a2l = subprocess.Popen(['arm-linux-androideabi-addr2line', '-e', bin], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+# Count the hits on each address, streaming the samples a chunk at a time
+counts = pdata.histogram()
 
-# Parse the data
-nsamps = 0
-while nsamps < samplecount:
-	# Read next sample
-	addrbytes = pdata.read(sizebyte)
-	if len(addrbytes) != sizebyte:
-		print 'ERROR: truncated file'
-		sys.exit(1)
-	nsamps += 1
-	# Update hash
-	counts[addrbytes] = counts.get(addrbytes, 0) + 1
-	continue
-	
-	# Convert the pc bytes to a string format
-	str = ''
-	for i in xrange(sizebyte):
-		str = '%02X%s' % (ord(addrbytes[i]), str)
-	# Send the address to addr2line and get translated result
-	a2l.stdin.write('%s\n' % str)
-	line = a2l.stdout.readline().strip()
-	line = '%s/%s' % (line, str)
-	# Increment hit count in the hash
-	counts[line] = counts.setdefault(line, 0) + 1
-	nsamps += 1
-	
-# Read the maps data
-mapsdatasig = pdata.read(8)
-if mapsdatasig != 'MAPSDATA':
-	print 'ERROR: %s does not contain MAPSDATA' % sys.argv[2]
-	print mapsdatasig
+mapsdata = pdata.get_maps()
+if not mapsdata:
+	print 'ERROR: %s does not contain the process maps' % sys.argv[2]
 	sys.exit(1)
-# Read the string length placeholder
-pdata.read(8)
-# Read the remainder of the file into mapsdata
-mapsdata = pdata.read()
 
 pdata.close()
 
@@ -223,12 +157,7 @@ modules_symtab = {}
 
 # Translate addresses to line numbers
 resolvedcounts = {}
-for (addrbytes, count) in counts.items():
-	# Unpack the address
-	if sizebyte == 4:
-		addr = struct.unpack('I', addrbytes)[0]
-	else:
-		addr = struct.unpack('Q', addrbytes)[0]
+for (addr, count) in counts.items():
 	# Default signature
 	addrstring = '??? (%X)' % addr
 	# Find the module the address is part of
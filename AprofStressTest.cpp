@@ -0,0 +1,117 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <pthread.h>
+
+#include "Aprof.h"
+
+// Keeps many threads busy under the profiler so the per-thread buffers and
+// the flusher can be exercised off-device.
+//   AprofStressTest <outfile> [threads] [seconds] [frequency] [prof|thread|wall] [stackdepth] [churn]
+// With churn, the main thread also starts that many short-lived threads one
+// after another, so more distinct threads are sampled than there are rings.
+
+static volatile int running = 1;
+
+static double Now()
+{
+	timespec ts;
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return ts.tv_sec + ts.tv_nsec * 1e-9;
+}
+
+__attribute__((noinline)) static unsigned Spin(unsigned x)
+{
+	for (int i = 0; i < 100000; ++i)
+	{
+		x = x * 1103515245 + 12345;
+	}
+	return x;
+}
+
+__attribute__((noinline)) static unsigned Nested(unsigned x, int depth)
+{
+	// Gives stack-sampling mode a few frames to walk
+	if (depth == 0)
+	{
+		return Spin(x);
+	}
+	return Nested(x, depth - 1) + 1;
+}
+
+static void* ShortWorker(void* arg)
+{
+	// Lives long enough to be sampled a few times
+	unsigned x = reinterpret_cast<unsigned long>(arg);
+	double end = Now() + 0.03;
+	while (Now() < end)
+	{
+		x = Spin(x);
+	}
+	return reinterpret_cast<void*>(static_cast<unsigned long>(x));
+}
+
+static void* Worker(void* arg)
+{
+	unsigned x = reinterpret_cast<unsigned long>(arg);
+	while (running)
+	{
+		x = Nested(x, x % 4);
+	}
+	return reinterpret_cast<void*>(static_cast<unsigned long>(x));
+}
+
+int main(int argc, char** argv)
+{
+	if (argc < 2)
+	{
+		fprintf(stderr, "usage: %s outfile [threads] [seconds] [frequency] [prof|thread|wall] [stackdepth] [churn]\n", argv[0]);
+		return 1;
+	}
+	int nthreads = argc > 2 ? atoi(argv[2]) : 64;
+	double seconds = argc > 3 ? atof(argv[3]) : 2.0;
+	int frequency = argc > 4 ? atoi(argv[4]) : GUM::Aprof::DEFAULT_FREQUENCY;
+	GUM::Aprof::ClockMode clockmode = GUM::Aprof::PROCESS_CPU;
+	if (argc > 5 && strcmp(argv[5], "thread") == 0)
+	{
+		clockmode = GUM::Aprof::THREAD_CPU;
+	}
+	else if (argc > 5 && strcmp(argv[5], "wall") == 0)
+	{
+		clockmode = GUM::Aprof::WALL_CLOCK;
+	}
+
+	int stackdepth = argc > 6 ? atoi(argv[6]) : 0;
+	int churn = argc > 7 ? atoi(argv[7]) : 0;
+
+	if (!GUM::Aprof::Begin(argv[1], frequency, clockmode, stackdepth))
+	{
+		return 1;
+	}
+	pthread_t* threads = new pthread_t[nthreads];
+	for (int i = 0; i < nthreads; ++i)
+	{
+		pthread_create(&threads[i], 0, &Worker, reinterpret_cast<void*>(static_cast<unsigned long>(i)));
+	}
+	for (int i = 0; i < churn; ++i)
+	{
+		pthread_t thread;
+		pthread_create(&thread, 0, &ShortWorker, reinterpret_cast<void*>(static_cast<unsigned long>(i)));
+		pthread_join(thread, 0);
+	}
+	double end = Now() + seconds;
+	while (Now() < end)
+	{
+		Spin(0);
+	}
+	running = 0;
+	for (int i = 0; i < nthreads; ++i)
+	{
+		pthread_join(threads[i], 0);
+	}
+	delete[] threads;
+	GUM::Aprof::End();
+	printf("%d threads\n", nthreads + churn + 1);
+	return 0;
+}
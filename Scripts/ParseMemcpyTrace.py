@@ -1,29 +1,15 @@
 import sys
-import re
+import os
 
-bytecount = {}
-callcount = {}
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-framere = re.compile(r'#1\s.* in (.*)')
-nbytere = re.compile(r'\$[0-9]+ = (.*)')
-fp = open(sys.argv[1], 'r')
-frame = None
-nbyte = None
-for line in map(str.strip, fp.xreadlines()):
-	mat = framere.match(line)
-	if mat:
-		frame = mat.group(1)
-	mat = nbytere.match(line)
-	if mat:
-		nbyte = int(mat.group(1))
-	if frame is not None and nbyte is not None:
-		callcount[frame] = callcount.get(frame, 0) + 1
-		bytecount[frame] = bytecount.get(frame, 0) + nbyte
-		frame = None
-		nbyte = None
+from Aprof.MemcpyTrace import *
 
-print 'Context,Calls,BytesCopied'
-for frame in callcount:
-	count = callcount[frame]
-	nbyte = bytecount[frame]
-	print '"%s",%d,%d' % (frame, count, nbyte)
+# Usage: ParseMemcpyTrace.py [-j jobs] memcpy.txt
+jobs = 1
+for i in xrange(1, len(sys.argv) - 1):
+	if sys.argv[i] == '-j':
+		jobs = int(sys.argv[i + 1])
+
+trace = MemcpyTrace(sys.argv[-1], jobs)
+trace.dump_csv(sys.stdout)
@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Times each phase of Profiler on synthetic fixtures, with stub adb, addr2line
+# and c++filt standing in for the device and the NDK. Run from anywhere:
+#
+#   python benchmarks/Bench.py --samples 1000000 --modules 8 --save base.json
+#   python benchmarks/Bench.py --samples 1000000 --modules 8 --baseline base.json
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHDIR))
+
+from Aprof.Profiler import *
+from Synth import *
+
+# Profiler times these itself (see Aprof/Stats.py). Phases nest, loading
+# modules while symbolizing and demangling while dumping, and each one is
+# charged only for the time not spent in the phases inside it.
+PHASES = ['parse', 'maps', 'load', 'symbolize', 'aggregate', 'demangle', 'dump']
+
+def InstallStubs(workdir, device):
+	# Put the stub tools first on the PATH, serving files from device
+	bindir = os.path.join(workdir, 'bin')
+	os.makedirs(bindir)
+	for tool in os.listdir(os.path.join(BENCHDIR, 'stubs')):
+		# Run the stubs with this interpreter, whatever 'python' is on PATH
+		source = open(os.path.join(BENCHDIR, 'stubs', tool)).read().split('\n', 1)[1]
+		target = os.path.join(bindir, tool)
+		f = open(target, 'w')
+		f.write('#!%s\n%s' % (sys.executable, source))
+		f.close()
+		os.chmod(target, 0755)
+	os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+	os.environ['APROF_STUB_DEVICE'] = device
+
+def MakeFixtures(workdir, args):
+	# Modules on the fake device, the capture, and a bin directory with the
+	# stub tools. Returns the capture's path and what it contains.
+	device = os.path.join(workdir, 'device')
+	os.makedirs(os.path.join(device, 'system', 'lib'))
+	modules = []
+	maps = []
+	nfuncs = 0
+	for m in xrange(args.modules):
+		remotepath = '/system/lib/libbench%d.so' % m
+		localpath = os.path.join(device, remotepath.lstrip('/'))
+		funcs = WriteElf(localpath, args.pcsize, args.functions, args.function_size, args.files,
+			args.rows, 1 if args.addr2line else 3, '%040x' % (m + 1), m, args.addr2line)
+		base = 0x40000000 + m * 0x01000000
+		size = (TEXT_START + len(funcs) * args.function_size + 0xfff) & ~0xfff
+		modules.append((base, funcs))
+		maps.append((remotepath, base, size))
+		nfuncs += len(funcs)
+	pcs = MakeSamples(modules, args.samples, args.distribution, args.zipf, args.unknown)
+	profile = os.path.join(workdir, 'profiledata.bin')
+	WriteProfile(profile, pcs, MakeMaps(maps, args.pcsize), args.pcsize, args.format, args.threads)
+
+	InstallStubs(workdir, device)
+	return (profile, {'samples': len(pcs), 'distinct_pcs': len(set(pcs)), 'modules': args.modules,
+		'functions': nfuncs, 'profile_bytes': os.path.getsize(profile)})
+
+def RunOnce(profile, jobs, top=None, coverage=None):
+	p = Profiler([], profile, jobs, None, top, coverage)
+	out = open(os.devnull, 'w')
+	p.dump_csv(out)
+	out.close()
+	p.close()
+	phases = p.stats['phases']
+	return dict([(phase, phases[phase]['wall'] if phases.has_key(phase) else 0.0) for phase in PHASES])
+
+def Report(label, timings, counts):
+	# What each phase's throughput is measured in
+	units = {'parse': ('samples', counts['samples']), 'maps': ('modules', counts['modules']),
+		'load': ('modules', counts['modules']), 'symbolize': ('PCs', counts['distinct_pcs']),
+		'aggregate': ('PCs', counts['distinct_pcs']),
+		'demangle': ('symbols', counts['functions']), 'dump': ('samples', counts['samples'])}
+	print '%s,Seconds,Throughput' % label
+	for phase in PHASES:
+		(unit, n) = units[phase]
+		seconds = timings[phase]
+		rate = n / seconds if seconds > 0 else 0
+		print '%s,%0.4f,%0.0f %s/s' % (phase, seconds, rate, unit)
+	print 'total,%0.4f,' % sum(timings.values())
+	print
+
+def Compare(results, baseline, tolerance, minimum):
+	# Phases that got slower than the baseline by more than tolerance (a
+	# fraction) and by at least minimum seconds, to ignore timer noise
+	regressions = []
+	for run in sorted(results['runs'].keys()):
+		if run not in baseline.get('runs', {}):
+			continue
+		for phase in PHASES:
+			old = baseline['runs'][run].get(phase)
+			new = results['runs'][run][phase]
+			if old is None:
+				continue
+			if new > old * (1 + tolerance) and new - old >= minimum:
+				regressions.append('%s %s: %0.4fs -> %0.4fs (+%0.0f%%)' % (run, phase, old, new, 100.0 * (new - old) / max(old, 1e-9)))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description='Time the phases of the Aprof analysis pipeline on synthetic data')
+	parser.add_argument('--samples', type=int, default=200000, help='samples in the capture')
+	parser.add_argument('--modules', type=int, default=4, help='shared objects sampled')
+	parser.add_argument('--functions', type=int, default=2000, help='functions per module')
+	parser.add_argument('--function-size', type=int, default=64, help='bytes per function')
+	parser.add_argument('--files', type=int, default=50, help='source files per module')
+	parser.add_argument('--rows', type=int, default=4, help='line table rows per function')
+	parser.add_argument('--distribution', choices=['uniform', 'zipf'], default='zipf', help='how samples spread over functions')
+	parser.add_argument('--zipf', type=float, default=1.1, help='zipf exponent')
+	parser.add_argument('--unknown', type=float, default=0.01, help='fraction of samples outside any module')
+	parser.add_argument('--pcsize', type=int, choices=[4, 8], default=4, help='PC size in bytes')
+	parser.add_argument('--format', type=int, choices=[1, 2], default=2, help='PROFDAT version')
+	parser.add_argument('--threads', type=int, default=4, help='threads in a PROFDAT2 capture')
+	parser.add_argument('--addr2line', action='store_true', help='make line tables undecodable so lines come from addr2line')
+	parser.add_argument('--jobs', type=int, default=1, help='symbolization processes')
+	parser.add_argument('--top', type=int, help='report (and resolve lines for) only this many symbols')
+	parser.add_argument('--coverage', type=float, help='report only the symbols covering this percentage of the samples')
+	parser.add_argument('--warm', action='store_true', help='run a second time with the symbol cache filled')
+	parser.add_argument('--keep', action='store_true', help='keep the work directory')
+	parser.add_argument('--save', help='write the results to this JSON file')
+	parser.add_argument('--baseline', help='compare against results saved with --save')
+	parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline, as a fraction')
+	parser.add_argument('--min-delta', type=float, default=0.01, help='slowdowns under this many seconds are ignored')
+	args = parser.parse_args()
+
+	workdir = tempfile.mkdtemp(prefix='aprof-bench-')
+	cwd = os.getcwd()
+	try:
+		start = time.time()
+		(profile, counts) = MakeFixtures(workdir, args)
+		print 'Fixtures,%0.2fs,%d samples,%d distinct PCs,%d modules,%d functions,%d bytes' % (time.time() - start,
+			counts['samples'], counts['distinct_pcs'], counts['modules'], counts['functions'], counts['profile_bytes'])
+		print
+		# The symbol cache lives in the working directory
+		os.chdir(workdir)
+		results = {'config': vars(args), 'counts': counts, 'runs': {}}
+		results['runs']['cold'] = RunOnce(profile, args.jobs, args.top, args.coverage)
+		Report('cold', results['runs']['cold'], counts)
+		if args.warm:
+			results['runs']['warm'] = RunOnce(profile, args.jobs, args.top, args.coverage)
+			Report('warm', results['runs']['warm'], counts)
+	finally:
+		os.chdir(cwd)
+		if args.keep:
+			print 'Work directory: %s' % workdir
+		else:
+			shutil.rmtree(workdir, True)
+
+	if args.save:
+		f = open(args.save, 'w')
+		json.dump(results, f, indent=1, sort_keys=True)
+		f.close()
+	if args.baseline:
+		regressions = Compare(results, json.load(open(args.baseline)), args.tolerance, args.min_delta)
+		for r in regressions:
+			print 'REGRESSION: %s' % r
+		if regressions:
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,86 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Diffs two captures that map different builds of the same library: the
+# device (the stub adb) has the new build, and the base build is passed as a
+# local file. Each capture's counts in the diff must match an analysis of
+# that capture alone, against its own build.
+#
+#   python benchmarks/Diff.py --samples 200000
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHDIR))
+
+from Aprof.ProfileDiff import *
+from Bench import InstallStubs
+from Synth import *
+
+REMOTEPATH = '/system/lib/libdiff.so'
+BASE = 0x40000000
+
+def WriteCapture(path, elfpath, module, buildid, args, funcsize, seed):
+	# A build of the library at elfpath and a capture of it at path
+	funcs = WriteElf(elfpath, 4, args.functions, funcsize, 10, 2, 3, buildid, module)
+	size = (TEXT_START + len(funcs) * funcsize + 0xfff) & ~0xfff
+	pcs = MakeSamples([(BASE, funcs)], args.samples, 'zipf', seed=seed)
+	WriteProfile(path, pcs, MakeMaps([(REMOTEPATH, BASE, size)]))
+
+def main():
+	parser = argparse.ArgumentParser(description='Diff captures of two builds of the same library')
+	parser.add_argument('--samples', type=int, default=100000, help='samples per capture')
+	parser.add_argument('--functions', type=int, default=500, help='functions per build')
+	parser.add_argument('--jobs', type=int, default=1, help='symbolization processes')
+	parser.add_argument('--keep', action='store_true', help='keep the work directory')
+	args = parser.parse_args()
+
+	workdir = tempfile.mkdtemp(prefix='aprof-diff-')
+	cwd = os.getcwd()
+	try:
+		device = os.path.join(workdir, 'device')
+		os.makedirs(os.path.join(device, 'system', 'lib'))
+		basebuild = os.path.join(workdir, 'basebuild')
+		os.makedirs(basebuild)
+		baselib = os.path.join(basebuild, os.path.basename(REMOTEPATH))
+		basefile = os.path.join(workdir, 'base.bin')
+		newfile = os.path.join(workdir, 'new.bin')
+		# The builds differ in layout as well as names, so symbolizing a
+		# capture with the other build gives different symbols
+		WriteCapture(basefile, baselib, 0, '%040x' % 1, args, 64, 1)
+		WriteCapture(newfile, os.path.join(device, REMOTEPATH.lstrip('/')), 1, '%040x' % 2, args, 96, 2)
+		InstallStubs(workdir, device)
+		os.chdir(workdir)
+
+		failed = False
+		for run in ['cold', 'warm']:
+			start = time.time()
+			p = ProfileDiff([], basefile, newfile, args.jobs, [baselib])
+			deltas = p.get_deltas()
+			p.close()
+			elapsed = time.time() - start
+			diffbase = dict([(key, basecount) for (key, basecount, newcount, delta, z) in deltas if basecount])
+			diffnew = dict([(key, newcount) for (key, basecount, newcount, delta, z) in deltas if newcount])
+			print 'Diff,%s,%0.2fs,%d base symbols,%d new symbols' % (run, elapsed, len(diffbase), len(diffnew))
+			for (label, localfiles, path, hits) in [('base', [baselib], basefile, diffbase), ('new', [], newfile, diffnew)]:
+				p = Profiler(localfiles, path, args.jobs)
+				alone = p.get_symbol_hits()
+				p.close()
+				if hits != alone:
+					differ = [key for key in set(hits.keys()) | set(alone.keys()) if hits.get(key) != alone.get(key)]
+					print 'MISMATCH: %d %s symbols differ from the %s capture alone' % (len(differ), label, label)
+					failed = True
+		if failed:
+			sys.exit(1)
+		print 'Both captures match their own builds'
+	finally:
+		os.chdir(cwd)
+		if args.keep:
+			print 'Work directory: %s' % workdir
+		else:
+			shutil.rmtree(workdir, True)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,115 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# Replays a synthetic capture through live mode: a writer thread appends
+# chunks to a capture on the stub device the way libAprof's flusher does,
+# while LiveProfiler tails it through the stub adb. At the end the live
+# counts are checked against an offline analysis of the finished file.
+#
+#   python benchmarks/Live.py --samples 50000 --seconds 5 --late
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHDIR))
+
+from Aprof.LiveProfiler import *
+from Bench import InstallStubs
+from Synth import *
+
+PID = 1234
+REMOTEPATH = '/sdcard/profiledata.bin'
+
+def WriteLive(device, modules, pcs, seconds, chunk, late):
+	# Append pcs to the capture a chunk at a time over the given time. With
+	# late set, the last module only appears in the maps just before its
+	# first sample.
+	def writemaps(count):
+		f = open(os.path.join(device, 'proc', str(PID), 'maps'), 'w')
+		f.write(MakeMaps(modules[:count]))
+		f.close()
+	latebase = modules[-1][1]
+	writemaps(len(modules) - 1 if late else len(modules))
+	f = open(os.path.join(device, REMOTEPATH.lstrip('/')), 'wb')
+	w = ProfileWriter(f, 4, '<')
+	w.write_info({'clock': 'prof', 'frequency': 1000})
+	f.flush()
+	nchunks = max(1, (len(pcs) + chunk - 1) // chunk)
+	for i in xrange(nchunks):
+		if late and [pc for pc in pcs[i * chunk:(i + 1) * chunk] if pc >= latebase]:
+			writemaps(len(modules))
+			late = False
+		w.write_samples(pcs[i * chunk:(i + 1) * chunk], PID, CODEC_DELTA)
+		f.flush()
+		time.sleep(float(seconds) / nchunks)
+	w.write_info({'samples': len(pcs), 'dropped': 0})
+	w.write_maps(MakeMaps(modules))
+	f.close()
+
+def main():
+	parser = argparse.ArgumentParser(description='Replay a synthetic capture through live mode')
+	parser.add_argument('--samples', type=int, default=20000, help='samples in the capture')
+	parser.add_argument('--modules', type=int, default=2, help='shared objects sampled')
+	parser.add_argument('--functions', type=int, default=500, help='functions per module')
+	parser.add_argument('--seconds', type=float, default=3.0, help='how long the capture takes to write')
+	parser.add_argument('--chunk', type=int, default=1024, help='samples per flushed chunk')
+	parser.add_argument('--refresh', type=float, default=1.0, help='seconds between views')
+	parser.add_argument('--late', action='store_true', help='map the last module only once it is first sampled')
+	parser.add_argument('--keep', action='store_true', help='keep the work directory')
+	args = parser.parse_args()
+
+	workdir = tempfile.mkdtemp(prefix='aprof-live-')
+	cwd = os.getcwd()
+	try:
+		device = os.path.join(workdir, 'device')
+		os.makedirs(os.path.join(device, 'system', 'lib'))
+		os.makedirs(os.path.join(device, 'sdcard'))
+		os.makedirs(os.path.join(device, 'proc', str(PID)))
+		modules = []
+		placed = []
+		for m in xrange(args.modules):
+			remotepath = '/system/lib/liblive%d.so' % m
+			funcs = WriteElf(os.path.join(device, remotepath.lstrip('/')), 4, args.functions, 64, 10, 2, 3, '%040x' % (m + 100), m)
+			base = 0x40000000 + m * 0x01000000
+			modules.append((remotepath, base, (TEXT_START + len(funcs) * 64 + 0xfff) & ~0xfff))
+			placed.append((base, funcs))
+		# Move the late module's samples to the second half of the capture
+		pcs = MakeSamples(placed, args.samples, 'zipf')
+		if args.late:
+			half = len(pcs) // 2
+			latebase = modules[-1][1]
+			pcs = [pc for pc in pcs[:half] if pc < latebase] + pcs[half:] + [pc for pc in pcs[:half] if pc >= latebase]
+		InstallStubs(workdir, device)
+		os.chdir(workdir)
+
+		writer = threading.Thread(target=WriteLive, args=(device, modules, pcs, args.seconds, args.chunk, args.late))
+		start = time.time()
+		writer.start()
+		p = LiveProfiler([], REMOTEPATH, PID)
+		p.run(sys.stdout, args.refresh)
+		elapsed = time.time() - start
+		writer.join()
+		livehits = p.get_symbol_hits()
+		p.close()
+		print 'Live,%0.2fs,%d samples,%0.0f samples/s' % (elapsed, sum(livehits.values()), sum(livehits.values()) / elapsed)
+
+		p = Profiler([], os.path.join(device, REMOTEPATH.lstrip('/')))
+		offlinehits = p.get_symbol_hits()
+		p.close()
+		if livehits != offlinehits:
+			differ = [key for key in set(livehits.keys()) | set(offlinehits.keys()) if livehits.get(key) != offlinehits.get(key)]
+			print 'MISMATCH: %d symbols differ from the offline analysis' % len(differ)
+			sys.exit(1)
+		print 'Live and offline counts match'
+	finally:
+		os.chdir(cwd)
+		if args.keep:
+			print 'Work directory: %s' % workdir
+		else:
+			shutil.rmtree(workdir, True)
+
+if __name__ == '__main__':
+	main()
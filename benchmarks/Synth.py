@@ -0,0 +1,248 @@
+import bisect
+import random
+import struct
+
+from Aprof.ProfileData import *
+
+# Synthetic fixtures for the benchmarks: ELF shared objects with symbol and
+# line tables, the maps of a process that has them loaded, and PROFDAT files
+# sampling them.
+
+EM_ARM = 40
+EM_AARCH64 = 183
+
+# Where .text starts in every synthetic module (file offset and VMA)
+TEXT_START = 0x1000
+
+def MangledName(module, index):
+	# An Itanium-mangled name, bench<module>::f<index>(int), so the demangler
+	# has real work to do
+	ns = 'bench%d' % module
+	fn = 'f%d' % index
+	return '_ZN%d%s%d%sEi' % (len(ns), ns, len(fn), fn)
+
+def _uleb(value):
+	out = bytearray()
+	while True:
+		b = value & 0x7f
+		value >>= 7
+		if value:
+			out.append(b | 0x80)
+		else:
+			out.append(b)
+			return str(out)
+
+def _sleb(value):
+	out = bytearray()
+	while True:
+		b = value & 0x7f
+		value >>= 7
+		if (value == 0 and not b & 0x40) or (value == -1 and b & 0x40):
+			out.append(b)
+			return str(out)
+		out.append(b | 0x80)
+
+def _debug_line(rows, files, end, addrsize, version):
+	# One DWARF 2-4 line program covering rows of (addr, file index, line)
+	header = ''
+	header += struct.pack('<BBbBB', 1, 1, -5, 14, 13)
+	if version >= 4:
+		header = header[:1] + struct.pack('<B', 1) + header[1:] # maximum_operations_per_instruction
+	header += struct.pack('<12B', 0, 1, 1, 1, 1, 0, 0, 0, 1, 0, 0, 1)
+	header += 'src\0\0'
+	for name in files:
+		header += name + '\0' + _uleb(1) + _uleb(0) + _uleb(0)
+	header += '\0'
+	program = [struct.pack('<BB', 0, 1 + addrsize) + '\x02' + struct.pack('<I' if addrsize == 4 else '<Q', rows[0][0])]
+	(addr, file, line) = (rows[0][0], 1, 1)
+	for (raddr, rfile, rline) in rows:
+		if raddr != addr:
+			program.append('\x02' + _uleb(raddr - addr))
+			addr = raddr
+		if rfile + 1 != file:
+			program.append('\x04' + _uleb(rfile + 1))
+			file = rfile + 1
+		if rline != line:
+			program.append('\x03' + _sleb(rline - line))
+			line = rline
+		program.append('\x01')
+	program.append('\x02' + _uleb(end - addr))
+	program.append('\x00\x01\x01')
+	program = ''.join(program)
+	body = struct.pack('<I', len(header)) + header + program
+	return struct.pack('<IH', 2 + len(body), version) + body
+
+def WriteElf(path, pcsize=4, nfuncs=1000, funcsize=64, nfiles=20, rowsperfunc=4,
+	dwarfversion=3, buildid=None, module=0, sidecar=False):
+	# Write a shared object with nfuncs functions of funcsize bytes each, a
+	# .symtab naming them, a .debug_line with rowsperfunc rows per function
+	# spread over nfiles source files, and (if buildid is given) a GNU build-id
+	# note. dwarfversion outside 2-4 makes the line table undecodable, which
+	# sends line lookups to addr2line; sidecar writes <path>.lines for the stub
+	# addr2line to answer from. Returns [(vma, size, name)].
+	is64 = pcsize == 8
+	funcs = [(TEXT_START + i * funcsize, funcsize, MangledName(module, i)) for i in xrange(nfuncs)]
+	textsize = nfuncs * funcsize
+	files = ['file%d.cpp' % i for i in xrange(nfiles)]
+	rows = []
+	for (i, (vma, size, name)) in enumerate(funcs):
+		for k in xrange(rowsperfunc):
+			rows.append((vma + k * size // rowsperfunc, i % nfiles, 10 * i + k + 1))
+	version = dwarfversion if 2 <= dwarfversion <= 4 else 3
+	debugline = _debug_line(rows, files, TEXT_START + textsize, pcsize, version)
+	if version != dwarfversion:
+		debugline = debugline[:4] + struct.pack('<H', dwarfversion) + debugline[6:]
+
+	strtab = '\0'
+	syms = [struct.pack('<IBBHQQ', 0, 0, 0, 0, 0, 0) if is64 else struct.pack('<IIIBBH', 0, 0, 0, 0, 0, 0)]
+	for (vma, size, name) in funcs:
+		info = (1 << 4) | 2 # STB_GLOBAL, STT_FUNC
+		if is64:
+			syms.append(struct.pack('<IBBHQQ', len(strtab), info, 0, 1, vma, size))
+		else:
+			syms.append(struct.pack('<IIIBBH', len(strtab), vma, size, info, 0, 1))
+		strtab += name + '\0'
+	symtab = ''.join(syms)
+
+	note = ''
+	if buildid is not None:
+		desc = buildid.decode('hex')
+		note = struct.pack('<III', 4, len(desc), 3) + 'GNU\0' + desc
+
+	# Sections after .text, in file order: (name, type, data, link, entsize).
+	# Section 0 is the null section and 1 is .text, so .strtab is section 3,
+	# or 4 after a build-id note.
+	sections = [
+		('.symtab', 2, symtab, 4 if note else 3, 24 if is64 else 16),
+		('.strtab', 3, strtab, 0, 0),
+		('.debug_line', 1, debugline, 0, 0),
+	]
+	if note:
+		sections.insert(0, ('.note.gnu.build-id', 7, note, 0, 0))
+	names = ['.text'] + [s[0] for s in sections] + ['.shstrtab']
+	shstrtab = '\0'
+	nameoffs = {}
+	for name in names:
+		nameoffs[name] = len(shstrtab)
+		shstrtab += name + '\0'
+	sections.append(('.shstrtab', 3, shstrtab, 0, 0))
+
+	ehsize = 64 if is64 else 52
+	phentsize = 56 if is64 else 32
+	shentsize = 64 if is64 else 40
+	out = ['\0' * TEXT_START, '\0' * textsize]
+	offset = TEXT_START + textsize
+	layout = []
+	for (name, shtype, data, link, entsize) in sections:
+		pad = (-offset) % 8
+		out.append('\0' * pad)
+		offset += pad
+		layout.append((name, shtype, offset, len(data), link, entsize))
+		out.append(data)
+		offset += len(data)
+	pad = (-offset) % 8
+	out.append('\0' * pad)
+	shoff = offset + pad
+
+	shdrs = []
+	def shdr(name, shtype, flags, addr, off, size, link, entsize):
+		if is64:
+			return struct.pack('<IIQQQQIIQQ', name, shtype, flags, addr, off, size, link, 0, 8, entsize)
+		return struct.pack('<IIIIIIIIII', name, shtype, flags, addr, off, size, link, 0, 4, entsize)
+	shdrs.append(shdr(0, 0, 0, 0, 0, 0, 0, 0))
+	shdrs.append(shdr(nameoffs['.text'], 1, 6, TEXT_START, TEXT_START, textsize, 0, 0))
+	for (name, shtype, off, size, link, entsize) in layout:
+		shdrs.append(shdr(nameoffs[name], shtype, 2 if shtype == 7 else 0, 0, off, size, link, entsize))
+	out.append(''.join(shdrs))
+
+	# One PT_LOAD covering .text, plus the build-id note if there is one
+	phdrs = []
+	loadend = TEXT_START + textsize
+	if is64:
+		phdrs.append(struct.pack('<IIQQQQQQ', 1, 5, 0, 0, 0, loadend, loadend, 0x1000))
+	else:
+		phdrs.append(struct.pack('<IIIIIIII', 1, 0, 0, 0, loadend, loadend, 5, 0x1000))
+	if note:
+		(name, shtype, off, size, link, entsize) = layout[0]
+		if is64:
+			phdrs.append(struct.pack('<IIQQQQQQ', 4, 4, off, 0, 0, size, size, 4))
+		else:
+			phdrs.append(struct.pack('<IIIIIIII', 4, off, 0, 0, size, size, 4, 4))
+	ident = '\x7fELF' + struct.pack('<BBB', 2 if is64 else 1, 1, 1) + '\0' * 9
+	if is64:
+		ehdr = ident + struct.pack('<HHIQQQIHHHHHH', 3, EM_AARCH64, 1, 0, ehsize, shoff, 0,
+			ehsize, phentsize, len(phdrs), shentsize, len(shdrs), len(shdrs) - 1)
+	else:
+		ehdr = ident + struct.pack('<HHIIIIIHHHHHH', 3, EM_ARM, 1, 0, ehsize, shoff, 0,
+			ehsize, phentsize, len(phdrs), shentsize, len(shdrs), len(shdrs) - 1)
+	headers = ehdr + ''.join(phdrs)
+	out[0] = headers + '\0' * (TEXT_START - len(headers))
+
+	f = open(path, 'wb')
+	f.write(''.join(out))
+	f.close()
+	if sidecar:
+		f = open(path + '.lines', 'w')
+		for (addr, file, line) in rows:
+			f.write('%x src/%s:%d\n' % (addr, files[file], line))
+		f.write('%x ??:0\n' % (TEXT_START + textsize))
+		f.close()
+	return funcs
+
+def MakeMaps(modules, pcsize=4):
+	# /proc/self/maps text for modules, a list of (remotepath, base, size), with
+	# the usual unnamed and special mappings around them
+	width = 16 if pcsize == 8 else 8
+	fmt = '%%0%dx-%%0%dx %%s %%08x 00:00 %%d %%s\n' % (width, width)
+	lines = [fmt % (0x8000, 0x10000, 'r-xp', 0, 1, '/system/bin/app_process')]
+	for (i, (path, base, size)) in enumerate(modules):
+		lines.append(fmt % (base, base + size, 'r-xp', 0, 100 + i, path))
+		lines.append(fmt % (base + size, base + size + 0x1000, 'rw-p', 0, 0, ''))
+	lines.append(fmt % (0xffff0000, 0xffff1000, 'r-xp', 0, 0, '[vectors]'))
+	return ''.join(lines)
+
+def MakeSamples(modules, nsamps, distribution='uniform', zipf=1.1, unknown=0.01, seed=1):
+	# nsamps PCs over modules, a list of (base, funcs) with funcs as returned
+	# by WriteElf. 'uniform' samples every function alike; 'zipf' makes a few
+	# functions hot, like real profiles. A fraction unknown of the samples land
+	# outside every module.
+	rnd = random.Random(seed)
+	targets = [(base, vma, size) for (base, funcs) in modules for (vma, size, name) in funcs]
+	if distribution == 'zipf':
+		rnd.shuffle(targets)
+		weights = [1.0 / (rank + 1) ** zipf for rank in xrange(len(targets))]
+	else:
+		weights = [1.0] * len(targets)
+	cumulative = []
+	total = 0.0
+	for w in weights:
+		total += w
+		cumulative.append(total)
+	pcs = []
+	for i in xrange(nsamps):
+		if rnd.random() < unknown:
+			pcs.append(0x12340000 + rnd.randrange(0, 0x10000, 2))
+			continue
+		(base, vma, size) = targets[bisect.bisect_left(cumulative, rnd.random() * total)]
+		pcs.append(base + vma + rnd.randrange(0, size, 2))
+	return pcs
+
+def WriteProfile(path, pcs, maps, pcsize=4, version=2, threads=1, codec=CODEC_ZLIB, frequency=100):
+	# A PROFDAT1 file, or a PROFDAT2 file with the samples dealt round-robin
+	# to the given number of threads
+	f = open(path, 'wb')
+	fmt = '<%d%s' % (len(pcs), 'Q' if pcsize == 8 else 'I')
+	if version == 1:
+		f.write('PROFDAT1')
+		f.write(struct.pack('<IQ', pcsize, len(pcs)))
+		f.write(struct.pack(fmt, *pcs))
+		f.write('MAPSDATA')
+		f.write(struct.pack('<Q', len(maps)))
+		f.write(maps)
+	else:
+		w = ProfileWriter(f, pcsize, '<')
+		w.write_info({'clock': 'prof', 'frequency': frequency})
+		for t in xrange(threads):
+			w.write_samples(pcs[t::threads], 1000 + t, codec)
+		w.write_maps(maps)
+	f.close()
@@ -27,4 +27,14 @@ LOCAL_MODULE		:= AprofTest
 LOCAL_SRC_FILES		:=	$(SRC_ROOT)/AprofTest.cpp
 LOCAL_SHARED_LIBRARIES := Aprof AprofTest_mm
 
-include $(BUILD_EXECUTABLE)
\ No newline at end of file
+include $(BUILD_EXECUTABLE)
+
+include $(CLEAR_VARS)
+
+SRC_ROOT			:= ..
+
+LOCAL_MODULE		:= AprofStressTest
+LOCAL_SRC_FILES		:=	$(SRC_ROOT)/AprofStressTest.cpp
+LOCAL_SHARED_LIBRARIES := Aprof
+
+include $(BUILD_EXECUTABLE)